@@ -1,19 +1,42 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g, Response, stream_with_context
 from flask_cors import CORS
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
-import cv2
+import json
+import posixpath
 import numpy as np
-from scipy.signal import convolve2d
 import zipfile
+import zlib
+import hashlib
+import sqlite3
+import socket
+import bisect
+import heapq
+import ipaddress
 import uuid
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import shutil
 import pymysql
 from functools import wraps
+from contextlib import contextmanager
+from image_processing import (MAJORITY_WINDOW_SIZE, TILE_SIZE, PIPELINE_VERSION, OUTPUT_FORMATS,
+                              DEFAULT_OUTPUT_FORMAT, stage_timings, timed_stage, load_image, smooth_image,
+                              process_image, build_component_tables, apply_component_thresholds,
+                              is_target_file, encode_mask, output_file_name_for)
 import jwt
 from jwt import encode, decode
 import datetime
-from queue import Queue
+from collections import deque, OrderedDict
+import itertools
 import threading
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只能单进程运行
+    fcntl = None
 import time
 import logging
 from logging.config import dictConfig
@@ -46,14 +69,15 @@ logging.getLogger('werkzeug').disabled = True
 app = Flask(__name__)
 CORS(app)
 
+# 服务前的可信反向代理层数，0 表示直接对外服务。大于 0 时只采信 X-Forwarded-For 中
+# 由这几层代理追加的地址，客户端自行伪造的请求头不会影响白名单和按IP的调度与限额
+TRUSTED_PROXY_COUNT = 0
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
+
 # 2. 添加获取客户端IP的函数
-def get_client_ip():    
-    if request.headers.get('X-Forwarded-For'):
-        ip = request.headers.get('X-Forwarded-For').split(',')[0].strip()
-        return ip
-    elif request.headers.get('X-Real-IP'):
-        ip = request.headers.get('X-Real-IP')
-        return ip
+def get_client_ip():
+    """客户端IP，经可信代理时由 ProxyFix 改写为真实地址"""
     return request.remote_addr
 
 # JWT配置
@@ -72,11 +96,160 @@ db_config = {
 # 基础文件夹配置
 BASE_UPLOAD_FOLDER = 'uploads'
 BASE_PROCESSED_FOLDER = 'processed'
+RESULT_CACHE_FOLDER = 'cache'
+COMPONENTS_FOLDER = 'components'
 os.makedirs(BASE_UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(BASE_PROCESSED_FOLDER, exist_ok=True)
+os.makedirs(RESULT_CACHE_FOLDER, exist_ok=True)
+os.makedirs(COMPONENTS_FOLDER, exist_ok=True)
+
+# 单个任务内并行处理文件的进程数，设为1时在队列线程中顺序处理
+FILE_PROCESS_WORKERS = os.cpu_count() or 1
+# 结果ZIP压缩方式：zipfile.ZIP_STORED / zipfile.ZIP_DEFLATED / zipfile.ZIP_LZMA
+RESULT_ZIP_COMPRESSION = zipfile.ZIP_STORED
+# 结果ZIP压缩级别，None为默认值；ZIP_DEFLATED取0-9，ZIP_LZMA不支持设置级别
+RESULT_ZIP_COMPRESSLEVEL = None
+# 结果缓存容量上限（字节），超出后按最近使用时间淘汰，设为0时不缓存
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# 保留连通区域表（用于重新设置阈值）的时长（秒）
+COMPONENTS_TTL = 1800
+# 重新设置阈值生成的结果ZIP在生成后保留的时长（秒）
+RETHRESHOLD_ZIP_TTL = 1800
+# 重新设置阈值生成的结果ZIP（及未写完的临时文件）的文件名：任务ID_白色阈值_黑色阈值_随机串_processed.zip
+RETHRESHOLD_ZIP_PATTERN = re.compile(r'.+_-?\d+_-?\d+_[0-9a-f]{12}_processed\.zip(\.part)?')
+
+# 数据库连接池最大连接数（含使用中的连接）
+DB_POOL_SIZE = 10
+# 取连接时等待空闲连接的最长时间（秒）
+DB_POOL_TIMEOUT = 10
+# 连接创建超过该时间（秒）后不再复用，关闭重建
+DB_POOL_RECYCLE = 3600
+# 连接空闲超过该时间（秒）后关闭，避免被MySQL的wait_timeout断开
+DB_POOL_IDLE_TIMEOUT = 600
+# 连接空闲超过该时间（秒）后，取出时先ping检查是否可用
+DB_POOL_PING_INTERVAL = 30
+
+class ConnectionPool:
+    """线程安全的MySQL连接池，连接按需创建，总数不超过max_size"""
+
+    def __init__(self, config, max_size, timeout, recycle, idle_timeout, ping_interval):
+        self.config = config
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        # 空闲连接 (连接, 创建时间, 归还时间)，后进先出，使少数连接保持活跃，多余的自然空闲过期
+        self.idle = []
+        self.stats = {'in_use': 0, 'created': 0, 'reused': 0, 'recycled': 0, 'broken': 0,
+                      'waits': 0, 'timeouts': 0}
+
+    def close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats['waits'] += 1
+            if not self.slots.acquire(timeout=self.timeout):
+                with self.lock:
+                    self.stats['timeouts'] += 1
+                raise RuntimeError('数据库连接池已满，等待超时')
+
+        try:
+            while True:
+                now = time.time()
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, created_at, returned_at = self.idle.pop()
+                if (now - created_at > self.recycle or now - returned_at > self.idle_timeout):
+                    self.close_quietly(conn)
+                    with self.lock:
+                        self.stats['recycled'] += 1
+                    continue
+                if now - returned_at > self.ping_interval:
+                    try:
+                        conn.ping(reconnect=False)
+                    except Exception:
+                        self.close_quietly(conn)
+                        with self.lock:
+                            self.stats['broken'] += 1
+                        continue
+                with self.lock:
+                    self.stats['reused'] += 1
+                    self.stats['in_use'] += 1
+                return conn, created_at
 
-def get_db_connection():
-    return pymysql.connect(**db_config)
+            conn = pymysql.connect(**self.config)
+            with self.lock:
+                self.stats['created'] += 1
+                self.stats['in_use'] += 1
+            return conn, time.time()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn, created_at):
+        # 结束未提交的事务，下次取出时不会读到旧快照
+        try:
+            conn.rollback()
+            with self.lock:
+                self.idle.append((conn, created_at, time.time()))
+        except Exception:
+            self.close_quietly(conn)
+            with self.lock:
+                self.stats['broken'] += 1
+        finally:
+            with self.lock:
+                self.stats['in_use'] -= 1
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        """取出连接，退出时（包括发生异常时）归还"""
+        conn, created_at = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn, created_at)
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, idle=len(self.idle), max_size=self.max_size)
+
+db_pool = ConnectionPool(db_config, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+                         DB_POOL_IDLE_TIMEOUT, DB_POOL_PING_INTERVAL)
+
+# 已验证token缓存的最大条数，设为0时每次请求都重新验证
+TOKEN_CACHE_SIZE = 256
+
+# 已验证的token -> 解码后的内容，按最近使用排序
+verified_tokens = OrderedDict()
+verified_tokens_lock = threading.Lock()
+
+def verify_token(token):
+    """验证token并返回其内容，无效时抛出异常；验证过且未过期的token直接返回缓存的内容"""
+    with verified_tokens_lock:
+        claims = verified_tokens.get(token)
+        if claims is not None:
+            if 'exp' not in claims or time.time() < claims['exp']:
+                verified_tokens.move_to_end(token)
+                return claims
+            del verified_tokens[token]
+
+    claims = decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    if TOKEN_CACHE_SIZE > 0:
+        with verified_tokens_lock:
+            verified_tokens[token] = claims
+            while len(verified_tokens) > TOKEN_CACHE_SIZE:
+                verified_tokens.popitem(last=False)
+    return claims
 
 def token_required(f):
     @wraps(f)
@@ -86,107 +259,406 @@ def token_required(f):
             return jsonify({'message': '没有提供token!', 'status': 'error'}), 401
         try:
             token = token.split(' ')[1]
-            decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            # 解码后的内容供接口直接使用，无需再次解码
+            g.token_claims = verify_token(token)
         except:
             return jsonify({'message': 'token无效!', 'status': 'error'}), 401
         return f(*args, **kwargs)
     return decorated
 
-def linear_show(image, contrast_factor):
-    low_percentile = np.percentile(image, contrast_factor * 100)
-    high_percentile = np.percentile(image, 100 - contrast_factor * 100)
-    return np.clip((image - low_percentile) * 255 / (high_percentile - low_percentile), 0, 255)
 
-def process_image(file_path, white_area_threshold, black_area_threshold):
+# 结果缓存命中统计
+cache_stats = {'hits': 0, 'misses': 0}
+cache_stats_lock = threading.Lock()
+# 没有 fcntl 时只能在进程内用线程锁串行写入缓存
+result_cache_lock = threading.Lock()
+
+def result_cache_key(data, white_area_threshold, black_area_threshold, output_format):
+    """按输入文件内容和处理参数计算缓存键"""
+    params = f'{PIPELINE_VERSION}|{MAJORITY_WINDOW_SIZE}|{white_area_threshold}|{black_area_threshold}|{output_format}|'
+    return hashlib.sha256(params.encode() + data).hexdigest()
+
+def result_cache_get(key):
+    """读取缓存结果，未命中返回None；命中时更新修改时间作为最近使用时间"""
+    if RESULT_CACHE_MAX_BYTES <= 0:
+        return None
+    path = os.path.join(RESULT_CACHE_FOLDER, key)
     try:
-        ori = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
-        if ori is None:
-            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except OSError:
+        return None
 
-        if len(ori.shape) == 2:
-            mask_1 = ori
-        elif len(ori.shape) == 3:
-            mask_1 = ori[:, :, 0]
-        else:
-            return None
+def result_cache_put(key, data):
+    """写入缓存，写入前先淘汰到放得下新结果，保证缓存总大小不超过上限；
+    先写临时文件再重命名，避免其他进程读到不完整的文件"""
+    if RESULT_CACHE_MAX_BYTES <= 0 or len(data) > RESULT_CACHE_MAX_BYTES:
+        return
+    path = os.path.join(RESULT_CACHE_FOLDER, key)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    size_path = os.path.join(RESULT_CACHE_FOLDER, '.size')
+    try:
+        with result_cache_locked():
+            # 缓存总大小记录在 .size 文件中，只在放不下时才扫描目录
+            try:
+                with open(size_path, encoding='utf-8') as f:
+                    total_size = int(f.read())
+                if os.path.exists(path):
+                    total_size -= os.path.getsize(path)
+            except (OSError, ValueError):
+                total_size = None
+            if total_size is None or total_size + len(data) > RESULT_CACHE_MAX_BYTES:
+                total_size = evict_result_cache(len(data))
+                if total_size + len(data) > RESULT_CACHE_MAX_BYTES:
+                    return
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            with open(size_path, 'w', encoding='utf-8') as f:
+                f.write(str(total_size + len(data)))
+    except OSError as e:
+        print(f"写入缓存失败: {str(e)}")
 
-        mask_1 = linear_show(mask_1, 0.03).astype(np.uint8)
-        mask_1 = (mask_1 < 33).astype(np.uint8) * 255
-        mask_1 = convolve2d(mask_1 > 0, np.ones((5, 5), dtype=np.uint8), mode='same')
-        mask_1 = ((mask_1 > (5 * 5 / 2)) * 255).astype(np.uint8)
+@contextmanager
+def result_cache_locked():
+    """写入和淘汰缓存期间持有：缓存目录中锁文件上的文件锁。
+    每次重新打开锁文件，同一进程的线程之间也互斥；不在 fork 出的处理进程中使用线程锁"""
+    if fcntl is None:
+        with result_cache_lock:
+            yield
+        return
+    with open(os.path.join(RESULT_CACHE_FOLDER, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
 
-        if white_area_threshold > 0:
-            white_isolated_mask, _ = detect_isolated_points(mask_1, white_area_threshold, False)
-            mask_1[white_isolated_mask == 255] = 0
+def evict_result_cache(reserve):
+    """为reserve字节的新结果腾出空间，返回删除后的缓存总大小，调用时需持有缓存锁。
+    放不下时按最近使用时间从旧到新删除到上限的90%，避免缓存满后每次写入都扫描目录"""
+    entries = []
+    total_size = 0
+    with os.scandir(RESULT_CACHE_FOLDER) as it:
+        for entry in it:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            try:
+                if entry.name.endswith('.tmp'):
+                    # 持有缓存锁时的临时文件是写入中途退出留下的
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+    if total_size + reserve <= RESULT_CACHE_MAX_BYTES:
+        return total_size
+    entries.sort()
+    for _, size, path in entries:
+        if total_size + reserve <= RESULT_CACHE_MAX_BYTES * 9 // 10:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+    return total_size
+
+def record_cache_result(hit):
+    with cache_stats_lock:
+        cache_stats['hits' if hit else 'misses'] += 1
+
+def process_image_keep_components(source, white_area_threshold, black_area_threshold, components_path):
+    """处理单个图像并将连通区域表保存到components_path(.npz)，失败返回None
 
-        if black_area_threshold > 0:
-            black_isolated_mask, _ = detect_isolated_points(255 - mask_1, black_area_threshold, True)
-            mask_1[black_isolated_mask == 255] = 255
+    需要分块处理的大图不保存连通区域表。
+    """
+    with timed_stage('decode'):
+        image = load_image(source)
+    if image is None:
+        return None
+    if TILE_SIZE and max(image.shape) > TILE_SIZE:
+        return process_image(image, white_area_threshold, black_area_threshold)
 
+    try:
+        smoothed = smooth_image(image)
+        with timed_stage('isolated_points'):
+            tables = build_component_tables(smoothed)
+            np.savez(components_path, **tables)
+            mask_1, _ = apply_component_thresholds(tables, white_area_threshold, black_area_threshold)
         return mask_1
     except Exception as e:
         print(f"处理图像错误: {str(e)}")
         return None
 
-def detect_isolated_points(image, area_threshold, detect_black=False):
-    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(image, connectivity=8)
-    error_flag = 0
-    mask = np.zeros_like(image)
+def process_zip_member(zip_path, member_name, white_area_threshold, black_area_threshold,
+                       output_format=DEFAULT_OUTPUT_FORMAT, components_path=None):
+    """直接从ZIP中读取单个文件处理，返回 (编码后的结果, 是否命中缓存, 统计)，失败时结果为None
 
-    for i in range(1, num_labels):
-        connected_area = stats[i, -1]
-        if connected_area <= area_threshold:
-            error_flag = 1
-            mask[labels == i] = 255
+    相同内容和参数的文件直接返回缓存结果，跳过解码和处理。
+    指定components_path时同时保存连通区域表，此时不读缓存。
+    统计为 {'stages': {阶段: 秒}, 'pixels': 处理的像素数, 'bytes_in': 输入字节数, 'bytes_out': 输出字节数}。
+    """
+    timings = stage_timings.current = {}
+    try:
+        with timed_stage('read'):
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                data = zip_ref.read(member_name)
+        stats = {'stages': timings, 'pixels': 0, 'bytes_in': len(data), 'bytes_out': 0}
 
-    return mask, error_flag
+        with timed_stage('cache'):
+            key = result_cache_key(data, white_area_threshold, black_area_threshold, output_format)
+            cached = result_cache_get(key) if components_path is None else None
+        if cached is not None:
+            stats['bytes_out'] = len(cached)
+            return cached, True, stats
 
-def is_ip_allowed(ip):
+        with timed_stage('decode'):
+            image = load_image(data)
+        # 解码后即释放文件内容，处理期间不同时保留压缩数据和解码后的图像
+        del data
+        if image is None:
+            return None, False, stats
+        if components_path is None:
+            mask_1 = process_image(image, white_area_threshold, black_area_threshold)
+        else:
+            mask_1 = process_image_keep_components(image, white_area_threshold, black_area_threshold,
+                                                   components_path)
+        if mask_1 is None:
+            return None, False, stats
+        stats['pixels'] = mask_1.size
+        with timed_stage('encode'):
+            encoded = encode_mask(mask_1, output_format)
+        if encoded is not None:
+            stats['bytes_out'] = len(encoded)
+            with timed_stage('cache'):
+                result_cache_put(key, encoded)
+        return encoded, False, stats
+    finally:
+        stage_timings.current = None
+
+def rethreshold_file(components_path, white_area_threshold, black_area_threshold,
+                     output_format=None):
+    """按新阈值从保存的连通区域表重新生成结果，返回 (编码后的结果或None, 统计)
+
+    output_format为None时只统计，不读取标签图。
+    """
+    with np.load(components_path) as tables:
+        mask_1, stats = apply_component_thresholds(tables, white_area_threshold, black_area_threshold,
+                                                   with_mask=output_format is not None)
+    if mask_1 is None:
+        return None, stats
+    return encode_mask(mask_1, output_format), stats
+
+# 文件处理进程池，首次使用时创建，各任务共享
+process_pool = None
+process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(max_workers=FILE_PROCESS_WORKERS)
+        return process_pool
+
+def reset_process_pool(pool):
+    """进程池损坏（如子进程崩溃）后丢弃，下次使用时重建"""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is pool:
+            process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def run_file_jobs(func, jobs):
+    """并行执行func，按提交顺序逐个返回 (结果, 异常)，单个失败不影响其他"""
+    if FILE_PROCESS_WORKERS <= 1 or len(jobs) <= 1:
+        for args in jobs:
+            try:
+                yield func(*args), None
+            except Exception as e:
+                yield None, e
+        return
+
+    # 限制已提交未取走的任务数，避免结果在内存中堆积；记录每个任务提交到的进程池
+    pending = deque()
+    jobs = iter(jobs)
+    while True:
+        for args in itertools.islice(jobs, FILE_PROCESS_WORKERS * 2 - len(pending)):
+            pending.append((args,) + submit_file_job(func, args))
+        if not pending:
+            return
+        args, future, pool = pending.popleft()
+        try:
+            yield future.result(), None
+        except BrokenProcessPool:
+            # 只丢弃该任务所在的进程池；其他任务可能已换用新进程池，不能关闭新进程池
+            reset_process_pool(pool)
+            # 进程池中任一子进程崩溃时所有未完成的任务都会失败，单独重新执行以找出导致崩溃的文件
+            yield run_isolated_file_job(func, args)
+        except Exception as e:
+            yield None, e
+
+def run_isolated_file_job(func, args):
+    """在单独的子进程中执行，返回 (结果, 异常)；子进程再次崩溃说明是该任务本身导致的"""
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        try:
+            return pool.submit(func, *args).result(), None
+        except Exception as e:
+            return None, e
+
+def submit_file_job(func, args):
+    """提交到当前进程池，返回 (future, 进程池)；进程池已损坏时重建后重试一次"""
+    pool = get_process_pool()
     try:
-        # 首先检查白名单是否启用
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 获取白名单状态
+        return pool.submit(func, *args), pool
+    except BrokenProcessPool:
+        reset_process_pool(pool)
+        pool = get_process_pool()
+        return pool.submit(func, *args), pool
+
+# IP白名单索引的最长使用时间（秒），通过管理接口修改时立即失效；到期重新加载，以便识别直接修改数据库的情况
+IP_WHITELIST_TTL = 300
+
+def cache_version(name):
+    """名为name的缓存在所有服务进程间共享的版本号，每次查询缓存时检查"""
+    return task_registry.cache_version(name)
+
+def bump_cache_version(name):
+    """使所有服务进程中名为name的缓存失效"""
+    task_registry.bump_cache_version(name)
+
+class IpWhitelistIndex:
+    """IP白名单索引，单个IP和CIDR网段转为合并后的地址区间，按起点排序后二分查找"""
+
+    def __init__(self, enabled, entries, version=0):
+        self.enabled = enabled
+        self.version = version
+        self.loaded_at = time.time()
+        # 无法解析为IP或网段的记录按原字符串精确匹配
+        self.exact = set()
+        intervals = {4: [], 6: []}
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(entry.strip(), strict=False)
+            except ValueError:
+                self.exact.add(entry)
+                continue
+            intervals[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+        self.starts = {}
+        self.ends = {}
+        for version, ranges in intervals.items():
+            merged = []
+            for start, end in sorted(ranges):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.starts[version] = [start for start, _ in merged]
+            self.ends[version] = [end for _, end in merged]
+
+    def contains(self, ip):
+        if not self.enabled or ip in self.exact:
+            return True
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        i = bisect.bisect_right(self.starts[address.version], value) - 1
+        return i >= 0 and value <= self.ends[address.version][i]
+
+# 重新加载白名单失败后等待该秒数再重试，期间继续使用已加载的白名单
+IP_WHITELIST_RETRY = 30
+
+# 当前IP白名单索引，None表示尚未加载
+ip_whitelist = None
+ip_whitelist_lock = threading.Lock()
+# 上次加载失败的时间（time.monotonic()）
+ip_whitelist_failed_at = None
+
+def load_ip_whitelist(version):
+    with db_pool.connection() as conn, conn.cursor() as cursor:
         cursor.execute('SELECT enabled FROM whitelist_settings LIMIT 1')
         whitelist_result = cursor.fetchone()
-        whitelist_enabled = bool(whitelist_result['enabled']) if whitelist_result else True
-        
-        print(f"检查IP: {ip}")
-        print(f"白名单状态: {'启用' if whitelist_enabled else '禁用'}")
-        
-        if not whitelist_enabled:
-            print("白名单已禁用，允许所有IP访问")
-            cursor.close()
-            conn.close()
-            return True
-            
-        # 检查IP是否在白名单中
-        cursor.execute('SELECT COUNT(*) as count FROM allowed_ips WHERE ip = %s', (ip,))
-        result = cursor.fetchone()
-        ip_count = result['count']
-        
-        cursor.close()
-        conn.close()
-        
-        print(f"IP在白名单中的数量: {ip_count}")
-        return ip_count > 0
-        
+        cursor.execute('SELECT ip FROM allowed_ips')
+        rows = cursor.fetchall()
+    whitelist_enabled = bool(whitelist_result['enabled']) if whitelist_result else True
+    print(f"IP白名单已加载: {'启用' if whitelist_enabled else '禁用'}, {len(rows)} 条记录")
+    return IpWhitelistIndex(whitelist_enabled, [row['ip'] for row in rows], version)
+
+def get_ip_whitelist():
+    """返回当前白名单索引，过期或版本变化时重新加载
+
+    已有索引时只由一个线程重新加载，其他线程继续使用旧索引，不在数据库连接超时期间排队；
+    重新加载失败时继续使用旧索引，IP_WHITELIST_RETRY 秒后再重试。从未加载成功时抛出异常。
+    """
+    global ip_whitelist, ip_whitelist_failed_at
+    index = ip_whitelist
+    version = cache_version('ip_whitelist')
+    if index is not None and index.version == version and time.time() - index.loaded_at < IP_WHITELIST_TTL:
+        return index
+    failed_at = ip_whitelist_failed_at
+    if failed_at is not None and time.monotonic() - failed_at < IP_WHITELIST_RETRY:
+        if index is None:
+            raise RuntimeError('IP白名单加载失败，稍后重试')
+        return index
+
+    if not ip_whitelist_lock.acquire(blocking=index is None):
+        return index
+    try:
+        # 等锁期间其他线程可能已重新加载；版本号在读取数据库前取得，加载期间的修改会在下次检查时发现
+        if ip_whitelist is not index:
+            return ip_whitelist
+        if ip_whitelist_failed_at != failed_at:
+            # 等锁期间其他线程加载失败，不再重复连接数据库
+            if index is None:
+                raise RuntimeError('IP白名单加载失败，稍后重试')
+            return index
+        try:
+            ip_whitelist = load_ip_whitelist(version)
+        except Exception as e:
+            ip_whitelist_failed_at = time.monotonic()
+            if index is None:
+                raise
+            print(f"重新加载IP白名单错误，继续使用已加载的白名单: {str(e)}")
+            return index
+        ip_whitelist_failed_at = None
+        return ip_whitelist
+    finally:
+        ip_whitelist_lock.release()
+
+def invalidate_ip_whitelist():
+    """白名单或其启用状态修改后调用，所有服务进程在下次检查时重新加载"""
+    bump_cache_version('ip_whitelist')
+
+def is_ip_allowed(ip):
+    try:
+        return get_ip_whitelist().contains(ip)
     except Exception as e:
         print(f"检查IP错误: {str(e)}")
         return False
 
+def ip_whitelist_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not is_ip_allowed(get_client_ip()):
+            return jsonify({'message': '当前IP不在白名单中', 'status': 'error'}), 403
+        return f(*args, **kwargs)
+
+    return decorated
+
 @app.route('/api/ips', methods=['GET', 'POST'])
 @token_required
 def manage_ips():
     if request.method == 'GET':
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM allowed_ips')
-            ips = cursor.fetchall()
-            cursor.close()
-            conn.close()
+            with db_pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute('SELECT * FROM allowed_ips')
+                ips = cursor.fetchall()
             
             return jsonify({
                 'ips': ips,
@@ -207,30 +679,32 @@ def manage_ips():
                     'message': '请提供IP地址',
                     'status': 'error'
                 }), 400
-
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # 检查IP是否已存在
-            cursor.execute('SELECT COUNT(*) as count FROM allowed_ips WHERE ip = %s', (data['ip'],))
-            result = cursor.fetchone()
-            if result['count'] > 0:
-                cursor.close()
-                conn.close()
+            try:
+                ipaddress.ip_network(data['ip'].strip(), strict=False)
+            except ValueError:
                 return jsonify({
-                    'message': 'IP已存在',
+                    'message': 'IP地址或网段格式错误',
                     'status': 'error'
                 }), 400
 
-            # 添加新IP
-            cursor.execute(
-                'INSERT INTO allowed_ips (ip, description) VALUES (%s, %s)',
-                (data['ip'], data.get('description', ''))
-            )
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+            with db_pool.connection() as conn, conn.cursor() as cursor:
+                # 检查IP是否已存在
+                cursor.execute('SELECT COUNT(*) as count FROM allowed_ips WHERE ip = %s', (data['ip'],))
+                result = cursor.fetchone()
+                if result['count'] > 0:
+                    return jsonify({
+                        'message': 'IP已存在',
+                        'status': 'error'
+                    }), 400
+
+                # 添加新IP
+                cursor.execute(
+                    'INSERT INTO allowed_ips (ip, description) VALUES (%s, %s)',
+                    (data['ip'], data.get('description', ''))
+                )
+                
+                conn.commit()
+            invalidate_ip_whitelist()
             
             return jsonify({
                 'message': 'IP添加成功',
@@ -248,12 +722,9 @@ def manage_ips():
 @token_required
 def get_whitelist_status_api():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT enabled FROM whitelist_settings LIMIT 1')
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT enabled FROM whitelist_settings LIMIT 1')
+            result = cursor.fetchone()
         
         enabled = bool(result['enabled']) if result else True
         return jsonify({
@@ -271,13 +742,11 @@ def update_whitelist_status():
         if 'enabled' not in data:
             return jsonify({'message': '缺少enabled参数', 'status': 'error'}), 400
             
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE whitelist_settings SET enabled = %s', 
-                      (1 if data['enabled'] else 0,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('UPDATE whitelist_settings SET enabled = %s', 
+                          (1 if data['enabled'] else 0,))
+            conn.commit()
+        invalidate_ip_whitelist()
         
         return jsonify({
             'message': '设置更新成功',
@@ -286,23 +755,87 @@ def update_whitelist_status():
     except Exception as e:
         return jsonify({'message': str(e), 'status': 'error'}), 500
 
+@app.route('/api/db-pool/status', methods=['GET'])
+@token_required
+def get_db_pool_status():
+    return jsonify({
+        'pool': db_pool.status(),
+        'status': 'success'
+    })
+
+def render_samples(name, documentation, kind, values):
+    """渲染在请求时计算的指标，values为 (标签文本, 值) 列表"""
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+    lines.extend(f'{name}{labels} {value}' for labels, value in values)
+    return lines
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus格式的指标"""
+    lines = []
+    for metric in (stage_seconds, file_megapixels_per_second, task_queue_wait_seconds, task_service_seconds,
+                   files_total, tasks_total, pixels_total, bytes_in_total, bytes_out_total):
+        lines.extend(metric.render())
+    lines.extend(render_samples('tif_tasks_queued', '排队中的任务数', 'gauge', [('', task_registry.queued_count())]))
+    lines.extend(render_samples('tif_tasks_running', '处理中的任务数', 'gauge', [('', task_registry.running_count())]))
+    with cache_stats_lock:
+        cache = dict(cache_stats)
+    lines.extend(render_samples('tif_result_cache_lookups_total', '结果缓存命中/未命中次数', 'counter',
+                              [(f'{{result="{key}"}}', value) for key, value in sorted(cache.items())]))
+    lines.extend(render_samples('tif_db_pool_connections', '数据库连接池连接数', 'gauge',
+                              [(f'{{state="{key}"}}', value) for key, value in sorted(db_pool.status().items())
+                               if key in ('in_use', 'idle', 'max_size')]))
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# 默认阈值设置缓存的最长使用时间（秒），通过接口修改时立即失效
+THRESHOLD_SETTINGS_TTL = 300
+
+# 当前默认阈值设置 {'white_threshold', 'black_threshold', 'etag', 'version', 'loaded_at'}，None表示需要重新加载
+threshold_settings = None
+threshold_settings_lock = threading.Lock()
+
+def get_threshold_settings():
+    global threshold_settings
+    settings = threshold_settings
+    version = cache_version('threshold_settings')
+    if (settings is not None and settings['version'] == version and
+            time.time() - settings['loaded_at'] < THRESHOLD_SETTINGS_TTL):
+        return settings
+
+    with threshold_settings_lock:
+        if threshold_settings is settings:
+            with db_pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute('SELECT white_threshold, black_threshold FROM default_settings LIMIT 1')
+                result = cursor.fetchone()
+            white_threshold = result['white_threshold'] if result else 0
+            black_threshold = result['black_threshold'] if result else 0
+            threshold_settings = {
+                'white_threshold': white_threshold,
+                'black_threshold': black_threshold,
+                'etag': hashlib.sha1(f'{white_threshold}:{black_threshold}'.encode()).hexdigest()[:16],
+                'version': version,
+                'loaded_at': time.time()
+            }
+        return threshold_settings
+
+def invalidate_threshold_settings():
+    """默认阈值修改后调用，所有服务进程在下次查询时重新加载"""
+    bump_cache_version('threshold_settings')
+
 @app.route('/api/settings/threshold', methods=['GET', 'POST'])
 def manage_threshold_settings():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         if request.method == 'GET':
-            cursor.execute('SELECT white_threshold, black_threshold FROM default_settings LIMIT 1')
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            
-            return jsonify({
-                'white_threshold': result['white_threshold'] if result else 0,
-                'black_threshold': result['black_threshold'] if result else 0,
+            settings = get_threshold_settings()
+            response = jsonify({
+                'white_threshold': settings['white_threshold'],
+                'black_threshold': settings['black_threshold'],
                 'status': 'success'
             })
+            # 浏览器和反向代理每次用 If-None-Match 验证，未修改时返回304
+            response.set_etag(settings['etag'])
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
             
         elif request.method == 'POST':
             data = request.json
@@ -312,23 +845,23 @@ def manage_threshold_settings():
                     'status': 'error'
                 }), 400
                 
-            # 更新设置
-            cursor.execute('''
-                UPDATE default_settings 
-                SET white_threshold = %s, black_threshold = %s
-                WHERE id = (SELECT id FROM (SELECT id FROM default_settings LIMIT 1) AS temp)
-            ''', (data['white_threshold'], data['black_threshold']))
-            
-            # 如果没有记录，创建一条
-            if cursor.rowcount == 0:
+            with db_pool.connection() as conn, conn.cursor() as cursor:
+                # 更新设置
                 cursor.execute('''
-                    INSERT INTO default_settings (white_threshold, black_threshold)
-                    VALUES (%s, %s)
+                    UPDATE default_settings 
+                    SET white_threshold = %s, black_threshold = %s
+                    WHERE id = (SELECT id FROM (SELECT id FROM default_settings LIMIT 1) AS temp)
                 ''', (data['white_threshold'], data['black_threshold']))
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
+                
+                # 如果没有记录，创建一条
+                if cursor.rowcount == 0:
+                    cursor.execute('''
+                        INSERT INTO default_settings (white_threshold, black_threshold)
+                        VALUES (%s, %s)
+                    ''', (data['white_threshold'], data['black_threshold']))
+                
+                conn.commit()
+            invalidate_threshold_settings()
             
             return jsonify({
                 'message': '设置更新成功',
@@ -349,13 +882,10 @@ def login():
         if not auth or not auth.get('username') or not auth.get('password'):
             return jsonify({'message': '请提供用户名和密码!', 'status': 'error'}), 401
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM admin_users WHERE username = %s AND password = %s', 
-                      (auth.get('username'), auth.get('password')))
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT * FROM admin_users WHERE username = %s AND password = %s', 
+                          (auth.get('username'), auth.get('password')))
+            user = cursor.fetchone()
 
         if not user:
             return jsonify({'message': '用户名或密码错误!', 'status': 'error'}), 401
@@ -377,12 +907,29 @@ def login():
     except Exception as e:
         return jsonify({'message': str(e), 'status': 'error'}), 500
 
-# 全局任务队列
-task_queue = Queue()
-# 当前正在处理的任务ID
-current_task_id = None
-# 用于线程同步
-task_lock = threading.Lock()
+# 任务处理线程数，即可同时处理的任务数（多进程部署时为每个进程的线程数）
+TASK_WORKERS = 4
+# 已完成或失败的任务保留时长（秒，从创建时算起）
+TASK_TTL = 1800
+# 任务存储：'sqlite' 保存在 TASK_DB_PATH，重启不丢失，同一主机的多个进程可共享；'memory' 保存在本进程内存中
+TASK_BACKEND = 'sqlite'
+TASK_DB_PATH = 'tasks.db'
+# sqlite存储下，检查其他进程提交或更新的任务的间隔（秒）
+TASK_POLL_INTERVAL = 0.5
+# sqlite存储下，处理中任务的租约时长（秒），处理进程定期续约，进程退出后超时的任务重新排队
+TASK_LEASE = 60
+# 任务调度：'fair' 按客户端IP公平分配处理时间（按估算成本），'fifo' 按提交顺序
+TASK_SCHEDULING = 'fair'
+# 为True时优先处理估算成本小的任务：'fair' 调度下在同一IP的任务中优先，'fifo' 调度下在全部任务中优先
+TASK_SHORTEST_JOB_FIRST = False
+# 每个IP同时处理的任务数上限，0为不限
+TASK_MAX_RUNNING_PER_IP = 0
+# 每个IP排队和处理中的任务数上限，达到后拒绝新的上传，0为不限
+TASK_MAX_PENDING_PER_IP = 20
+# 估算任务耗时的初始处理速度（秒/MB），之后按已完成任务的实际耗时平滑更新
+TASK_SECONDS_PER_MB = 0.05
+# 每个待处理文件的固定开销，按该字节数计入任务成本
+TASK_FILE_COST_BYTES = 1024 ** 2
 
 class TaskStatus:
     QUEUED = 'queued'
@@ -390,50 +937,1029 @@ class TaskStatus:
     COMPLETED = 'completed'
     FAILED = 'failed'
 
-# 任务状态存储
-task_status = {}
+# 当前估算的处理速度（秒/成本字节），初始值由 TASK_SECONDS_PER_MB 换算
+task_seconds_per_cost = TASK_SECONDS_PER_MB / 1024 ** 2
+task_seconds_per_cost_lock = threading.Lock()
 
-def process_queue():
-    global current_task_id
-    while True:
-        if not task_queue.empty():
-            print_queue_status()  # 打印队列状态
-            with task_lock:
-                task_id = task_queue.get()
-                current_task_id = task_id
-                task_status[task_id]['status'] = TaskStatus.PROCESSING
-                
+def estimate_task_cost(zip_path):
+    """按ZIP目录估算任务成本，不解压：返回 {'files': 待处理文件数, 'bytes': 其解压后总大小, 'cost': 成本}"""
+    files = size = 0
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                if not info.is_dir() and is_target_file(posixpath.basename(info.filename)):
+                    files += 1
+                    size += info.file_size
+    except (OSError, zipfile.BadZipFile):
+        pass
+    return {'files': files, 'bytes': size, 'cost': size + files * TASK_FILE_COST_BYTES}
+
+def estimate_task_seconds(cost):
+    return cost * task_seconds_per_cost
+
+def observe_task_seconds(cost, seconds):
+    """按完成任务的实际耗时更新处理速度（指数平滑）"""
+    global task_seconds_per_cost
+    if cost > 0:
+        with task_seconds_per_cost_lock:
+            task_seconds_per_cost += 0.2 * (seconds / cost - task_seconds_per_cost)
+
+def remaining_task_seconds(cost, started_at, progress, now):
+    """处理中任务的预计剩余时间：已有进度时按已处理文件的速度推算，否则按估算成本"""
+    elapsed = max(now - started_at, 0) if started_at else 0
+    if progress and progress['done'] > 0:
+        return elapsed / progress['done'] * (progress['total'] - progress['done'])
+    return max(estimate_task_seconds(cost) - elapsed, 0)
+
+def task_cost(task):
+    return task['data'].get('cost', {}).get('cost', 0)
+
+def queued_task_seconds(running, ahead_count, ahead_cost, cost, workers):
+    """排队任务的预计完成秒数
+
+    running 为处理中任务的预计剩余秒数列表，ahead_count/ahead_cost 为排在前面的任务数和估算成本之和。
+    有空闲的处理线程时立即开始，否则按处理中和排在前面的任务总耗时平均分给各处理线程估算开始时间。
+    """
+    start = 0.0
+    if len(running) + ahead_count >= workers:
+        start = (sum(running) + estimate_task_seconds(ahead_cost)) / max(workers, 1)
+    return start + estimate_task_seconds(cost)
+
+def queue_tags(start, costs):
+    """一个IP的排队任务的开始时间标签，costs 为按该IP内处理顺序排列的成本
+
+    'fair' 调度下第一个任务从该IP已分配服务量的结束位置（不早于虚拟时间）开始，之后依次累加成本；
+    'fifo' 调度下都为0，只按排序键排列。
+    """
+    tags = []
+    for cost in costs:
+        tags.append(start if TASK_SCHEDULING == 'fair' else 0.0)
+        start += cost
+    return tags
+
+def task_order_key(cost, seq):
+    """同一IP的任务的排序键：按提交顺序，TASK_SHORTEST_JOB_FIRST 时按成本从小到大"""
+    return (cost, seq) if TASK_SHORTEST_JOB_FIRST else (seq,)
+
+class OrderIndex:
+    """按键排序的集合，每个键带有值和成本
+
+    用树堆（treap）保存，各节点记录子树的元素数和成本之和，插入、删除、求排在某键之前的元素数
+    及其成本之和都为 O(log n)。
+    """
+
+    class Node:
+        __slots__ = ('key', 'value', 'cost', 'priority', 'left', 'right', 'size', 'total')
+
+        def __init__(self, key, value, cost):
+            self.key = key
+            self.value = value
+            self.cost = cost
+            self.priority = random.random()
+            self.left = self.right = None
+            self.size = 1
+            self.total = cost
+
+    def __init__(self):
+        self.root = None
+
+    def __len__(self):
+        return self.root.size if self.root else 0
+
+    def __iter__(self):
+        """按键从小到大返回 (键, 值)"""
+        stack = []
+        node = self.root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.key, node.value
+            node = node.right
+
+    @staticmethod
+    def update(node):
+        node.size = 1
+        node.total = node.cost
+        for child in (node.left, node.right):
+            if child:
+                node.size += child.size
+                node.total += child.total
+
+    def merge(self, left, right):
+        """合并两棵树，left 中的键都小于 right 中的键"""
+        if left is None or right is None:
+            return left or right
+        if left.priority > right.priority:
+            left.right = self.merge(left.right, right)
+            self.update(left)
+            return left
+        right.left = self.merge(left, right.left)
+        self.update(right)
+        return right
+
+    def split(self, node, key):
+        """分为键小于key和不小于key的两棵树"""
+        if node is None:
+            return None, None
+        if node.key < key:
+            node.right, right = self.split(node.right, key)
+            self.update(node)
+            return node, right
+        left, node.left = self.split(node.left, key)
+        self.update(node)
+        return left, node
+
+    def remove_first(self, node):
+        if node.left is None:
+            return node.right
+        node.left = self.remove_first(node.left)
+        self.update(node)
+        return node
+
+    def insert(self, key, value, cost):
+        left, right = self.split(self.root, key)
+        self.root = self.merge(self.merge(left, self.Node(key, value, cost)), right)
+
+    def remove(self, key):
+        left, right = self.split(self.root, key)
+        # right 中最小的键即 key
+        self.root = self.merge(left, self.remove_first(right))
+
+    def rank(self, key):
+        """返回 (键小于key的元素数, 其成本之和)"""
+        count = total = 0
+        node = self.root
+        while node:
+            if node.key < key:
+                count += 1
+                total += node.cost
+                if node.left:
+                    count += node.left.size
+                    total += node.left.total
+                node = node.right
+            else:
+                node = node.left
+        return count, total
+
+class FairQueue:
+    """按客户端IP分组的排队任务，决定下一个开始处理的任务
+
+    'fair' 调度为开始时间公平排队（SFQ）：每个IP记录已分配的服务量（已开始任务的估算成本之和），
+    总是从服务量最小的IP取任务，一个IP提交的大任务不会让其他IP的小任务一直等待；
+    新出现或空闲过的IP从当前虚拟时间开始计，不能积累额度。'fifo' 调度按各IP队首任务的提交顺序选择。
+    同一IP的任务按提交顺序，TASK_SHORTEST_JOB_FIRST 时按成本从小到大。
+
+    每个排队任务带有开始时间标签，全部排队任务按 (标签, 排序键) 保存在 OrderIndex 中，即调度顺序：
+    加入任务时只重新计算该IP的标签，排队位置和前面任务的成本之和为 O(log n)，不需要模拟调度。
+    """
+
+    def __init__(self):
+        # IP -> 该IP排队任务按处理顺序的 [(排序键, 任务ID, 成本)]
+        self.queues = {}
+        # 全部排队任务按调度顺序，键为 (调度键, 任务ID)，值为 (IP, 成本)，调度键为 (开始时间标签,) + 排序键
+        self.order = OrderIndex()
+        # 任务ID -> 调度键
+        self.ranks = {}
+        # IP -> 处理中的任务数
+        self.running = {}
+        # IP -> 已分配服务量的结束位置，不超过虚拟时间的IP不记录
+        self.usage = {}
+        self.virtual_time = 0.0
+
+    @property
+    def size(self):
+        return len(self.order)
+
+    def retag(self, ip):
+        """按该IP当前的服务量和虚拟时间重新计算其排队任务的开始时间标签，调整在调度顺序中的位置"""
+        queue = self.queues[ip]
+        start = max(self.usage.get(ip, 0.0), self.virtual_time)
+        tags = queue_tags(start, [cost for _, _, cost in queue])
+        for tag, (key, task_id, cost) in zip(tags, queue):
+            rank = (tag,) + key
+            old = self.ranks.get(task_id)
+            if old == rank:
+                continue
+            if old is not None:
+                self.order.remove((old, task_id))
+            self.order.insert((rank, task_id), (ip, cost), cost)
+            self.ranks[task_id] = rank
+
+    def add(self, seq, task_id, client_ip, cost):
+        ip = client_ip or ''
+        bisect.insort(self.queues.setdefault(ip, []), (task_order_key(cost, seq), task_id, cost))
+        self.retag(ip)
+
+    def start(self, client_ip):
+        """记录一个处理中的任务"""
+        ip = client_ip or ''
+        self.running[ip] = self.running.get(ip, 0) + 1
+
+    def done(self, client_ip):
+        ip = client_ip or ''
+        self.running[ip] -= 1
+        if not self.running[ip]:
+            del self.running[ip]
+
+    def pending_count(self, client_ip):
+        """该IP排队和处理中的任务数"""
+        ip = client_ip or ''
+        return len(self.queues.get(ip, ())) + self.running.get(ip, 0)
+
+    def position(self, task_id):
+        """返回 (排在前面的任务数, 其估算成本之和)，任务不在队列中时返回None"""
+        rank = self.ranks.get(task_id)
+        if rank is None:
+            return None
+        return self.order.rank((rank, task_id))
+
+    def pop(self):
+        """取出下一个开始处理的任务并记为处理中，返回 (任务ID, IP, 成本)
+
+        没有排队任务，或有排队任务的IP都达到 TASK_MAX_RUNNING_PER_IP 时返回None。
+        """
+        skipped = set()
+        for (rank, task_id), (ip, cost) in self.order:
+            if not TASK_MAX_RUNNING_PER_IP or self.running.get(ip, 0) < TASK_MAX_RUNNING_PER_IP:
+                break
+            skipped.add(ip)
+        else:
+            return None
+
+        self.order.remove((rank, task_id))
+        del self.ranks[task_id]
+        # 同一IP中标签最小的任务即队首
+        del self.queues[ip][0]
+        if not self.queues[ip]:
+            del self.queues[ip]
+        self.start(ip)
+        if TASK_SCHEDULING == 'fair':
+            start = rank[0]
+            self.virtual_time = start
+            self.usage[ip] = start + cost
+            for stale in [other for other, finish in self.usage.items() if finish <= start]:
+                del self.usage[stale]
+            # 因达到处理中上限而跳过的IP，标签早于新的虚拟时间，改为从虚拟时间开始
+            for other in skipped:
+                self.retag(other)
+        return task_id, ip, cost
+
+def task_state(task, position):
+    """任务的状态、排队位置和进度，任一变化时推送新的任务事件"""
+    return task['status'], position, task.get('progress')
+
+class TaskRegistry:
+    """线程安全的内存任务表（'memory'任务存储）
+
+    排队任务由FairQueue决定处理顺序，排队位置和预计完成时间由其维护的调度顺序直接得到。
+    结束的任务按创建时间放入最小堆，清理时只处理已过期的任务。
+    等待状态变化的连接按任务登记条件变量，状态变化时只唤醒相关的连接。
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.running = set()
+        self.scheduler = FairQueue()
+        self.next_seq = 0
+        self.expiry = []
+        self.available = threading.Condition(self.lock)
+        # 任务ID -> [条件变量, 等待数]
+        self.watchers = {}
+        # 缓存名 -> 版本号，只有一个进程，保存在内存中
+        self.cache_versions = {}
+
+    def notify(self, task_id=None):
+        """唤醒等待task_id的连接，task_id为None时唤醒全部（排队位置都可能变化）"""
+        if task_id is None:
+            for condition, _ in self.watchers.values():
+                condition.notify_all()
+        elif task_id in self.watchers:
+            self.watchers[task_id][0].notify_all()
+
+    def add(self, task_id, task):
+        with self.lock:
+            task.update(status=TaskStatus.QUEUED, seq=self.next_seq)
+            self.next_seq += 1
+            self.tasks[task_id] = task
+            self.scheduler.add(task['seq'], task_id, task.get('client_ip'), task_cost(task))
+            self.available.notify()
+            self.notify()
+
+    def claim(self):
+        """阻塞等待下一个任务并标记为处理中，返回 (任务ID, 任务数据)"""
+        with self.lock:
+            while True:
+                picked = self.scheduler.pop()
+                if picked is not None:
+                    break
+                self.available.wait()
+            task_id = picked[0]
+            task = self.tasks[task_id]
+            self.running.add(task_id)
+            task.update(status=TaskStatus.PROCESSING, started_at=time.time())
+            self.notify()
+            return task_id, task['data']
+
+    def queued_count(self):
+        with self.lock:
+            return self.scheduler.size
+
+    def running_count(self):
+        with self.lock:
+            return len(self.running)
+
+    def pending_count(self, client_ip):
+        with self.lock:
+            return self.scheduler.pending_count(client_ip)
+
+    def set_progress(self, task_id, done, total):
+        with self.lock:
+            self.tasks[task_id]['progress'] = {'done': done, 'total': total}
+            self.notify(task_id)
+
+    def finish(self, task_id, status, **fields):
+        with self.lock:
+            task = self.tasks[task_id]
+            self.running.discard(task_id)
+            self.scheduler.done(task.get('client_ip'))
+            task.update(fields, status=status)
+            heapq.heappush(self.expiry, (task['created_at'], task_id))
+            # 该IP的处理中任务数减少后，受上限限制的任务可能可以开始
+            self.available.notify()
+            self.notify()
+
+    def locate(self, task_id):
+        """需持有self.lock调用"""
+        task = self.tasks.get(task_id)
+        if task is None:
+            return None, 0
+        task = dict(task)
+        position = 0
+        now = time.time()
+        if task['status'] == TaskStatus.QUEUED:
+            position, ahead_cost = self.scheduler.position(task_id)
+            running = [remaining_task_seconds(task_cost(self.tasks[other]), self.tasks[other].get('started_at'),
+                                              self.tasks[other].get('progress'), now)
+                       for other in self.running]
+            task['eta_seconds'] = queued_task_seconds(running, position, ahead_cost, task_cost(task), self.workers)
+            if len(self.running) >= self.workers:
+                position += 1
+        elif task['status'] == TaskStatus.PROCESSING:
+            task['eta_seconds'] = remaining_task_seconds(task_cost(task), task.get('started_at'),
+                                                         task.get('progress'), now)
+        return task, position
+
+    def get(self, task_id):
+        """返回 (任务副本, 排队位置)，任务不存在时返回 (None, 0)
+
+        排队位置为按调度顺序排在前面的等待任务数，所有处理线程都忙时再+1；
+        排队和处理中的任务副本带有预计完成的秒数 eta_seconds。
+        """
+        with self.lock:
+            return self.locate(task_id)
+
+    def wait(self, task_id, last_state, timeout):
+        """等待任务的状态、排队位置或进度与last_state不同，超时则返回当前结果，返回值同get"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            watcher = self.watchers.setdefault(task_id, [threading.Condition(self.lock), 0])
+            watcher[1] += 1
             try:
-                # 执行实际的处理逻辑
-                result = process_task(task_status[task_id]['data'])
-                task_status[task_id].update({
-                    'status': TaskStatus.COMPLETED,
-                    'result': result
-                })
-            except Exception as e:
-                task_status[task_id].update({
-                    'status': TaskStatus.FAILED,
-                    'error': str(e)
-                })
+                while True:
+                    task, position = self.locate(task_id)
+                    remaining = deadline - time.monotonic()
+                    if task is None or task_state(task, position) != last_state or remaining <= 0:
+                        return task, position
+                    watcher[0].wait(remaining)
             finally:
-                with task_lock:
-                    current_task_id = None
-        time.sleep(0.1)  # 避免CPU过度使用
+                watcher[1] -= 1
+                if watcher[1] == 0:
+                    del self.watchers[task_id]
+
+    def expire(self, max_age):
+        """删除创建超过max_age秒且已结束的任务，返回被删除的任务ID"""
+        now = time.time()
+        expired = []
+        with self.lock:
+            while self.expiry and now - self.expiry[0][0] > max_age:
+                _, task_id = heapq.heappop(self.expiry)
+                del self.tasks[task_id]
+                expired.append(task_id)
+        return expired
+
+    def snapshot(self):
+        """返回 (处理中的任务ID, 按创建时间排序的 (任务ID, 任务副本) 列表)"""
+        with self.lock:
+            running = list(self.running)
+            tasks = sorted(((task_id, dict(task)) for task_id, task in self.tasks.items()),
+                           key=lambda x: x[1]['created_at'])
+        return running, tasks
+
+    def cache_version(self, name):
+        with self.lock:
+            return self.cache_versions.get(name, 0)
+
+    def bump_cache_version(self, name):
+        with self.lock:
+            self.cache_versions[name] = self.cache_versions.get(name, 0) + 1
+
+class SqliteTaskStore:
+    """SQLite任务存储（'sqlite'任务存储），接口同TaskRegistry
+
+    使用WAL模式，同一主机的多个服务进程共享一个数据库文件：任务由 BEGIN IMMEDIATE 事务原子领取，
+    处理中的任务带有租约，由处理进程的心跳线程续约；进程崩溃后租约超时，任务重新排队。
+    调度状态（各IP的服务量和虚拟时间）和排队任务的开始时间标签（vstart 列，同 FairQueue）也保存在数据库中，
+    领取任务按索引中的调度顺序进行，任务变化时只重新计算所属IP的标签。排队任务的变化由触发器记入 queue_log，
+    各进程按日志增量维护调度顺序的 OrderIndex 副本，查询排队位置时不扫描排在前面的任务。
+    本进程内的变化立即唤醒等待者（进度变化只唤醒该任务的等待者），其他进程的变化每 poll_interval 秒检查一次。
+    各进程的处理线程数随心跳登记在 workers 表中，排队位置和预计时间按所有存活进程的线程总数计算。
+    白名单等进程内缓存的版本号也保存在数据库中，一个进程修改后其他进程下次查询时重新加载。
+    """
+
+    # queue_log 保留的行数
+    log_keep = 10000
+
+    def __init__(self, path, workers, poll_interval, lease):
+        self.path = path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.local = threading.local()
+        # 领取任务的线程等待
+        self.changed = threading.Condition()
+        # 任务ID -> [条件变量, 等待数, 通知次数]，等待状态变化的连接按任务登记
+        self.watch_lock = threading.Lock()
+        self.watchers = {}
+
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL,
+                client_ip TEXT,
+                created_at REAL NOT NULL,
+                progress TEXT,
+                result TEXT,
+                error TEXT,
+                owner TEXT,
+                lease_until REAL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_status_seq ON tasks (status, seq);
+            CREATE INDEX IF NOT EXISTS tasks_created_at ON tasks (created_at);
+            CREATE TABLE IF NOT EXISTS ip_usage (
+                client_ip TEXT PRIMARY KEY,
+                finish REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS scheduler_clock (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                virtual_time REAL NOT NULL
+            );
+            INSERT OR IGNORE INTO scheduler_clock VALUES (0, 0);
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS workers (
+                owner TEXT PRIMARY KEY,
+                workers INTEGER NOT NULL,
+                heartbeat_at REAL NOT NULL
+            );
+        ''')
+        # 旧版本创建的数据库没有调度用的列
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(tasks)')}
+        for column, definition in (('cost', 'REAL NOT NULL DEFAULT 0'), ('started_at', 'REAL'),
+                                   ('vstart', 'REAL NOT NULL DEFAULT 0')):
+            if column not in columns:
+                try:
+                    conn.execute(f'ALTER TABLE tasks ADD COLUMN {column} {definition}')
+                except sqlite3.OperationalError:
+                    pass  # 其他进程已添加
+        conn.execute('CREATE INDEX IF NOT EXISTS tasks_client_ip ON tasks (client_ip, status)')
+        conn.execute('CREATE INDEX IF NOT EXISTS tasks_schedule ON tasks (status, vstart, cost, seq)')
+        # 排队任务的加入、移出和标签变化由触发器记录，各进程据此增量维护自己的调度顺序
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS queue_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL,
+                vstart REAL,
+                cost REAL,
+                seq INTEGER
+            );
+            CREATE TRIGGER IF NOT EXISTS tasks_queue_insert AFTER INSERT ON tasks WHEN NEW.status = 'queued'
+            BEGIN
+                INSERT INTO queue_log (task_id, vstart, cost, seq) VALUES (NEW.task_id, NEW.vstart, NEW.cost, NEW.seq);
+            END;
+            CREATE TRIGGER IF NOT EXISTS tasks_queue_update AFTER UPDATE OF status, vstart, cost ON tasks
+            WHEN OLD.status = 'queued' OR NEW.status = 'queued'
+            BEGIN
+                INSERT INTO queue_log (task_id, vstart, cost, seq)
+                VALUES (NEW.task_id, CASE WHEN NEW.status = 'queued' THEN NEW.vstart END, NEW.cost, NEW.seq);
+            END;
+            CREATE TRIGGER IF NOT EXISTS tasks_queue_delete AFTER DELETE ON tasks WHEN OLD.status = 'queued'
+            BEGIN
+                INSERT INTO queue_log (task_id, vstart, cost, seq) VALUES (OLD.task_id, NULL, OLD.cost, OLD.seq);
+            END;
+        ''')
+        # 本进程的调度顺序副本：键为调度列的值，与 ORDER BY schedule_columns() 一致
+        self.order_lock = threading.Lock()
+        self.order = OrderIndex()
+        self.order_keys = {}
+        self.log_id = None
+        self.recover()
+        self.register_workers(conn)
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+
+    def connect(self):
+        """每个线程（fork后的子进程中重新）打开自己的连接"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def notify(self, task_id=None):
+        """唤醒等待task_id的连接，task_id为None时唤醒领取任务的线程和全部连接（排队位置都可能变化）"""
+        with self.watch_lock:
+            if task_id is None:
+                watchers = list(self.watchers.values())
+            else:
+                watchers = [self.watchers[task_id]] if task_id in self.watchers else []
+            for watcher in watchers:
+                watcher[2] += 1
+                watcher[0].notify_all()
+        if task_id is None:
+            with self.changed:
+                self.changed.notify_all()
+
+    @staticmethod
+    def to_task(row):
+        task = {
+            'status': row['status'],
+            'seq': row['seq'],
+            'data': json.loads(row['data']),
+            'client_ip': row['client_ip'],
+            'created_at': row['created_at']
+        }
+        for field in ('progress', 'result'):
+            if row[field] is not None:
+                task[field] = json.loads(row[field])
+        for field in ('error', 'started_at'):
+            if row[field] is not None:
+                task[field] = row[field]
+        return task
+
+    def recover(self):
+        """启动时将本机已退出进程（及本进程的旧PID）遗留的处理中任务重新排队，并重新计算排队任务的标签"""
+        host = socket.gethostname()
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for row in conn.execute("SELECT task_id, owner FROM tasks WHERE status = 'processing'").fetchall():
+                owner_host, _, pid = (row['owner'] or '').rpartition(':')
+                if owner_host != host:
+                    continue
+                alive = False
+                if row['owner'] != self.owner:
+                    try:
+                        os.kill(int(pid), 0)
+                        alive = True
+                    except PermissionError:
+                        alive = True
+                    except (OSError, ValueError):
+                        pass
+                if not alive:
+                    conn.execute('''UPDATE tasks SET status = 'queued', owner = NULL, lease_until = NULL, progress = NULL,
+                                    started_at = NULL WHERE task_id = ? AND status = 'processing' ''', (row['task_id'],))
+                    print(f"恢复未完成的任务: {row['task_id'][:8]}...")
+            # 调度设置可能已修改，全部重新计算
+            for row in conn.execute("SELECT DISTINCT client_ip FROM tasks WHERE status = 'queued'").fetchall():
+                self.retag(conn, row['client_ip'])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def heartbeat(self):
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                conn = self.connect()
+                conn.execute("UPDATE tasks SET lease_until = ? WHERE owner = ? AND status = 'processing'",
+                             (time.time() + self.lease, self.owner))
+                self.register_workers(conn)
+            except sqlite3.Error as e:
+                print(f"任务续约错误: {str(e)}")
+
+    def register_workers(self, conn):
+        """登记本进程的处理线程数，并删除心跳超时（已退出）的进程"""
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, ?)', (self.owner, self.workers, now))
+        conn.execute('DELETE FROM workers WHERE heartbeat_at < ?', (now - self.lease,))
+
+    def total_workers(self, conn):
+        """所有存活服务进程的处理线程数之和"""
+        total = conn.execute('SELECT SUM(workers) FROM workers WHERE heartbeat_at >= ?',
+                             (time.time() - self.lease,)).fetchone()[0]
+        return total or self.workers
+
+    def add(self, task_id, task):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT INTO tasks (task_id, status, data, client_ip, created_at, cost) VALUES (?, ?, ?, ?, ?, ?)',
+                (task_id, TaskStatus.QUEUED, json.dumps(task['data']), task.get('client_ip'), task['created_at'],
+                 task_cost(task)))
+            self.retag(conn, task.get('client_ip'))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.notify()
+
+    def retag(self, conn, client_ip):
+        """重新计算该IP排队任务的开始时间标签，只更新有变化的任务，需在写事务中调用"""
+        virtual_time = conn.execute('SELECT virtual_time FROM scheduler_clock').fetchone()[0]
+        usage = conn.execute('SELECT finish FROM ip_usage WHERE client_ip = ?', (client_ip or '',)).fetchone()
+        rows = sorted(conn.execute("""SELECT task_id, seq, cost, vstart FROM tasks
+                                      WHERE client_ip IS ? AND status = 'queued'""", (client_ip,)).fetchall(),
+                      key=lambda row: task_order_key(row['cost'], row['seq']))
+        start = max(usage[0] if usage else 0.0, virtual_time)
+        for row, tag in zip(rows, queue_tags(start, [row['cost'] for row in rows])):
+            if row['vstart'] != tag:
+                conn.execute('UPDATE tasks SET vstart = ? WHERE task_id = ?', (tag, row['task_id']))
+
+    @staticmethod
+    def schedule_columns():
+        """排队任务调度顺序的列，与 FairQueue 的调度键对应"""
+        return ('vstart', 'cost', 'seq') if TASK_SHORTEST_JOB_FIRST else ('vstart', 'seq')
+
+    def place(self, task_id, vstart, cost, seq):
+        """更新调度顺序副本中的一个任务，vstart为None时移出"""
+        key = self.order_keys.pop(task_id, None)
+        if key is not None:
+            self.order.remove(key)
+        if vstart is not None:
+            key = (vstart, cost, seq) if TASK_SHORTEST_JOB_FIRST else (vstart, seq)
+            self.order.insert(key, task_id, cost)
+            self.order_keys[task_id] = key
+
+    def sync_order(self, conn):
+        """读取上次同步之后的 queue_log 更新调度顺序副本，所需的日志已被清理时从任务表重新加载
+
+        需持有self.order_lock并在读事务中调用。
+        """
+        if self.log_id is not None:
+            first = conn.execute('SELECT MIN(id) FROM queue_log').fetchone()[0]
+            if first is not None and first > self.log_id + 1:
+                self.log_id = None
+        if self.log_id is None:
+            self.order = OrderIndex()
+            self.order_keys = {}
+            self.log_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM queue_log').fetchone()[0]
+            for row in conn.execute("SELECT task_id, vstart, cost, seq FROM tasks WHERE status = 'queued'"):
+                self.place(row['task_id'], row['vstart'], row['cost'], row['seq'])
+            return
+        for row in conn.execute('SELECT * FROM queue_log WHERE id > ? ORDER BY id', (self.log_id,)):
+            self.place(row['task_id'], row['vstart'], row['cost'], row['seq'])
+            self.log_id = row['id']
+
+    def try_claim(self):
+        conn = self.connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 租约超时（处理进程已退出）的任务重新排队
+            expired = [row['client_ip'] for row in conn.execute(
+                "SELECT DISTINCT client_ip FROM tasks WHERE status = 'processing' AND lease_until < ?", (now,))]
+            conn.execute('''UPDATE tasks SET status = 'queued', owner = NULL, lease_until = NULL, progress = NULL,
+                            started_at = NULL WHERE status = 'processing' AND lease_until < ?''', (now,))
+            for client_ip in expired:
+                self.retag(conn, client_ip)
+
+            capped = set()
+            if TASK_MAX_RUNNING_PER_IP:
+                capped = {row[0] for row in conn.execute(
+                    "SELECT client_ip FROM tasks WHERE status = 'processing' GROUP BY client_ip HAVING COUNT(*) >= ?",
+                    (TASK_MAX_RUNNING_PER_IP,))}
+            # 按调度顺序取第一个所属IP未达到处理中上限的任务
+            row = None
+            skipped = set()
+            for candidate in conn.execute(f"""SELECT task_id, data, client_ip, cost, vstart FROM tasks
+                                              WHERE status = 'queued' ORDER BY {', '.join(self.schedule_columns())}"""):
+                if candidate['client_ip'] not in capped:
+                    row = candidate
+                    break
+                skipped.add(candidate['client_ip'])
+            if row is not None:
+                conn.execute('''UPDATE tasks SET status = 'processing', owner = ?, lease_until = ?, started_at = ?
+                                WHERE task_id = ?''', (self.owner, now + self.lease, now, row['task_id']))
+                if TASK_SCHEDULING == 'fair':
+                    start = row['vstart']
+                    conn.execute('INSERT OR REPLACE INTO ip_usage VALUES (?, ?)',
+                                 (row['client_ip'] or '', start + row['cost']))
+                    conn.execute('DELETE FROM ip_usage WHERE finish <= ?', (start,))
+                    conn.execute('UPDATE scheduler_clock SET virtual_time = ?', (start,))
+                    # 因达到处理中上限而跳过的IP，标签早于新的虚拟时间，改为从虚拟时间开始
+                    for client_ip in skipped:
+                        self.retag(conn, client_ip)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        self.notify()
+        return row['task_id'], json.loads(row['data'])
+
+    def claim(self):
+        """阻塞等待下一个任务并标记为处理中，返回 (任务ID, 任务数据)"""
+        while True:
+            claimed = self.try_claim()
+            if claimed is not None:
+                return claimed
+            with self.changed:
+                self.changed.wait(self.poll_interval)
+
+    def queued_count(self):
+        return self.connect().execute("SELECT COUNT(*) FROM tasks WHERE status = 'queued'").fetchone()[0]
+
+    def running_count(self):
+        return self.connect().execute("SELECT COUNT(*) FROM tasks WHERE status = 'processing'").fetchone()[0]
+
+    def pending_count(self, client_ip):
+        return self.connect().execute(
+            "SELECT COUNT(*) FROM tasks WHERE client_ip IS ? AND status IN ('queued', 'processing')",
+            (client_ip,)).fetchone()[0]
+
+    def set_progress(self, task_id, done, total):
+        self.connect().execute('UPDATE tasks SET progress = ? WHERE task_id = ? AND owner = ?',
+                               (json.dumps({'done': done, 'total': total}), task_id, self.owner))
+        self.notify(task_id)
+
+    def finish(self, task_id, status, **fields):
+        # 租约超时后任务可能已被其他进程领取，只更新本进程领取的任务
+        self.connect().execute(
+            '''UPDATE tasks SET status = ?, result = ?, error = ?, owner = NULL, lease_until = NULL
+               WHERE task_id = ? AND owner = ?''',
+            (status, json.dumps(fields['result']) if 'result' in fields else None, fields.get('error'),
+             task_id, self.owner))
+        self.notify()
+
+    def get(self, task_id):
+        """返回 (任务副本, 排队位置)，任务不存在时返回 (None, 0)
+
+        排队位置为按调度顺序排在前面的等待任务数，处理中的任务数达到所有进程的处理线程总数时再+1；
+        排队和处理中的任务副本带有预计完成的秒数 eta_seconds。排队位置和前面任务的成本之和
+        由本进程的调度顺序副本求出，为 O(log n)。
+        """
+        conn = self.connect()
+        now = time.time()
+        # 在同一读事务中同步调度顺序并读取任务，两者一致；持有锁使副本不会比本事务读到的状态更新
+        with self.order_lock:
+            conn.execute('BEGIN')
+            try:
+                self.sync_order(conn)
+                row = conn.execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+                if row is None:
+                    return None, 0
+                task = self.to_task(row)
+                position = 0
+                if task['status'] == TaskStatus.QUEUED:
+                    position, ahead_cost = self.order.rank(self.order_keys[task_id])
+                    running = [remaining_task_seconds(other['cost'], other['started_at'],
+                                                      json.loads(other['progress']) if other['progress'] else None,
+                                                      now)
+                               for other in conn.execute("""SELECT cost, started_at, progress FROM tasks
+                                                            WHERE status = 'processing'""")]
+                    workers = self.total_workers(conn)
+                    task['eta_seconds'] = queued_task_seconds(running, position, ahead_cost, row['cost'], workers)
+                    if len(running) >= workers:
+                        position += 1
+                elif task['status'] == TaskStatus.PROCESSING:
+                    task['eta_seconds'] = remaining_task_seconds(row['cost'], task.get('started_at'),
+                                                                 task.get('progress'), now)
+                return task, position
+            finally:
+                conn.execute('COMMIT')
+
+    def wait(self, task_id, last_state, timeout):
+        """等待任务的状态、排队位置或进度与last_state不同，超时则返回当前结果，返回值同get"""
+        deadline = time.monotonic() + timeout
+        with self.watch_lock:
+            watcher = self.watchers.setdefault(task_id, [threading.Condition(self.watch_lock), 0, 0])
+            watcher[1] += 1
+        try:
+            while True:
+                # 查询期间收到的通知不会丢失：通知次数变化时不再等待
+                notified = watcher[2]
+                task, position = self.get(task_id)
+                remaining = deadline - time.monotonic()
+                if task is None or task_state(task, position) != last_state or remaining <= 0:
+                    return task, position
+                with self.watch_lock:
+                    if watcher[2] == notified:
+                        watcher[0].wait(min(remaining, self.poll_interval))
+        finally:
+            with self.watch_lock:
+                watcher[1] -= 1
+                if watcher[1] == 0:
+                    del self.watchers[task_id]
+
+    def expire(self, max_age):
+        """删除创建超过max_age秒且已结束的任务，返回被删除的任务ID"""
+        conn = self.connect()
+        cutoff = time.time() - max_age
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            expired = [row['task_id'] for row in conn.execute(
+                "SELECT task_id FROM tasks WHERE created_at < ? AND status IN ('completed', 'failed')", (cutoff,))]
+            conn.execute("DELETE FROM tasks WHERE created_at < ? AND status IN ('completed', 'failed')", (cutoff,))
+            # 保留最近的日志，落后更多的进程从任务表重新加载调度顺序；
+            # 至少保留最后一行，否则 sync_order 无法发现日志已被清理
+            conn.execute('DELETE FROM queue_log WHERE id <= (SELECT MAX(id) FROM queue_log) - ?',
+                         (max(self.log_keep, 1),))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return expired
+
+    def snapshot(self):
+        """返回 (处理中的任务ID, 按创建时间排序的 (任务ID, 任务副本) 列表)"""
+        rows = self.connect().execute('SELECT * FROM tasks ORDER BY created_at').fetchall()
+        running = [row['task_id'] for row in rows if row['status'] == TaskStatus.PROCESSING]
+        return running, [(row['task_id'], self.to_task(row)) for row in rows]
+
+    def cache_version(self, name):
+        """共享缓存的版本号，保存在数据库中，其他进程修改后本进程下次查询时即可发现"""
+        row = self.connect().execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump_cache_version(self, name):
+        self.connect().execute('''INSERT INTO cache_versions VALUES (?, 1)
+                                  ON CONFLICT (name) DO UPDATE SET version = version + 1''', (name,))
+
+def create_task_store():
+    if TASK_BACKEND == 'sqlite':
+        return SqliteTaskStore(TASK_DB_PATH, TASK_WORKERS, TASK_POLL_INTERVAL, TASK_LEASE)
+    elif TASK_BACKEND == 'memory':
+        return TaskRegistry(TASK_WORKERS)
+    raise ValueError(f'不支持的任务存储: {TASK_BACKEND}')
+
+# 任务状态存储，由 start_workers 在提供服务的进程中创建，导入模块时不打开数据库
+task_registry = None
+workers_lock = threading.Lock()
+workers_started = False
+
+class Counter:
+    """Prometheus计数器，按标签值分别累计"""
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.label_names, labels)} {value}')
+        return lines
+
+class Histogram:
+    """Prometheus直方图，按标签值分别统计各桶计数、总和与次数"""
+
+    def __init__(self, name, documentation, buckets, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        # 标签值 -> [各桶（非累计）计数..., 总和, 次数]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels(self.label_names + ("le",), labels + (bound,))} '
+                                 f'{cumulative}')
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names + ("le",), labels + ("+Inf",))} '
+                             f'{series[-1]}')
+                lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {series[-2]}')
+                lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {series[-1]}')
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+stage_seconds = Histogram('tif_stage_seconds', '单个文件各处理阶段的耗时（秒）', STAGE_BUCKETS, ('stage',))
+file_megapixels_per_second = Histogram('tif_file_megapixels_per_second', '单个文件的处理速度（百万像素/秒）',
+                                       (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+task_queue_wait_seconds = Histogram('tif_task_queue_wait_seconds', '任务排队等待时间（秒）', TASK_BUCKETS)
+task_service_seconds = Histogram('tif_task_service_seconds', '任务处理时间（秒）', TASK_BUCKETS)
+files_total = Counter('tif_files_total', '处理的文件数', ('result',))
+tasks_total = Counter('tif_tasks_total', '结束的任务数', ('status',))
+pixels_total = Counter('tif_pixels_total', '处理的像素数')
+bytes_in_total = Counter('tif_bytes_in_total', '读取的输入文件字节数')
+bytes_out_total = Counter('tif_bytes_out_total', '写入结果的字节数')
+
+def record_file_metrics(stats, result, timings):
+    """记录单个文件的指标并累加到任务的耗时统计timings中，stats为process_zip_member返回的统计"""
+    files_total.inc(1, result)
+    if stats is None:
+        return
+    for stage, seconds in stats['stages'].items():
+        stage_seconds.observe(seconds, stage)
+        timings['stages'][stage] = timings['stages'].get(stage, 0.0) + seconds
+    for field in ('pixels', 'bytes_in', 'bytes_out'):
+        timings[field] += stats[field]
+    pixels_total.inc(stats['pixels'])
+    bytes_in_total.inc(stats['bytes_in'])
+    bytes_out_total.inc(stats['bytes_out'])
+    busy = sum(stats['stages'].values())
+    if stats['pixels'] and busy > 0:
+        file_megapixels_per_second.observe(stats['pixels'] / busy / 1e6)
+
+def process_queue():
+    while True:
+        try:
+            task_id, task_data = task_registry.claim()  # 阻塞等待新任务
+        except Exception as e:
+            print(f"领取任务错误: {str(e)}")
+            time.sleep(1)
+            continue
+        print_queue_status()  # 打印队列状态
+
+        started_at = time.time()
+        queue_wait = started_at - task_data.get('queued_at', started_at)
+        task_queue_wait_seconds.observe(queue_wait)
+        try:
+            # 执行实际的处理逻辑
+            result = process_task(task_data, lambda done, total: task_registry.set_progress(task_id, done, total))
+            service = time.time() - started_at
+            observe_task_seconds(task_data.get('cost', {}).get('cost', 0), service)
+            timings = result['timings']
+            timings.update(queue_wait=round(queue_wait, 3), service=round(service, 3),
+                           megapixels_per_second=round(timings['pixels'] / service / 1e6, 2) if service > 0 else 0)
+            task_registry.finish(task_id, TaskStatus.COMPLETED, result=result)
+            tasks_total.inc(1, TaskStatus.COMPLETED)
+        except Exception as e:
+            task_registry.finish(task_id, TaskStatus.FAILED, error=str(e))
+            tasks_total.inc(1, TaskStatus.FAILED)
+        task_service_seconds.observe(time.time() - started_at)
 
 def print_queue_status():
     """打印当前队列状态"""
+    # 按创建时间排序的任务列表
+    running, sorted_tasks = task_registry.snapshot()
+
     print("\n=== 队列状态 ===")
     print(f"当前时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"队列中任务数量: {task_queue.qsize()}")
-    print(f"当前处理任务ID: {current_task_id}")
+    print(f"队列中任务数量: {task_registry.queued_count()}")
+    print(f"当前处理任务ID: {', '.join(t[:8] for t in running) or None}")
+    print(f"结果缓存: 命中 {cache_stats['hits']} 次, 未命中 {cache_stats['misses']} 次")
+    pool = db_pool.status()
+    print(f"数据库连接池: 使用中 {pool['in_use']}, 空闲 {pool['idle']}, 已创建 {pool['created']}")
     print("\n任务详情:")
     
-    # 按创建时间排序的任务列表
-    sorted_tasks = sorted(
-        task_status.items(),
-        key=lambda x: x[1]['created_at']
-    )
-    
     for task_id, task in sorted_tasks:
         status_str = {
             TaskStatus.QUEUED: "等待中",
@@ -448,46 +1974,78 @@ def print_queue_status():
     
     print("================\n")
 
-# 启动队列处理线程
-threading.Thread(target=process_queue, daemon=True).start()
+def build_task_data(upload_folder, options):
+    """由上传目录和处理参数（表单或JSON）生成任务数据，参数无效时抛出ValueError"""
+    output_format = options.get('output_format', DEFAULT_OUTPUT_FORMAT)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'不支持的输出格式: {output_format}')
+
+    task_data = {
+        'zip_path': os.path.join(upload_folder, 'files.zip'),
+        'upload_folder': upload_folder,
+        'white_area_threshold': int(options.get('white_area_threshold', 0)),
+        'black_area_threshold': int(options.get('black_area_threshold', 0)),
+        'output_format': output_format
+    }
+    # 可选保留连通区域表，之后可通过 /api/rethreshold 快速换阈值
+    if str(options.get('keep_components', '')).lower() in ('1', 'true', 'yes'):
+        task_data['components_folder'] = os.path.join(COMPONENTS_FOLDER, os.path.basename(upload_folder))
+    return task_data
+
+def enqueue_task(task_data):
+    """将任务添加到队列，返回任务ID"""
+    # 生成唯一任务ID
+    task_id = str(uuid.uuid4())
+    client_ip = get_client_ip()
+    
+    print(f"\n=== 新任务添加 ===")
+    print(f"任务ID: {task_id[:8]}...")
+    print(f"客户端IP: {client_ip}")
+    print(f"添加时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    
+    task_data['queued_at'] = time.time()
+    task_data['cost'] = estimate_task_cost(task_data['zip_path'])
+    task_registry.add(task_id, {
+        'data': task_data,
+        'created_at': task_data['queued_at'],
+        'client_ip': client_ip  # 保存客户端IP
+    })
+    return task_id
+
+def task_quota_required(f):
+    """当前IP排队和处理中的任务数达到 TASK_MAX_PENDING_PER_IP 时拒绝提交"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if TASK_MAX_PENDING_PER_IP and task_registry.pending_count(get_client_ip()) >= TASK_MAX_PENDING_PER_IP:
+            return jsonify({
+                'message': f'当前IP已有{TASK_MAX_PENDING_PER_IP}个任务在排队或处理中，请等待完成后再提交',
+                'status': 'error'
+            }), 429
+        return f(*args, **kwargs)
+
+    return decorated
 
 @app.route('/api/process', methods=['POST'])
+@ip_whitelist_required
+@task_quota_required
 def process_zip():
     try:
-        # 生成唯一任务ID
-        task_id = str(uuid.uuid4())
-        client_ip = get_client_ip()
-        
-        print(f"\n=== 新任务添加 ===")
-        print(f"任务ID: {task_id[:8]}...")
-        print(f"客户端IP: {client_ip}")
-        print(f"添加时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        unique_id = str(uuid.uuid4())
+        upload_folder = os.path.join(BASE_UPLOAD_FOLDER, unique_id)
+        try:
+            task_data = build_task_data(upload_folder, request.form)
+        except ValueError as e:
+            return jsonify({
+                'message': str(e),
+                'status': 'error'
+            }), 400
         
         # 保存上传文件并创建任务
         file = request.files['file']
-        unique_id = str(uuid.uuid4())
-        upload_folder = os.path.join(BASE_UPLOAD_FOLDER, unique_id)
         os.makedirs(upload_folder, exist_ok=True)
+        file.save(task_data['zip_path'])
         
-        zip_path = os.path.join(upload_folder, 'files.zip')
-        file.save(zip_path)
-        
-        # 创建任务数据
-        task_data = {
-            'zip_path': zip_path,
-            'upload_folder': upload_folder,
-            'white_area_threshold': int(request.form.get('white_area_threshold', 0)),
-            'black_area_threshold': int(request.form.get('black_area_threshold', 0))
-        }
-        
-        # 将任务添加到队列
-        task_status[task_id] = {
-            'status': TaskStatus.QUEUED,
-            'data': task_data,
-            'created_at': time.time(),
-            'client_ip': client_ip  # 保存客户端IP
-        }
-        task_queue.put(task_id)
+        task_id = enqueue_task(task_data)
         
         # 返回任务ID
         return jsonify({
@@ -502,99 +2060,391 @@ def process_zip():
             'status': 'error'
         }), 500
 
+# 分块上传的文件大小上限（字节）
+MAX_UPLOAD_SIZE = 20 * 1024 ** 3
+# 建议的分块大小和单个分块的大小上限（字节）
+UPLOAD_CHUNK_SIZE = 8 * 1024 ** 2
+UPLOAD_CHUNK_MAX = 64 * 1024 ** 2
+# 未完成的分块上传在最后一次写入后保留的时长（秒）
+UPLOAD_TTL = 24 * 3600
+# 每个IP同时进行的分块上传数上限，达到后返回429，0为不限
+UPLOAD_MAX_PER_IP = 5
+# 所有未完成的分块上传声明的总大小上限（字节），超出时返回413，应不超过上传目录所在磁盘的可用空间，0为不限
+UPLOAD_MAX_RESERVED_BYTES = 100 * 1024 ** 3
+
+# 分块上传ID -> 锁，同一上传的分块依次写入
+upload_locks = {}
+upload_locks_lock = threading.Lock()
+CHUNK_CRC32_PATTERN = re.compile(r'[0-9a-fA-F]{1,8}')
+# 新分块上传的额度检查和创建依次进行
+upload_reserve_lock = threading.Lock()
+
+def get_upload_lock(upload_id):
+    with upload_locks_lock:
+        return upload_locks.setdefault(upload_id, threading.Lock())
+
+@contextmanager
+def upload_lock(upload_folder, upload_id):
+    """锁定一个分块上传：进程内的线程锁加 files.zip 上的文件锁，多进程部署时同样依次写入
+
+    上传已被处理或清理时返回 False。
+    """
+    with get_upload_lock(upload_id):
+        try:
+            f = open(os.path.join(upload_folder, 'files.zip'), 'rb')
+        except OSError:
+            yield False
+            return
+        with f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield os.path.exists(os.path.join(upload_folder, 'upload.json'))
+
+@contextmanager
+def upload_reservation():
+    """检查额度和创建新上传期间持有：进程内的线程锁加上传目录中锁文件上的文件锁"""
+    with upload_reserve_lock:
+        with open(os.path.join(BASE_UPLOAD_FOLDER, '.reserve.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+def open_uploads():
+    """所有未完成的分块上传的信息"""
+    uploads = []
+    for name in os.listdir(BASE_UPLOAD_FOLDER):
+        try:
+            with open(os.path.join(BASE_UPLOAD_FOLDER, name, 'upload.json'), encoding='utf-8') as f:
+                uploads.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return uploads
+
+def load_upload(upload_id):
+    """返回 (上传目录, 上传信息)，上传不存在或已完成时返回 (None, None)"""
+    try:
+        upload_id = str(uuid.UUID(upload_id))
+    except ValueError:
+        return None, None
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, upload_id)
+    try:
+        with open(os.path.join(upload_folder, 'upload.json'), encoding='utf-8') as f:
+            return upload_folder, json.load(f)
+    except (OSError, ValueError):
+        return None, None
+
+def upload_not_found():
+    return jsonify({'message': '上传不存在或已完成', 'status': 'error'}), 404
+
+@app.route('/api/uploads', methods=['POST'])
+@ip_whitelist_required
+@task_quota_required
+def init_upload():
+    """开始分块上传，请求体: {"size": 文件字节数, "sha256": 可选，完成时校验}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        size = int(data['size'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'message': '请提供文件大小', 'status': 'error'}), 400
+    if size <= 0 or size > MAX_UPLOAD_SIZE:
+        return jsonify({
+            'message': f'文件大小超出限制（最大 {MAX_UPLOAD_SIZE} 字节）',
+            'status': 'error'
+        }), 413
+
+    client_ip = get_client_ip()
+    with upload_reservation():
+        uploads = open_uploads()
+        if UPLOAD_MAX_PER_IP and sum(upload.get('client_ip') == client_ip for upload in uploads) >= UPLOAD_MAX_PER_IP:
+            return jsonify({
+                'message': f'当前IP已有{UPLOAD_MAX_PER_IP}个未完成的上传，请完成后再开始新的上传',
+                'status': 'error'
+            }), 429
+        if UPLOAD_MAX_RESERVED_BYTES and sum(upload['size'] for upload in uploads) + size > UPLOAD_MAX_RESERVED_BYTES:
+            return jsonify({'message': '服务器上传空间不足，请稍后再试', 'status': 'error'}), 413
+
+        upload_id = str(uuid.uuid4())
+        upload_folder = os.path.join(BASE_UPLOAD_FOLDER, upload_id)
+        os.makedirs(upload_folder)
+        open(os.path.join(upload_folder, 'files.zip'), 'wb').close()
+        with open(os.path.join(upload_folder, 'upload.json'), 'w', encoding='utf-8') as f:
+            json.dump({'size': size, 'sha256': data.get('sha256'), 'client_ip': client_ip,
+                       'created_at': time.time()}, f)
+
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': 0,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'status': 'success'
+    })
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@ip_whitelist_required
+def get_upload(upload_id):
+    """查询已接收的字节数，断线后从该位置继续上传"""
+    upload_folder, upload = load_upload(upload_id)
+    if upload_folder is None:
+        return upload_not_found()
+    return jsonify({
+        'upload_id': upload_id,
+        'size': upload['size'],
+        'offset': os.path.getsize(os.path.join(upload_folder, 'files.zip')),
+        'status': 'success'
+    })
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@ip_whitelist_required
+def append_upload(upload_id):
+    """追加一个分块，请求体为分块原始内容
+
+    查询参数offset须等于已接收的字节数；可选请求头X-Chunk-CRC32（十六进制）校验分块，
+    校验失败时丢弃该分块。
+    """
+    upload_folder, upload = load_upload(upload_id)
+    if upload_folder is None:
+        return upload_not_found()
+    zip_path = os.path.join(upload_folder, 'files.zip')
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if length is None:
+        return jsonify({'message': '请提供Content-Length', 'status': 'error'}), 411
+    if length > UPLOAD_CHUNK_MAX or (offset or 0) + length > upload['size']:
+        return jsonify({'message': '分块大小超出限制', 'status': 'error'}), 413
+    expected_crc = request.headers.get('X-Chunk-CRC32')
+    if expected_crc and not CHUNK_CRC32_PATTERN.fullmatch(expected_crc):
+        return jsonify({'message': '无效的X-Chunk-CRC32', 'status': 'error'}), 400
+
+    with upload_lock(upload_folder, upload_id) as active:
+        if not active:
+            return upload_not_found()
+        current = os.path.getsize(zip_path)
+        if offset != current:
+            return jsonify({
+                'message': '分块位置与已接收的字节数不一致',
+                'offset': current,
+                'status': 'error'
+            }), 409
+
+        # 边接收边写入磁盘，内存占用与分块大小无关；连接中断时丢弃已写入的部分
+        crc = 0
+        written = 0
+        complete = False
+        try:
+            with open(zip_path, 'ab') as f:
+                while written < length:
+                    block = request.stream.read(min(1 << 20, length - written))
+                    if not block:
+                        break
+                    f.write(block)
+                    crc = zlib.crc32(block, crc)
+                    written += len(block)
+            complete = written == length and (not expected_crc or int(expected_crc, 16) == crc)
+        finally:
+            if not complete:
+                os.truncate(zip_path, offset)
+        if not complete:
+            return jsonify({
+                'message': '分块不完整或校验失败，请重新上传该分块',
+                'offset': offset,
+                'status': 'error'
+            }), 400
+
+    return jsonify({'offset': offset + written, 'status': 'success'})
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@ip_whitelist_required
+@task_quota_required
+def finalize_upload(upload_id):
+    """完成分块上传并创建处理任务，请求体为处理参数（同 /api/process 的表单字段），返回同 /api/process"""
+    upload_folder, upload = load_upload(upload_id)
+    if upload_folder is None:
+        return upload_not_found()
+    zip_path = os.path.join(upload_folder, 'files.zip')
+
+    try:
+        task_data = build_task_data(upload_folder, request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'message': str(e), 'status': 'error'}), 400
+
+    with upload_lock(upload_folder, upload_id) as active:
+        if not active:
+            return upload_not_found()
+        received = os.path.getsize(zip_path)
+        if received != upload['size']:
+            return jsonify({
+                'message': f'文件未上传完整（{received}/{upload["size"]} 字节）',
+                'offset': received,
+                'status': 'error'
+            }), 409
+
+        if upload.get('sha256'):
+            digest = hashlib.sha256()
+            with open(zip_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            if digest.hexdigest() != upload['sha256'].lower():
+                shutil.rmtree(upload_folder, ignore_errors=True)
+                return jsonify({'message': '文件校验失败，请重新上传', 'status': 'error'}), 400
+
+        # 删除上传信息后不能再追加，上传目录交给任务处理
+        os.remove(os.path.join(upload_folder, 'upload.json'))
+    with upload_locks_lock:
+        upload_locks.pop(upload_id, None)
+
+    task_id = enqueue_task(task_data)
+    return jsonify({
+        'task_id': task_id,
+        'status': 'success',
+        'message': '文件已上传，等待处理'
+    })
+
 @app.route('/api/task-status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
-    if task_id not in task_status:
+    task, queue_position = task_registry.get(task_id)
+    if task is None:
         return jsonify({
             'status': 'error',
             'message': '任务不存在'
         }), 404
-        
-    task = task_status[task_id]
-    queue_position = 0
-    
-    if task['status'] == TaskStatus.QUEUED:
-        # 计算队列位置：包括正在处理的任务和排在前面的等待任务
-        current_time = time.time()
-        
-        # 如果有正在处理的任务，队列位置+1
-        if current_task_id is not None:
-            queue_position += 1
-            
-        # 计算排在前面的等待任务
-        for t_id, t_info in task_status.items():
-            if (t_info['status'] == TaskStatus.QUEUED and 
-                t_info['created_at'] < task['created_at']):
-                queue_position += 1
     
+    return jsonify(task_status_response(task, queue_position, request.args.get('timings') in ('1', 'true')))
+
+def task_status_response(task, queue_position, include_timings=False):
+    """include_timings为True时结果中包含各阶段耗时"""
     response = {
         'status': task['status'],
         'queue_position': queue_position
     }
     
-    if task['status'] == TaskStatus.COMPLETED and 'result' in task:
+    if task['status'] == TaskStatus.PROCESSING and 'progress' in task:
+        response['progress'] = task['progress']
+    elif task['status'] == TaskStatus.COMPLETED and 'result' in task:
         response['result'] = task['result']
+        if not include_timings:
+            response['result'] = {k: v for k, v in task['result'].items() if k != 'timings'}
     elif task['status'] == TaskStatus.FAILED and 'error' in task:
         response['error'] = task['error']
+    # 按估算成本和当前处理速度推算的剩余时间
+    if 'eta_seconds' in task:
+        response['eta_seconds'] = round(task['eta_seconds'], 1)
     
-    return jsonify(response)
+    return response
+
+# 任务事件流无变化时发送心跳的间隔（秒），防止代理断开空闲连接
+TASK_EVENTS_KEEPALIVE = 15
+
+@app.route('/api/task-events/<task_id>', methods=['GET'])
+def task_events(task_id):
+    """以Server-Sent Events推送任务状态，内容同 /api/task-status，任务结束后关闭"""
+    if task_registry.get(task_id)[0] is None:
+        return jsonify({
+            'status': 'error',
+            'message': '任务不存在'
+        }), 404
+
+    include_timings = request.args.get('timings') in ('1', 'true')
 
-def process_task(task_data):
-    """处理单个任务的函数"""
+    def generate():
+        last_state = None
+        while True:
+            task, queue_position = task_registry.wait(task_id, last_state, TASK_EVENTS_KEEPALIVE)
+            if task is None:
+                yield f"event: error\ndata: {json.dumps({'status': 'error', 'message': '任务不存在'}, ensure_ascii=False)}\n\n"
+                return
+            state = task_state(task, queue_position)
+            if state == last_state:
+                yield ": keepalive\n\n"
+                continue
+            last_state = state
+            yield f"data: {json.dumps(task_status_response(task, queue_position, include_timings), ensure_ascii=False)}\n\n"
+            if task['status'] in (TaskStatus.COMPLETED, TaskStatus.FAILED):
+                return
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # 关闭nginx缓冲，事件立即送达
+    })
+
+def process_task(task_data, progress=None):
+    """处理单个任务的函数，progress(已处理文件数, 文件总数) 在每个文件处理后调用"""
     try:
         zip_path = task_data['zip_path']
         upload_folder = task_data['upload_folder']
         white_area_threshold = task_data['white_area_threshold']
         black_area_threshold = task_data['black_area_threshold']
+        output_format = task_data.get('output_format', DEFAULT_OUTPUT_FORMAT)
+        components_folder = task_data.get('components_folder')
         
-        # 创建处理结果目录
         unique_id = os.path.basename(upload_folder)
-        processed_folder = os.path.join(BASE_PROCESSED_FOLDER, unique_id)
-        os.makedirs(processed_folder, exist_ok=True)
+        if components_folder:
+            os.makedirs(components_folder, exist_ok=True)
         
-        # 解压ZIP文件
+        # 按ZIP目录筛选文件，处理时直接从ZIP中读取，不解压到磁盘
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(upload_folder)
+            members = [info.filename for info in zip_ref.infolist() if not info.is_dir()]
             
-        total_files = -1  # 初始化为-1，因为会包含ZIP文件本身
+        total_files = len(members)
         processed_files = []
         
-        # 处理所有符合条件的文件
-        for root, _, files in os.walk(upload_folder):
-            for file_name in files:
-                total_files += 1
-                if ((file_name.startswith('f_') and file_name.endswith('_p.tif')) or
-                    (file_name.startswith('f_') and file_name.endswith('_P.tif')) or
-                    (file_name.startswith('o_') and file_name.endswith('.tif'))):
-                    try:
-                        file_path = os.path.join(root, file_name)
-                        mask_1 = process_image(file_path, white_area_threshold, black_area_threshold)
-                        if mask_1 is not None:
-                            output_file_name = file_name.replace(".tif", "_m.tif")
-                            output_file_path = os.path.join(processed_folder, output_file_name)
-                            cv2.imwrite(output_file_path, mask_1)
-                            processed_files.append(output_file_name)
-                    except Exception as e:
-                        print(f"处理文件失败: {file_name}, 错误: {str(e)}")
-                        continue
+        # 收集所有符合条件的文件
+        file_names = []
+        jobs = []
+        for member_name in members:
+            file_name = posixpath.basename(member_name)
+            if is_target_file(file_name):
+                components_path = None
+                if components_folder:
+                    components_path = os.path.join(components_folder, f'{len(jobs)}.npz')
+                file_names.append(file_name)
+                jobs.append((zip_path, member_name, white_area_threshold, black_area_threshold,
+                             output_format, components_path))
+        
+        # 各阶段耗时为所有文件之和（并行处理时大于实际用时）
+        timings = {'stages': {}, 'pixels': 0, 'bytes_in': 0, 'bytes_out': 0}
         
-        # 创建结果ZIP文件
+        # 并行处理，结果按收集顺序直接写入结果ZIP
         zip_filename = f"{unique_id}_processed.zip"
         zip_filepath = os.path.join(BASE_PROCESSED_FOLDER, zip_filename)
-        with zipfile.ZipFile(zip_filepath, 'w') as zipf:
-            for file_name in processed_files:
-                file_path = os.path.join(processed_folder, file_name)
-                zipf.write(file_path, arcname=file_name)
+        if progress:
+            progress(0, len(jobs))
+        with zipfile.ZipFile(zip_filepath, 'w', compression=RESULT_ZIP_COMPRESSION,
+                             compresslevel=RESULT_ZIP_COMPRESSLEVEL) as zipf:
+            for done, (file_name, (result, error)) in enumerate(
+                    zip(file_names, run_file_jobs(process_zip_member, jobs)), 1):
+                if progress:
+                    progress(done, len(jobs))
+                if error is not None:
+                    print(f"处理文件失败: {file_name}, 错误: {str(error)}")
+                    record_file_metrics(None, 'failed', timings)
+                    continue
+                data, cache_hit, stats = result
+                record_cache_result(cache_hit)
+                if data is not None:
+                    start = time.perf_counter()
+                    output_file_name = output_file_name_for(file_name, output_format)
+                    zipf.writestr(output_file_name, data)
+                    processed_files.append(output_file_name)
+                    stats['stages']['zip_write'] = time.perf_counter() - start
+                record_file_metrics(stats, 'cached' if cache_hit else 'processed' if data is not None else 'failed',
+                                    timings)
+        
+        if components_folder:
+            # 记录保存了连通区域表的文件，分块处理的大图没有
+            index = [[file_name, os.path.basename(args[-1])] for file_name, args in zip(file_names, jobs)
+                     if os.path.exists(args[-1])]
+            with open(os.path.join(components_folder, 'index.json'), 'w', encoding='utf-8') as f:
+                json.dump({'output_format': output_format, 'files': index}, f, ensure_ascii=False)
                 
         # 清理临时文件
         shutil.rmtree(upload_folder)
-        shutil.rmtree(processed_folder)
         
+        timings['stages'] = {stage: round(seconds, 4) for stage, seconds in timings['stages'].items()}
         return {
             'message': f'件处理完成,上传{total_files}个文件,处理{len(processed_files)}个文件',
             'zip_file': zip_filename,
             'total_files': total_files,
-            'processed_files_count': len(processed_files)
+            'processed_files_count': len(processed_files),
+            'timings': timings
         }
         
     except Exception as e:
@@ -602,42 +2452,131 @@ def process_task(task_data):
         # 确保清理临时文件
         if 'upload_folder' in locals():
             shutil.rmtree(upload_folder, ignore_errors=True)
-        if 'processed_folder' in locals():
-            shutil.rmtree(processed_folder, ignore_errors=True)
+        if 'zip_filepath' in locals() and os.path.exists(zip_filepath):
+            os.remove(zip_filepath)
+        if task_data.get('components_folder'):
+            shutil.rmtree(task_data['components_folder'], ignore_errors=True)
         raise
 
+@app.route('/api/rethreshold/<task_id>', methods=['POST'])
+@ip_whitelist_required
+def rethreshold(task_id):
+    """用保存的连通区域表按新阈值重新处理，跳过拉伸、滤波和连通域标记
+
+    请求体: {"white_area_threshold", "black_area_threshold", "return": "counts" | "zip"}
+    """
+    task, _ = task_registry.get(task_id)
+    components_folder = task and task['data'].get('components_folder')
+    index_path = components_folder and os.path.join(components_folder, 'index.json')
+    if not index_path or task['status'] != TaskStatus.COMPLETED or not os.path.exists(index_path):
+        return jsonify({
+            'message': '任务不存在、未完成或未保留连通区域表',
+            'status': 'error'
+        }), 404
+
+    try:
+        data = request.get_json(silent=True) or {}
+        white_area_threshold = int(data.get('white_area_threshold', 0))
+        black_area_threshold = int(data.get('black_area_threshold', 0))
+        return_type = data.get('return', 'counts')
+        if return_type not in ('counts', 'zip'):
+            return jsonify({
+                'message': f'不支持的返回类型: {return_type}',
+                'status': 'error'
+            }), 400
+
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+        output_format = index['output_format'] if return_type == 'zip' else None
+        jobs = [(os.path.join(components_folder, npz_name), white_area_threshold, black_area_threshold,
+                 output_format) for _, npz_name in index['files']]
+
+        files = []
+        zip_filename = None
+        if return_type == 'zip':
+            # 每次请求使用唯一文件名，先写临时文件再改名，避免并发请求互相覆盖正在下载的结果
+            zip_filename = (f"{task_id}_{white_area_threshold}_{black_area_threshold}_"
+                            f"{uuid.uuid4().hex[:12]}_processed.zip")
+            zip_filepath = os.path.join(BASE_PROCESSED_FOLDER, zip_filename)
+            temp_filepath = zip_filepath + '.part'
+            with zipfile.ZipFile(temp_filepath, 'w', compression=RESULT_ZIP_COMPRESSION,
+                                 compresslevel=RESULT_ZIP_COMPRESSLEVEL) as zipf:
+                for (file_name, _), (result, error) in zip(index['files'], run_file_jobs(rethreshold_file, jobs)):
+                    if error is not None or result[0] is None:
+                        print(f"重新处理文件失败: {file_name}, 错误: {str(error)}")
+                        continue
+                    zipf.writestr(output_file_name_for(file_name, output_format), result[0])
+                    files.append(dict(result[1], file_name=file_name))
+            os.replace(temp_filepath, zip_filepath)
+        else:
+            # 只统计时计算量很小，直接在当前线程执行
+            for (file_name, _), args in zip(index['files'], jobs):
+                files.append(dict(rethreshold_file(*args)[1], file_name=file_name))
+
+        response = {
+            'status': 'success',
+            'white_area_threshold': white_area_threshold,
+            'black_area_threshold': black_area_threshold,
+            'files': files
+        }
+        if zip_filename:
+            response['zip_file'] = zip_filename
+        return jsonify(response)
+    except Exception as e:
+        print(f"重新处理错误: {str(e)}")
+        return jsonify({
+            'message': f'重新处理失败: {str(e)}',
+            'status': 'error'
+        }), 500
+
+# 结果下载交给前端服务器发送：None 由本服务发送；'x-accel' 返回 X-Accel-Redirect 由nginx发送；
+# 'x-sendfile' 返回 X-Sendfile 由 Apache(mod_xsendfile)/lighttpd 发送
+DOWNLOAD_OFFLOAD = None
+# X-Accel-Redirect 的路径前缀，需在nginx中配置为指向 processed 目录的 internal location
+DOWNLOAD_ACCEL_PREFIX = '/_processed/'
+
 @app.route('/api/download/<zip_filename>', methods=['GET'])
+@ip_whitelist_required
 def download_zip(zip_filename):
-    zip_filepath = os.path.join(BASE_PROCESSED_FOLDER, zip_filename)
-    if os.path.exists(zip_filepath):
-        return send_file(zip_filepath, as_attachment=True)
-    return jsonify({'message': '文件不存在', 'status': 'error'}), 404
+    zip_filepath = safe_join(os.path.abspath(BASE_PROCESSED_FOLDER), zip_filename)
+    if zip_filepath is None or not os.path.isfile(zip_filepath):
+        return jsonify({'message': '文件不存在', 'status': 'error'}), 404
+
+    if DOWNLOAD_OFFLOAD in ('x-accel', 'x-sendfile'):
+        response = Response(mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
+        if DOWNLOAD_OFFLOAD == 'x-accel':
+            response.headers['X-Accel-Redirect'] = DOWNLOAD_ACCEL_PREFIX + zip_filename
+        else:
+            response.headers['X-Sendfile'] = zip_filepath
+        return response
+
+    # 支持 Range/If-Range（206，断点续传和分段下载）和 ETag/If-None-Match（304）；
+    # 服务器提供 wsgi.file_wrapper 时（如gunicorn）由内核sendfile发送文件
+    response = send_file(zip_filepath, as_attachment=True, conditional=True, etag=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
 
 # 删除IP
 @app.route('/api/ips/<int:ip_id>', methods=['DELETE'])
 @token_required
 def delete_ip(ip_id):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 先检查IP是否存在
-        cursor.execute('SELECT * FROM allowed_ips WHERE id = %s', (ip_id,))
-        ip = cursor.fetchone()
-        
-        if not ip:
-            cursor.close()
-            conn.close()
-            return jsonify({
-                'message': 'IP不存在',
-                'status': 'error'
-            }), 404
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            # 先检查IP是否存在
+            cursor.execute('SELECT * FROM allowed_ips WHERE id = %s', (ip_id,))
+            ip = cursor.fetchone()
             
-        # 删除IP
-        cursor.execute('DELETE FROM allowed_ips WHERE id = %s', (ip_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+            if not ip:
+                return jsonify({
+                    'message': 'IP不存在',
+                    'status': 'error'
+                }), 404
+                
+            # 删除IP
+            cursor.execute('DELETE FROM allowed_ips WHERE id = %s', (ip_id,))
+            conn.commit()
+        invalidate_ip_whitelist()
         
         return jsonify({
             'message': 'IP删除成功',
@@ -662,32 +2601,24 @@ def change_password():
             }), 400
 
         # 从token中获取用户名
-        token = request.headers.get('Authorization').split(' ')[1]
-        user_data = decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        username = user_data['user']
+        username = g.token_claims['user']
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 验证旧密码
-        cursor.execute('SELECT * FROM admin_users WHERE username = %s AND password = %s', 
-                      (username, data.get('oldPassword')))
-        user = cursor.fetchone()
-        
-        if not user:
-            cursor.close()
-            conn.close()
-            return jsonify({
-                'message': '旧密码错误',
-                'status': 'error'
-            }), 400
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            # 验证旧密码
+            cursor.execute('SELECT * FROM admin_users WHERE username = %s AND password = %s', 
+                          (username, data.get('oldPassword')))
+            user = cursor.fetchone()
+            
+            if not user:
+                return jsonify({
+                    'message': '旧密码错误',
+                    'status': 'error'
+                }), 400
 
-        # 更新密码
-        cursor.execute('UPDATE admin_users SET password = %s WHERE username = %s',
-                      (data.get('newPassword'), username))
-        conn.commit()
-        cursor.close()
-        conn.close()
+            # 更新密码
+            cursor.execute('UPDATE admin_users SET password = %s WHERE username = %s',
+                          (data.get('newPassword'), username))
+            conn.commit()
         
         return jsonify({
             'message': '密码修改成功',
@@ -704,16 +2635,38 @@ def change_password():
 def cleanup_old_tasks():
     """清理已完成的旧任务"""
     current_time = time.time()
-    expired_tasks = []
-    
-    for task_id, task in task_status.items():
-        # 清理超过30分钟的已完成或失败任务
-        if (task['status'] in [TaskStatus.COMPLETED, TaskStatus.FAILED] and 
-            current_time - task['created_at'] > 1800):  # 30分钟
-            expired_tasks.append(task_id)
-            
-    for task_id in expired_tasks:
-        del task_status[task_id]
+    # 清理创建超过30分钟的已完成或失败任务
+    task_registry.expire(TASK_TTL)
+
+    # 清理过期的未完成分块上传
+    for name in os.listdir(BASE_UPLOAD_FOLDER):
+        upload_folder = os.path.join(BASE_UPLOAD_FOLDER, name)
+        try:
+            if (os.path.exists(os.path.join(upload_folder, 'upload.json')) and
+                    current_time - os.path.getmtime(os.path.join(upload_folder, 'files.zip')) > UPLOAD_TTL):
+                shutil.rmtree(upload_folder, ignore_errors=True)
+                with upload_locks_lock:
+                    upload_locks.pop(name, None)
+        except OSError:
+            pass
+
+    # 清理过期的重新设置阈值结果
+    for name in os.listdir(BASE_PROCESSED_FOLDER):
+        path = os.path.join(BASE_PROCESSED_FOLDER, name)
+        try:
+            if RETHRESHOLD_ZIP_PATTERN.fullmatch(name) and current_time - os.path.getmtime(path) > RETHRESHOLD_ZIP_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+    # 清理过期的连通区域表
+    for name in os.listdir(COMPONENTS_FOLDER):
+        path = os.path.join(COMPONENTS_FOLDER, name)
+        try:
+            if current_time - os.path.getmtime(path) > COMPONENTS_TTL:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
 
 # 启动定期清理线程
 def start_cleanup_thread():
@@ -721,7 +2674,32 @@ def start_cleanup_thread():
         cleanup_old_tasks()
         time.sleep(300)  # 每5分钟清理一次
 
-threading.Thread(target=start_cleanup_thread, daemon=True).start()
+def start_workers():
+    """创建任务存储，启动队列处理线程和定期清理线程；重复调用时不做任何事"""
+    global task_registry, workers_started
+    with workers_lock:
+        if workers_started:
+            return
+        if task_registry is None:
+            task_registry = create_task_store()
+        for _ in range(TASK_WORKERS):
+            threading.Thread(target=process_queue, daemon=True).start()
+        threading.Thread(target=start_cleanup_thread, daemon=True).start()
+        workers_started = True
+
+@app.before_request
+def ensure_workers():
+    # 未经 create_app 启动时（如 flask run）在第一个请求到达的进程中启动
+    if not workers_started:
+        start_workers()
+
+def create_app():
+    """WSGI服务器的入口（如 gunicorn 'app:create_app()'），在每个服务进程中启动任务处理"""
+    start_workers()
+    return app
 
 if __name__ == '__main__':
+    # 调试模式下自动重载的父进程只负责监视文件，任务处理只在提供服务的子进程中启动
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_workers()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
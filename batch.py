@@ -0,0 +1,316 @@
+"""命令行批处理：对本地目录或ZIP中的TIF运行与Web服务相同的处理流程
+
+不导入Flask，也不需要MySQL配置，适合对归档数据定期重新处理。
+
+用法:
+    python batch.py 输入目录或ZIP... -o 输出目录或输出.zip [--white-area-threshold 10] [--black-area-threshold 10]
+                    [--output-format tif] [--workers N] [--force]
+
+每个输入的结果放在以输入名（目录名或ZIP文件名去掉后缀）命名的子目录下，保留原有的相对路径，
+输入名相同时（如 a/x 和 b/x.zip）按输入顺序依次加上 _2、_3 后缀；文件名规则与Web服务相同
+（xxx.tif -> xxx_m.tif）。已处理的文件记录在清单中（输出目录下的
+.batch_manifest.json，或输出ZIP旁的 .manifest.json），再次运行时跳过输入和参数都未变化的文件：
+目录中的文件先比较大小和修改时间，修改时间变化时再比较SHA-256；ZIP中的文件比较大小和CRC32。
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from image_processing import (DEFAULT_OUTPUT_FORMAT, MAJORITY_WINDOW_SIZE, OUTPUT_FORMATS, PIPELINE_VERSION,
+                              encode_mask, is_target_file, output_file_name_for, process_image)
+
+MANIFEST_VERSION = 1
+# 输出为目录时保存清单的间隔（秒），中断后已完成的文件不必重新处理
+MANIFEST_SAVE_INTERVAL = 30
+
+def safe_member_path(name):
+    """ZIP成员名转为安全的相对路径，绝对路径、含盘符或 .. 的成员返回None"""
+    name = name.replace('\\', '/')
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if name.startswith('/') or not parts or '..' in parts or ':' in parts[0]:
+        return None
+    return '/'.join(parts)
+
+def unique_label(label, used):
+    """输入名已被之前的输入使用时依次加上 _2、_3 后缀"""
+    candidate, n = label, 1
+    while candidate in used:
+        n += 1
+        candidate = f'{label}_{n}'
+    used.add(candidate)
+    return candidate
+
+def find_sources(inputs):
+    """遍历输入目录和ZIP，返回 (键, 源, 清单中用于比较的属性) 列表
+
+    键为 输入名/相对路径；源为 (文件路径, None) 或 (ZIP路径, 成员名)。重复给出的输入只处理一次，
+    ZIP中路径相同的成员与解压时一样只保留最后一个。
+    """
+    sources = []
+    seen_inputs = set()
+    labels = set()
+    for input_path in inputs:
+        input_path = os.path.abspath(input_path)
+        if input_path in seen_inputs:
+            continue
+        seen_inputs.add(input_path)
+        if os.path.isdir(input_path):
+            label = unique_label(os.path.basename(input_path.rstrip(os.sep)), labels)
+            for root, dirs, files in os.walk(input_path):
+                dirs.sort()
+                for file_name in sorted(files):
+                    if not is_target_file(file_name):
+                        continue
+                    path = os.path.join(root, file_name)
+                    stat = os.stat(path)
+                    rel_path = os.path.relpath(path, input_path).replace(os.sep, '/')
+                    sources.append((f'{label}/{rel_path}', (path, None),
+                                    {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}))
+        elif zipfile.is_zipfile(input_path):
+            label = unique_label(os.path.splitext(os.path.basename(input_path))[0], labels)
+            members = {}
+            with zipfile.ZipFile(input_path) as zip_ref:
+                for info in zip_ref.infolist():
+                    if info.is_dir() or not is_target_file(info.filename.rsplit('/', 1)[-1]):
+                        continue
+                    rel_path = safe_member_path(info.filename)
+                    if rel_path is None:
+                        print(f"跳过路径不安全的ZIP成员: {input_path}: {info.filename}")
+                        continue
+                    if rel_path in members:
+                        print(f"跳过重复的ZIP成员: {input_path}: {members[rel_path].filename}")
+                    members[rel_path] = info
+            for rel_path, info in members.items():
+                sources.append((f'{label}/{rel_path}', (input_path, info.filename),
+                                {'size': info.file_size, 'crc': info.CRC}))
+        else:
+            raise ValueError(f'输入不是目录或ZIP文件: {input_path}')
+    return sources
+
+def process_source(source, white_area_threshold, black_area_threshold, output_format, output_path=None,
+                   expected_sha256=None):
+    """在工作进程中处理单个文件
+
+    output_path不为None时直接写入该文件，否则返回编码后的结果。输入内容的SHA-256与expected_sha256
+    相同时不处理，返回的 'unchanged' 为True。
+    """
+    path, member_name = source
+    if member_name is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    else:
+        with zipfile.ZipFile(path) as zip_ref:
+            data = zip_ref.read(member_name)
+    sha256 = hashlib.sha256(data).hexdigest()
+    result = {'sha256': sha256, 'bytes_in': len(data), 'pixels': 0, 'data': None, 'unchanged': False}
+    if sha256 == expected_sha256:
+        result['unchanged'] = True
+        return result
+
+    mask = process_image(data, white_area_threshold, black_area_threshold)
+    if mask is None:
+        raise ValueError('无法读取或处理图像')
+    encoded = encode_mask(mask, output_format)
+    if encoded is None:
+        raise ValueError('结果编码失败')
+    result['pixels'] = mask.size
+    if output_path is None:
+        result['data'] = encoded
+    else:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        temp_path = f'{output_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(temp_path, output_path)
+    return result
+
+def run_jobs(jobs, workers):
+    """并行执行 process_source，按完成顺序逐个返回 (任务, 结果, 异常)"""
+    if workers <= 1:
+        for job in jobs:
+            try:
+                yield job, process_source(*job['args']), None
+            except Exception as e:
+                yield job, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # 限制已提交未完成的任务数，结果写出后再提交新任务
+        jobs = iter(jobs)
+        pending = {}
+        while True:
+            while len(pending) < workers * 2:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending[pool.submit(process_source, *job['args'])] = job
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                try:
+                    yield job, future.result(), None
+                except Exception as e:
+                    yield job, None, e
+
+def load_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('files', {})
+
+def save_manifest(path, files):
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+def run_batch(inputs, output, white_area_threshold=0, black_area_threshold=0,
+              output_format=DEFAULT_OUTPUT_FORMAT, workers=None, force=False):
+    """批量处理，输出路径以 .zip 结尾时写入ZIP，否则写入目录；返回统计"""
+    workers = workers or os.cpu_count() or 1
+    to_archive = output.lower().endswith('.zip')
+    manifest_path = f'{os.path.splitext(output)[0]}.manifest.json' if to_archive \
+        else os.path.join(output, '.batch_manifest.json')
+    params = f'{PIPELINE_VERSION}|{MAJORITY_WINDOW_SIZE}|{white_area_threshold}|{black_area_threshold}|{output_format}'
+
+    previous = {} if force else load_manifest(manifest_path)
+    old_archive = None
+    if to_archive and os.path.exists(output) and previous:
+        old_archive = zipfile.ZipFile(output)
+    old_names = set(old_archive.namelist()) if old_archive else set()
+
+    start = time.perf_counter()
+    sources = find_sources(inputs)
+    stats = {'total': len(sources), 'processed': 0, 'skipped': 0, 'failed': 0, 'bytes_in': 0, 'pixels': 0}
+    files = {}
+    jobs = []
+    skipped = []
+    output_names = set()
+    for key, source, attributes in sources:
+        output_name = output_file_name_for(key, output_format)
+        if output_name in output_names:
+            raise ValueError(f'多个输入文件的结果文件名相同: {output_name}')
+        output_names.add(output_name)
+        output_path = None if to_archive else os.path.join(output, *output_name.split('/'))
+        if output_path is not None and os.path.commonpath(
+                [os.path.abspath(output), os.path.abspath(output_path)]) != os.path.abspath(output):
+            raise ValueError(f'输出路径不在输出目录内: {output_name}')
+        entry = previous.get(key)
+        exists = output_name in old_names if to_archive else os.path.exists(output_path)
+        expected_sha256 = None
+        if entry and entry.get('params') == params and exists:
+            same_size = entry.get('size') == attributes['size']
+            if same_size and all(entry.get(name) == value for name, value in attributes.items()):
+                skipped.append((key, output_name))
+                files[key] = entry
+                continue
+            if same_size and 'mtime_ns' in attributes:
+                # 只有修改时间变化时比较内容，内容相同则不重新处理
+                expected_sha256 = entry.get('sha256')
+        jobs.append({'key': key, 'output_name': output_name, 'attributes': attributes,
+                     'args': (source, white_area_threshold, black_area_threshold, output_format, output_path,
+                              expected_sha256)})
+
+    archive = None
+    if to_archive:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        archive = zipfile.ZipFile(f'{output}.tmp', 'w')
+    if not to_archive:
+        os.makedirs(output, exist_ok=True)
+
+    try:
+        # 跳过的文件从原输出ZIP复制到新ZIP
+        for key, output_name in skipped:
+            if archive is not None:
+                archive.writestr(old_archive.getinfo(output_name), old_archive.read(output_name))
+            stats['skipped'] += 1
+
+        saved_at = time.monotonic()
+        for job, result, error in run_jobs(jobs, workers):
+            key = job['key']
+            if error is not None:
+                print(f"处理文件失败: {key}, 错误: {str(error)}")
+                stats['failed'] += 1
+                continue
+            if result['unchanged']:
+                stats['skipped'] += 1
+                if archive is not None:
+                    archive.writestr(old_archive.getinfo(job['output_name']), old_archive.read(job['output_name']))
+            else:
+                if archive is not None:
+                    archive.writestr(job['output_name'], result['data'])
+                stats['processed'] += 1
+                stats['bytes_in'] += result['bytes_in']
+                stats['pixels'] += result['pixels']
+            files[key] = dict(job['attributes'], sha256=result['sha256'], params=params)
+
+            done = stats['processed'] + stats['skipped'] + stats['failed']
+            if not to_archive and time.monotonic() - saved_at > MANIFEST_SAVE_INTERVAL:
+                save_manifest(manifest_path, files)
+                saved_at = time.monotonic()
+                print(f"已完成 {done}/{stats['total']} 个文件")
+
+        if archive is not None:
+            archive.close()
+            archive = None
+            if old_archive is not None:
+                old_archive.close()
+                old_archive = None
+            os.replace(f'{output}.tmp', output)
+        save_manifest(manifest_path, files)
+    finally:
+        if archive is not None:
+            # 中断时丢弃未完成的ZIP，原输出ZIP和清单保持不变
+            archive.close()
+            os.remove(f'{output}.tmp')
+        elif not to_archive and files:
+            save_manifest(manifest_path, files)
+        if old_archive is not None:
+            old_archive.close()
+
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+def print_summary(stats):
+    seconds = max(stats['seconds'], 1e-9)
+    print("\n=== 批处理完成 ===")
+    print(f"文件: 共{stats['total']}个, 处理{stats['processed']}个, 跳过{stats['skipped']}个, 失败{stats['failed']}个")
+    print(f"输入: {stats['bytes_in'] / 1024 ** 2:.1f} MB, {stats['pixels'] / 1e6:.1f} 百万像素")
+    print(f"用时: {stats['seconds']:.2f} 秒")
+    print(f"吞吐量: {stats['processed'] / seconds:.2f} 文件/秒, {stats['pixels'] / 1e6 / seconds:.2f} 百万像素/秒, "
+          f"{stats['bytes_in'] / 1024 ** 2 / seconds:.2f} MB/秒")
+
+def main():
+    parser = argparse.ArgumentParser(description='对本地目录或ZIP中的TIF批量去除孤立点')
+    parser.add_argument('inputs', nargs='+', help='输入目录或ZIP文件')
+    parser.add_argument('-o', '--output', required=True, help='输出目录，以 .zip 结尾时输出为ZIP文件')
+    parser.add_argument('--white-area-threshold', type=int, default=0, help='白色孤立点面积阈值，默认0（不处理）')
+    parser.add_argument('--black-area-threshold', type=int, default=0, help='黑色孤立点面积阈值，默认0（不处理）')
+    parser.add_argument('--output-format', choices=list(OUTPUT_FORMATS), default=DEFAULT_OUTPUT_FORMAT,
+                        help=f'结果格式，默认 {DEFAULT_OUTPUT_FORMAT}')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='处理进程数，默认为CPU核数')
+    parser.add_argument('--force', action='store_true', help='忽略清单，重新处理所有文件')
+    args = parser.parse_args()
+
+    try:
+        stats = run_batch(args.inputs, args.output, args.white_area_threshold, args.black_area_threshold,
+                          args.output_format, args.workers, args.force)
+    except ValueError as e:
+        parser.error(str(e))
+    print_summary(stats)
+    if stats['failed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
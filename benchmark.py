@@ -0,0 +1,434 @@
+"""图像处理流水线基准测试
+
+用法: python benchmark.py [--suite algorithms stages e2e] [--quick] [--json 结果.json] [--compare 旧结果.json]
+
+stages 和 e2e 使用合成的红外图像，结果可用 --json 保存，--compare 与之前保存的结果逐项对比。
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import cv2
+import jwt
+import numpy as np
+from scipy.signal import convolve2d
+
+import app as backend
+from image_processing import (OUTPUT_FORMATS, apply_component_thresholds, binarize, build_component_tables,
+                              detect_isolated_points, encode_mask, is_target_file, linear_bounds, linear_show,
+                              majority_filter, process_image, smooth_image)
+
+def detect_isolated_points_loop(image, area_threshold, detect_black=False):
+    """旧版逐标签循环实现，仅用于对比"""
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(image, connectivity=8)
+    error_flag = 0
+    mask = np.zeros_like(image)
+
+    for i in range(1, num_labels):
+        connected_area = stats[i, -1]
+        if connected_area <= area_threshold:
+            error_flag = 1
+            mask[labels == i] = 255
+
+    return mask, error_flag
+
+def majority_filter_convolve(mask, window_size=5):
+    """旧版convolve2d实现，仅用于对比"""
+    counts = convolve2d(mask > 0, np.ones((window_size, window_size), dtype=np.uint8), mode='same')
+    return ((counts > (window_size * window_size / 2)) * 255).astype(np.uint8)
+
+def binarize_linear_show(image, contrast_factor=0.03, level=33):
+    """旧版 linear_show + 阈值实现，仅用于对比"""
+    mask = linear_show(image, contrast_factor).astype(np.uint8)
+    return (mask < level).astype(np.uint8) * 255
+
+def linear_bounds_percentile(image, contrast_factor=0.03):
+    """旧版两次 np.percentile 实现，仅用于对比"""
+    return (np.percentile(image, contrast_factor * 100),
+            np.percentile(image, 100 - contrast_factor * 100))
+
+def make_infrared_image(size, dtype=np.uint16, noise_density=0.001, components=50, seed=0):
+    """生成近似红外遥感图像的合成图像
+
+    平滑的温度背景上叠加 components 个冷/热斑块，再按 noise_density 加入椒盐噪声（孤立点）。
+    dtype 决定位深：uint8、uint16 或 float32（温度值）。
+    """
+    rng = np.random.default_rng(seed)
+    height, width = (size, size) if np.isscalar(size) else size
+    # 低分辨率随机场放大得到大尺度的温度起伏
+    background = cv2.resize(rng.random((8, 8)), (width, height), interpolation=cv2.INTER_CUBIC)
+    image = 0.5 + 0.15 * background + 0.02 * rng.standard_normal((height, width))
+    yy, xx = np.ogrid[:height, :width]
+    for _ in range(components):
+        cy, cx = rng.integers(0, height), rng.integers(0, width)
+        radius = rng.uniform(2, max(3, min(height, width) / 40))
+        box = (slice(max(0, int(cy - 3 * radius)), int(cy + 3 * radius) + 1),
+               slice(max(0, int(cx - 3 * radius)), int(cx + 3 * radius) + 1))
+        image[box] += rng.choice((-0.3, 0.3)) * np.exp(
+            -((yy[box[0]] - cy) ** 2 + (xx[:, box[1]] - cx) ** 2) / (2 * radius ** 2))
+    noise = rng.random((height, width))
+    image[noise < noise_density / 2] = 0
+    image[noise > 1 - noise_density / 2] = 1
+    np.clip(image, 0, 1, out=image)
+
+    if dtype == np.float32:
+        # 200K-350K 的亮温
+        return (200 + 150 * image).astype(np.float32)
+    return (image * np.iinfo(dtype).max).astype(dtype)
+
+def make_tif_zip(images, prefix='f_bench'):
+    """将图像编码为TIF并打包，返回ZIP内容(bytes)，文件名（f_*_p.tif）符合is_target_file，会被/api/process处理"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for i, image in enumerate(images):
+            ok, encoded = cv2.imencode('.tif', image)
+            assert ok
+            name = f'{prefix}_{i}_p.tif'
+            assert is_target_file(name), name
+            zipf.writestr(name, encoded.tobytes())
+    return buffer.getvalue()
+
+def make_speckle_mask(size, density, seed=0):
+    """生成带随机斑点的二值掩码，density越大连通区域越多"""
+    rng = np.random.default_rng(seed)
+    return ((rng.random((size, size)) < density) * 255).astype(np.uint8)
+
+def peak_memory(func, *args):
+    """返回函数执行期间的峰值内存（MB）"""
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+def timeit(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def measure(func, *args, repeat=5):
+    """返回 {'min': 最短耗时, 'median': 耗时中位数}（秒）"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': float(np.median(times))}
+
+# 机器可读的结果，每项为 {'benchmark': 名称, 'params': 参数, 'metrics': 指标}
+results = []
+
+def record(benchmark, params, **metrics):
+    results.append({'benchmark': benchmark, 'params': params, 'metrics': metrics})
+
+def bench_detect_isolated_points(size=1024, threshold=10):
+    print(f"\n=== detect_isolated_points ({size}x{size}, 阈值={threshold}) ===")
+    print(f"{'连通区域数':>10} | {'循环(s)':>10} | {'查找表(s)':>10} | {'加速比':>8}")
+    for density in (0.0005, 0.002, 0.01, 0.05):
+        image = make_speckle_mask(size, density)
+        num_labels = cv2.connectedComponents(image, connectivity=8)[0] - 1
+
+        for detect_black, img in ((False, image), (True, 255 - image)):
+            expected = detect_isolated_points_loop(img, threshold, detect_black)
+            actual = detect_isolated_points(img, threshold, detect_black)
+            assert np.array_equal(expected[0], actual[0]) and expected[1] == actual[1]
+
+        t_loop = timeit(detect_isolated_points_loop, image, threshold, repeat=1)
+        t_lut = timeit(detect_isolated_points, image, threshold)
+        print(f"{num_labels:>10} | {t_loop:>10.4f} | {t_lut:>10.4f} | {t_loop / t_lut:>7.1f}x")
+
+def bench_majority_filter(window_sizes=(3, 5, 9)):
+    print("\n=== majority_filter ===")
+    print(f"{'尺寸':>10} | {'窗口':>4} | {'convolve2d(s)':>13} | {'boxFilter(s)':>12} | {'加速比':>8}")
+    for size in (512, 2048):
+        image = make_speckle_mask(size, 0.5)
+        for window_size in window_sizes:
+            expected = majority_filter_convolve(image, window_size)
+            assert np.array_equal(expected, majority_filter(image, window_size))
+
+            t_conv = timeit(majority_filter_convolve, image, window_size)
+            t_box = timeit(majority_filter, image, window_size)
+            print(f"{size:>10} | {window_size:>4} | {t_conv:>13.4f} | {t_box:>12.4f} | {t_conv / t_box:>7.1f}x")
+
+def bench_binarize(size=2048):
+    print(f"\n=== binarize ({size}x{size}) ===")
+    print(f"{'类型':>8} | {'旧版(s)':>8} | {'融合(s)':>8} | {'旧版峰值(MB)':>12} | {'融合峰值(MB)':>12}")
+    rng = np.random.default_rng(0)
+    images = {
+        'uint8': rng.integers(0, 256, (size, size), dtype=np.uint8),
+        'uint16': rng.integers(0, 65536, (size, size), dtype=np.uint16),
+        'float32': rng.random((size, size), dtype=np.float32) * 300,
+    }
+    for name, image in images.items():
+        assert np.array_equal(binarize_linear_show(image), binarize(image, 0.03, 33))
+        t_old = timeit(binarize_linear_show, image)
+        t_new = timeit(binarize, image, 0.03, 33)
+        m_old = peak_memory(binarize_linear_show, image)
+        m_new = peak_memory(binarize, image, 0.03, 33)
+        print(f"{name:>8} | {t_old:>8.4f} | {t_new:>8.4f} | {m_old:>12.1f} | {m_new:>12.1f}")
+
+def bench_linear_bounds(size=2048):
+    print(f"\n=== linear_bounds ({size}x{size}) ===")
+    print(f"{'类型':>8} | {'np.percentile(s)':>16} | {'直方图(s)':>10} | {'加速比':>8}")
+    rng = np.random.default_rng(0)
+    for dtype in (np.uint8, np.uint16, np.float32):
+        high = 65536 if dtype == np.uint16 else 256
+        image = rng.integers(0, high, (size, size)).astype(dtype)
+        assert linear_bounds_percentile(image) == linear_bounds(image, 0.03)
+        t_old = timeit(linear_bounds_percentile, image)
+        t_new = timeit(linear_bounds, image, 0.03)
+        print(f"{np.dtype(dtype).name:>8} | {t_old:>16.4f} | {t_new:>10.4f} | {t_old / t_new:>7.1f}x")
+
+def bench_output_formats(size=2048):
+    print(f"\n=== 输出格式 ({size}x{size}) ===")
+    print(f"{'格式':>10} | {'大小(KB)':>10} | {'压缩比':>8} | {'编码(s)':>8}")
+    # 经多数滤波的斑点掩码，近似真实处理结果
+    mask = majority_filter(make_speckle_mask(size, 0.45))
+    for output_format in OUTPUT_FORMATS:
+        data = encode_mask(mask, output_format)
+        decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        assert np.array_equal(decoded, mask)
+        t_encode = timeit(encode_mask, mask, output_format)
+        print(f"{output_format:>10} | {len(data) / 1024:>10.1f} | {mask.nbytes / len(data):>7.1f}x | {t_encode:>8.4f}")
+
+def bench_rethreshold(size=2048):
+    print(f"\n=== 重新设置阈值 ({size}x{size}) ===")
+    print(f"{'白/黑阈值':>10} | {'完整处理(s)':>11} | {'连通区域表(s)':>13} | {'仅统计(s)':>10}")
+    rng = np.random.default_rng(0)
+    image = (cv2.blur(rng.random((size, size)), (3, 3)) * 4000).astype(np.uint16)
+    t_build = timeit(lambda: build_component_tables(smooth_image(image)), repeat=1)
+    tables = build_component_tables(smooth_image(image))
+    print(f"{'建表':>10} | {'':>11} | {t_build:>13.4f} | {'':>10}")
+    for thresholds in ((10, 10), (50, 200), (500, 0)):
+        assert np.array_equal(process_image(image, *thresholds), apply_component_thresholds(tables, *thresholds)[0])
+        t_full = timeit(process_image, image, *thresholds)
+        t_mask = timeit(apply_component_thresholds, tables, *thresholds)
+        t_counts = timeit(apply_component_thresholds, tables, *thresholds, False)
+        label = '/'.join(map(str, thresholds))
+        print(f"{label:>10} | {t_full:>11.4f} | {t_mask:>13.4f} | {t_counts:>10.4f}")
+
+def bench_token_required(requests_count=2000):
+    print(f"\n=== token_required ({requests_count} 次请求 /api/db-pool/status) ===")
+    print(f"{'':>8} | {'每次请求(us)':>12} | {'其中验证token(us)':>17}")
+    token = jwt.encode({'user': 'admin', 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                       backend.app.config['SECRET_KEY'], algorithm="HS256")
+    headers = {'Authorization': f'Bearer {token}'}
+    client = backend.app.test_client()
+    cache_size = backend.TOKEN_CACHE_SIZE
+    for name, size in (('不缓存', 0), ('缓存', cache_size)):
+        backend.TOKEN_CACHE_SIZE = size
+        backend.verified_tokens.clear()
+        assert client.get('/api/db-pool/status', headers=headers).status_code == 200
+
+        def requests_loop():
+            for _ in range(requests_count):
+                client.get('/api/db-pool/status', headers=headers)
+
+        def verify_loop():
+            for _ in range(requests_count):
+                backend.verify_token(token)
+
+        t_request = timeit(requests_loop) / requests_count * 1e6
+        t_verify = timeit(verify_loop) / requests_count * 1e6
+        print(f"{name:>8} | {t_request:>12.1f} | {t_verify:>17.2f}")
+    backend.TOKEN_CACHE_SIZE = cache_size
+
+STAGE_CASES = [
+    # (尺寸, 位深, 噪声密度, 斑块数)
+    (1024, np.uint8, 0.001, 50),
+    (1024, np.uint16, 0.001, 50),
+    (1024, np.float32, 0.001, 50),
+    (2048, np.uint16, 0.001, 50),
+    (2048, np.uint16, 0.02, 50),
+    (2048, np.uint16, 0.001, 2000),
+    (4096, np.uint16, 0.005, 500),
+]
+
+def bench_stages(cases=STAGE_CASES, repeat=5, white_area_threshold=10, black_area_threshold=10):
+    print("\n=== 各处理阶段（合成红外图像） ===")
+    print(f"{'尺寸':>6} | {'位深':>8} | {'噪声':>6} | {'斑块':>5} | {'linear_show(s)':>14} | {'拉伸二值化(s)':>13} "
+          f"| {'5x5滤波(s)':>10} | {'孤立点(s)':>9} | {'整图(s)':>8} | {'MP/s':>7}")
+    for size, dtype, noise_density, components in cases:
+        image = make_infrared_image(size, dtype, noise_density, components)
+        mask = binarize(image, 0.03, 33)
+        smoothed = majority_filter(mask)
+        timings = {
+            'linear_show': measure(linear_show, image, 0.03, repeat=repeat),
+            'binarize': measure(binarize, image, 0.03, 33, repeat=repeat),
+            'majority_filter': measure(majority_filter, smoothed, repeat=repeat),
+            'detect_isolated_points': measure(lambda: (detect_isolated_points(smoothed, white_area_threshold),
+                                                       detect_isolated_points(255 - smoothed, black_area_threshold,
+                                                                              True)), repeat=repeat),
+            'process_image': measure(process_image, image, white_area_threshold, black_area_threshold,
+                                     repeat=repeat),
+        }
+        megapixels_per_second = image.size / timings['process_image']['median'] / 1e6
+        record('stages', {'size': size, 'dtype': np.dtype(dtype).name, 'noise_density': noise_density,
+                          'components': components},
+               **{f'{stage}_seconds': t['median'] for stage, t in timings.items()},
+               megapixels_per_second=megapixels_per_second)
+        print(f"{size:>6} | {np.dtype(dtype).name:>8} | {noise_density:>6} | {components:>5} "
+              f"| {timings['linear_show']['median']:>14.4f} | {timings['binarize']['median']:>13.4f} "
+              f"| {timings['majority_filter']['median']:>10.4f} | {timings['detect_isolated_points']['median']:>9.4f} "
+              f"| {timings['process_image']['median']:>8.4f} | {megapixels_per_second:>7.1f}")
+
+E2E_CASES = [
+    # (每个ZIP的文件数, 图像尺寸, 任务数)
+    (4, 512, 8),
+    (16, 1024, 4),
+]
+
+def bench_end_to_end(cases=E2E_CASES, poll_interval=0.005, timeout=600):
+    """通过 Flask 测试客户端提交到 /api/process 并轮询 /api/task-status，统计延迟分位数和吞吐量
+
+    不连接数据库，也不使用服务的任务数据库和上传目录：跳过IP白名单检查，任务保存在进程内存中，
+    上传和结果写入临时目录；关闭结果缓存以免重复的输入命中缓存。
+    """
+    print("\n=== 端到端 /api/process ===")
+    print(f"{'文件数':>6} | {'尺寸':>6} | {'任务数':>6} | {'p50(s)':>8} | {'p90(s)':>8} | {'p99(s)':>8} "
+          f"| {'文件/s':>8} | {'MP/s':>7}")
+    client = backend.app.test_client()
+    folders = ('BASE_UPLOAD_FOLDER', 'BASE_PROCESSED_FOLDER', 'COMPONENTS_FOLDER')
+    saved = [backend.is_ip_allowed, backend.RESULT_CACHE_MAX_BYTES] + [getattr(backend, name) for name in folders]
+    temp_dir = tempfile.mkdtemp(prefix='bench_e2e_')
+    for name in folders:
+        setattr(backend, name, os.path.join(temp_dir, name.lower()))
+        os.makedirs(getattr(backend, name))
+    backend.is_ip_allowed = lambda ip: True
+    backend.RESULT_CACHE_MAX_BYTES = 0
+    # 队列处理线程在本进程中只启动一次，之后的调用沿用同一个内存任务存储
+    if backend.task_registry is None:
+        backend.task_registry = backend.TaskRegistry(backend.TASK_WORKERS)
+    backend.start_workers()
+    try:
+        for files, size, tasks in cases:
+            archives = [make_tif_zip([make_infrared_image(size, seed=task * files + i) for i in range(files)])
+                        for task in range(tasks)]
+            submitted = {}
+            latencies = []
+            # 任务添加和队列状态的输出不计入结果
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                for archive in archives:
+                    response = client.post('/api/process', data={
+                        'file': (io.BytesIO(archive), 'bench.zip'),
+                        'white_area_threshold': '10',
+                        'black_area_threshold': '10',
+                    }, content_type='multipart/form-data')
+                    assert response.status_code == 200, response.get_json()
+                    submitted[response.get_json()['task_id']] = time.perf_counter()
+                pending = dict(submitted)
+                while pending:
+                    if time.perf_counter() - start > timeout:
+                        raise TimeoutError(f'{len(pending)} 个任务未在 {timeout} 秒内完成')
+                    for task_id in list(pending):
+                        status = client.get(f'/api/task-status/{task_id}').get_json()
+                        if status['status'] == 'failed':
+                            raise RuntimeError(f"任务失败: {status.get('error')}")
+                        if status['status'] == 'completed':
+                            # 文件名不符合处理规则时任务不处理任何文件，测得的吞吐量没有意义
+                            assert status['result']['processed_files_count'] == files, status['result']
+                            latencies.append(time.perf_counter() - pending.pop(task_id))
+                            os.remove(os.path.join(backend.BASE_PROCESSED_FOLDER, status['result']['zip_file']))
+                    time.sleep(poll_interval)
+                elapsed = time.perf_counter() - start
+
+            p50, p90, p99 = np.percentile(latencies, (50, 90, 99))
+            files_per_second = files * tasks / elapsed
+            megapixels_per_second = files * tasks * size * size / elapsed / 1e6
+            record('e2e', {'files_per_zip': files, 'size': size, 'tasks': tasks,
+                           'task_workers': backend.TASK_WORKERS, 'file_workers': backend.FILE_PROCESS_WORKERS},
+                   latency_p50_seconds=p50, latency_p90_seconds=p90, latency_p99_seconds=p99,
+                   wall_seconds=elapsed, files_per_second=files_per_second,
+                   megapixels_per_second=megapixels_per_second)
+            print(f"{files:>6} | {size:>6} | {tasks:>6} | {p50:>8.3f} | {p90:>8.3f} | {p99:>8.3f} "
+                  f"| {files_per_second:>8.1f} | {megapixels_per_second:>7.1f}")
+    finally:
+        backend.is_ip_allowed, backend.RESULT_CACHE_MAX_BYTES = saved[:2]
+        for name, value in zip(folders, saved[2:]):
+            setattr(backend, name, value)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def compare_results(baseline, current, tolerance=0.1):
+    """逐项对比两次结果，耗时类指标变大、速度类指标变小超过tolerance时标记为退化，返回退化的项数"""
+    print(f"\n=== 与 {baseline['environment'].get('commit') or '基线'} 对比（容差 {tolerance:.0%}） ===")
+    previous = {(item['benchmark'], json.dumps(item['params'], sort_keys=True)): item['metrics']
+                for item in baseline['results']}
+    regressions = 0
+    for item in current:
+        old_metrics = previous.get((item['benchmark'], json.dumps(item['params'], sort_keys=True)))
+        if old_metrics is None:
+            continue
+        for name, value in item['metrics'].items():
+            old = old_metrics.get(name)
+            if not old or not value:
+                continue
+            # 耗时越小越好，吞吐量越大越好
+            change = value / old - 1 if name.endswith('_seconds') else old / value - 1
+            flag = '退化' if change > tolerance else ''
+            regressions += bool(flag)
+            print(f"{item['benchmark']:>8} {json.dumps(item['params'], sort_keys=True)} {name}: "
+                  f"{old:.4g} -> {value:.4g} ({change:+.1%}) {flag}")
+    return regressions
+
+def main():
+    suites = {
+        'algorithms': lambda quick: (bench_detect_isolated_points(), bench_majority_filter(), bench_binarize(),
+                                     bench_linear_bounds(), bench_output_formats(), bench_rethreshold(),
+                                     bench_token_required()),
+        'stages': lambda quick: bench_stages(STAGE_CASES[:2] if quick else STAGE_CASES, repeat=2 if quick else 5),
+        'e2e': lambda quick: bench_end_to_end([(2, 256, 4)] if quick else E2E_CASES),
+    }
+    parser = argparse.ArgumentParser(description='图像处理流水线基准测试')
+    parser.add_argument('--suite', nargs='+', choices=list(suites), default=list(suites), help='要运行的测试组')
+    parser.add_argument('--quick', action='store_true', help='只运行少量小规模用例，用于快速检查')
+    parser.add_argument('--json', help='将 stages 和 e2e 的结果保存为JSON文件')
+    parser.add_argument('--compare', help='与之前 --json 保存的结果对比，有退化时退出码为1')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='对比时允许的相对变化，默认0.1')
+    args = parser.parse_args()
+
+    for suite in args.suite:
+        suites[suite](args.quick)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.json}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
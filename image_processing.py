@@ -0,0 +1,520 @@
+"""TIF图像处理流水线：拉伸二值化、多数滤波、去除孤立点和结果编码
+
+只依赖 numpy、OpenCV 和 scipy，Web服务（app.py）和命令行批处理（batch.py）共用。
+"""
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# 多数滤波窗口大小（边长，像素）
+MAJORITY_WINDOW_SIZE = 5
+# 直方图百分位数每块统计的像素数
+PERCENTILE_HISTOGRAM_CHUNK = 1 << 20
+# 分块处理的块边长（像素），图像任一边超过该值时分块处理以限制中间数据的内存，None为不分块
+TILE_SIZE = 4096
+# 处理流程版本号，算法或输出变化时加1，使旧缓存失效
+PIPELINE_VERSION = 1
+
+def _percentile_ranks(values_count, percentiles):
+    """按numpy线性插值规则求每个百分位数的 (前一位次, 后一位次, gamma)"""
+    ranks = []
+    for quantile in np.true_divide(percentiles, 100):
+        virtual_index = (values_count - 1) * quantile
+        if virtual_index >= values_count - 1:
+            previous_index = next_index = values_count - 1
+        else:
+            previous_index = int(np.floor(virtual_index))
+            next_index = previous_index + 1
+        ranks.append((previous_index, next_index, virtual_index - previous_index))
+    return ranks
+
+def _interpolate_percentiles(ranks, order_statistics, dtype):
+    """按与numpy相同的运算顺序在相邻次序统计量之间线性插值
+
+    order_statistics 为 位次 -> 像素值 的映射。
+    """
+    results = []
+    for previous_index, next_index, gamma in ranks:
+        previous = dtype.type(order_statistics[previous_index])
+        next_ = dtype.type(order_statistics[next_index])
+        diff = np.subtract(next_, previous)
+        if gamma >= 0.5:
+            results.append(np.subtract(next_, diff * (1 - gamma)))
+        else:
+            results.append(np.add(previous, diff * gamma))
+    return results
+
+def _row_chunks(image):
+    """按行分块遍历图像，每块约 PERCENTILE_HISTOGRAM_CHUNK 个像素，不复制原图"""
+    rows = image.reshape(image.shape[0], -1)
+    step = max(1, PERCENTILE_HISTOGRAM_CHUNK // max(rows.shape[1], 1))
+    for start in range(0, rows.shape[0], step):
+        yield rows[start:start + step]
+
+def _histogram_percentiles(image, percentiles):
+    """基于直方图计算uint8/uint16图像的百分位数，结果与np.percentile(method='linear')一致"""
+    counts = np.zeros(np.iinfo(image.dtype).max + 1, dtype=np.int64)
+    for chunk in _row_chunks(image):
+        # 分块统计，避免bincount把整幅图像转换为intp
+        counts += np.bincount(chunk.ravel(), minlength=counts.size)
+    cumulative = np.cumsum(counts)
+    ranks = _percentile_ranks(int(cumulative[-1]), percentiles)
+    indices = {index for previous_index, next_index, _ in ranks for index in (previous_index, next_index)}
+    order_statistics = {index: np.searchsorted(cumulative, index, side='right') for index in indices}
+    return _interpolate_percentiles(ranks, order_statistics, image.dtype)
+
+def _float_order_keys(values, key_type):
+    """把浮点数映射为保持大小顺序的无符号整数"""
+    bits = values.view(key_type)
+    sign_bit = key_type(1) << key_type(bits.itemsize * 8 - 1)
+    return np.where(bits & sign_bit, ~bits, bits | sign_bit)
+
+def _radix_percentiles(image, percentiles):
+    """逐16位基数选择求浮点图像的百分位数，每轮只按行分块扫描一遍原图，结果与np.percentile一致"""
+    key_type = np.dtype(f'u{image.dtype.itemsize}').type
+    key_bits = image.dtype.itemsize * 8
+    if any(np.isnan(chunk).any() for chunk in _row_chunks(image)):
+        return [np.float64(np.nan)] * len(percentiles)
+
+    ranks = _percentile_ranks(image.size, percentiles)
+    # 每个待求位次: [已确定的高位前缀, 在该前缀内的剩余位次]
+    targets = {index: [0, index] for previous_index, next_index, _ in ranks
+               for index in (previous_index, next_index)}
+    for shift in range(key_bits - 16, -1, -16):
+        prefixes = {prefix for prefix, _ in targets.values()}
+        counts = {prefix: np.zeros(1 << 16, dtype=np.int64) for prefix in prefixes}
+        for chunk in _row_chunks(image):
+            keys = _float_order_keys(np.ascontiguousarray(chunk), key_type)
+            digits = ((keys >> key_type(shift)) & key_type(0xFFFF)).astype(np.uint16)
+            for prefix in prefixes:
+                selected = digits if shift + 16 == key_bits else digits[(keys >> key_type(shift + 16)) == prefix]
+                counts[prefix] += np.bincount(selected.ravel(), minlength=1 << 16)
+        for target in targets.values():
+            cumulative = np.cumsum(counts[target[0]])
+            digit = int(np.searchsorted(cumulative, target[1], side='right'))
+            target[1] -= int(cumulative[digit - 1]) if digit > 0 else 0
+            target[0] = (target[0] << 16) | digit
+
+    sign_bit = 1 << (key_bits - 1)
+    order_statistics = {}
+    for index, (key, _) in targets.items():
+        bits = key ^ sign_bit if key & sign_bit else ~key & ((1 << key_bits) - 1)
+        order_statistics[index] = np.array(bits, dtype=key_type).view(image.dtype)[()]
+    return _interpolate_percentiles(ranks, order_statistics, image.dtype)
+
+def linear_bounds(image, contrast_factor):
+    """线性拉伸的上下百分位数
+
+    uint8/uint16 图像走一次直方图统计，其余类型一次 np.percentile 同时求两个值。
+    """
+    percentiles = (contrast_factor * 100, 100 - contrast_factor * 100)
+    if (image.dtype in (np.uint8, np.uint16) and image.ndim > 0 and image.size > 0
+            and 0 <= contrast_factor <= 1):
+        low_percentile, high_percentile = _histogram_percentiles(image, percentiles)
+    else:
+        low_percentile, high_percentile = np.percentile(image, percentiles)
+    return low_percentile, high_percentile
+
+def streaming_linear_bounds(image, contrast_factor):
+    """与linear_bounds结果一致，但浮点图像也只分块扫描，不复制整幅图像"""
+    if (image.dtype in (np.float16, np.float32, np.float64) and image.size > 0
+            and 0 <= contrast_factor <= 1):
+        percentiles = (contrast_factor * 100, 100 - contrast_factor * 100)
+        low_percentile, high_percentile = _radix_percentiles(image, percentiles)
+        return low_percentile, high_percentile
+    return linear_bounds(image, contrast_factor)
+
+def linear_show(image, contrast_factor):
+    low_percentile, high_percentile = linear_bounds(image, contrast_factor)
+    return np.clip((image - low_percentile) * 255 / (high_percentile - low_percentile), 0, 255)
+
+def _binarize_cutoff(dtype, low, high, level):
+    """求最小的像素值x，使 (x - low) * 255 / (high - low) >= level
+
+    按linear_show对该dtype实际使用的浮点精度逐步逼近，保证与原计算逐像素一致。
+    """
+    if np.issubdtype(dtype, np.integer):
+        stretch = lambda x: (np.float64(x) - low) * 255 / (high - low)
+        x = int(np.floor(low + level * (high - low) / 255))
+        step_up, step_down = (lambda x: x + 1), (lambda x: x - 1)
+    else:
+        ft = dtype.type
+        low_t, range_t = ft(low), ft(high - low)
+        stretch = lambda x: (x - low_t) * ft(255) / range_t
+        x = ft(low + level * (high - low) / 255)
+        step_up = lambda x: np.nextafter(x, ft(np.inf))
+        step_down = lambda x: np.nextafter(x, ft(-np.inf))
+
+    while stretch(x) >= level:
+        x = step_down(x)
+    while stretch(x) < level:
+        x = step_up(x)
+    return x
+
+def binarize(image, contrast_factor, level=33):
+    """拉伸并二值化：等价于 (linear_show(image).astype(uint8) < level) * 255
+
+    直接用原始像素与阈值比较，不生成浮点中间图像。
+    """
+    low, high = linear_bounds(image, contrast_factor)
+    return binarize_with_bounds(image, low, high, level)
+
+def binarize_with_bounds(image, low, high, level=33):
+    """按给定的拉伸上下界二值化，逐像素计算，可用于分块处理"""
+    # 截断取整后 v < level 等价于 v < ceil(level)
+    level = int(np.ceil(level))
+    if level <= 0 or level > 255:
+        # 拉伸结果被截断在[0, 255]，阈值超出该范围时结果为常数
+        return np.full(image.shape, 0 if level <= 0 else 255, dtype=np.uint8)
+
+    range_t = high - low if np.issubdtype(image.dtype, np.integer) else image.dtype.type(high - low)
+    if not (np.isfinite(low) and np.isfinite(high) and np.isfinite(range_t)):
+        # 非有限的百分位数极少出现，直接沿用原始计算
+        stretched = np.clip((image - low) * 255 / (high - low), 0, 255)
+        return ((stretched.astype(np.uint8) < level) * 255).astype(np.uint8)
+
+    if range_t == 0:
+        # high == low 时 x > low 拉伸为 inf(255)，其余为 -inf 或 nan，转换后均为0
+        mask = np.greater(image, low if np.issubdtype(image.dtype, np.integer) else image.dtype.type(low))
+    else:
+        mask = np.greater_equal(image, _binarize_cutoff(image.dtype, low, high, level))
+    # 浮点图像中的nan像素在原计算中转换为0，同样判为小于阈值
+    np.logical_not(mask, out=mask)
+    mask = mask.view(np.uint8)
+    mask *= 255
+    return mask
+
+def majority_filter(mask, window_size=MAJORITY_WINDOW_SIZE):
+    """多数滤波：窗口内非零像素超过一半时置为255，边界按零填充（与convolve2d mode='same'一致）"""
+    if window_size < 1:
+        raise ValueError(f'窗口大小必须为正整数: {window_size}')
+    ddepth = cv2.CV_16U if window_size * window_size <= 0xFFFF else cv2.CV_32S
+    counts = cv2.boxFilter((mask > 0).view(np.uint8), ddepth, (window_size, window_size),
+                           anchor=(window_size // 2, window_size // 2), normalize=False,
+                           borderType=cv2.BORDER_CONSTANT)
+    # 在uint8上原地置为255，避免布尔数组乘以255时提升为int64
+    mask = np.greater(counts, window_size * window_size // 2).view(np.uint8)
+    mask *= 255
+    return mask
+
+# 当前线程正在统计的各阶段耗时 {阶段: 秒}，未统计时为None
+stage_timings = threading.local()
+
+@contextmanager
+def timed_stage(name):
+    """统计代码块耗时并累加到当前线程的阶段耗时中，未开始统计时不计时"""
+    timings = getattr(stage_timings, 'current', None)
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def load_image(source):
+    """读取图像并取第一个通道，失败返回None
+
+    source 为文件路径、已读入内存的文件内容(bytes)或图像数组（可为np.memmap）。
+    """
+    if isinstance(source, np.ndarray):
+        ori = source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        ori = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    else:
+        ori = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+    if ori is None:
+        return None
+
+    if len(ori.shape) == 2:
+        return ori
+    elif len(ori.shape) == 3:
+        return ori[:, :, 0]
+    return None
+
+def smooth_image(image, window_size=MAJORITY_WINDOW_SIZE):
+    """拉伸二值化并多数滤波，得到去除孤立点之前的掩码"""
+    with timed_stage('stretch'):
+        mask_1 = binarize(image, 0.03, 33)
+    with timed_stage('majority_filter'):
+        return majority_filter(mask_1, window_size)
+
+def remove_isolated_points(mask_1, white_area_threshold, black_area_threshold):
+    """先去除白色孤立点，再填充黑色孤立点，直接修改mask_1"""
+    if white_area_threshold > 0:
+        white_isolated_mask, _ = detect_isolated_points(mask_1, white_area_threshold, False)
+        mask_1[white_isolated_mask == 255] = 0
+
+    if black_area_threshold > 0:
+        black_isolated_mask, _ = detect_isolated_points(255 - mask_1, black_area_threshold, True)
+        mask_1[black_isolated_mask == 255] = 255
+
+    return mask_1
+
+def process_image(source, white_area_threshold, black_area_threshold,
+                  window_size=MAJORITY_WINDOW_SIZE, tile_size=TILE_SIZE):
+    """处理单个图像，source 的取值见 load_image"""
+    try:
+        with timed_stage('decode'):
+            mask_1 = load_image(source)
+        if mask_1 is None:
+            return None
+
+        if tile_size and max(mask_1.shape) > tile_size:
+            return process_image_tiled(mask_1, white_area_threshold, black_area_threshold,
+                                       window_size, tile_size)
+
+        mask_1 = smooth_image(mask_1, window_size)
+        with timed_stage('isolated_points'):
+            return remove_isolated_points(mask_1, white_area_threshold, black_area_threshold)
+    except Exception as e:
+        print(f"处理图像错误: {str(e)}")
+        return None
+
+def detect_isolated_points(image, area_threshold, detect_black=False):
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(image, connectivity=8)
+
+    # 按标签建立查找表，一次索引即可得到孤立点掩码，避免逐个标签扫描全图
+    isolated = stats[:, cv2.CC_STAT_AREA] <= area_threshold
+    isolated[0] = False  # 标签0为背景
+    lut = np.where(isolated, 255, 0).astype(image.dtype)
+    mask = lut[labels]
+    error_flag = 1 if isolated.any() else 0
+
+    return mask, error_flag
+
+def _tile_slices(shape, tile_size):
+    """按 tile_size 切分图像，返回 (行切片, 列切片) 列表"""
+    return [(slice(top, min(top + tile_size, shape[0])), slice(left, min(left + tile_size, shape[1])))
+            for top in range(0, shape[0], tile_size)
+            for left in range(0, shape[1], tile_size)]
+
+def _adjacent_label_pairs(first, second):
+    """两条相邻边界线上按8邻域相接的前景标签对，-1为背景"""
+    length = len(first)
+    pairs = []
+    for offset in (-1, 0, 1):
+        a = first[max(-offset, 0):length - max(offset, 0)]
+        b = second[max(offset, 0):length - max(-offset, 0)]
+        connected = (a >= 0) & (b >= 0)
+        pairs.append((a[connected], b[connected]))
+    return pairs
+
+def remove_isolated_points_tiled(mask, area_threshold, detect_black, tile_size):
+    """分块去除孤立点，结果与整图调用 detect_isolated_points 一致，直接修改mask
+
+    每块单独标记连通区域，再用块边界上相接的标签合并（无向图连通分量），
+    按合并后的总面积判断是否孤立。白色孤立点置0，黑色孤立点置255。
+    """
+    height, width = mask.shape
+    tiles = _tile_slices(mask.shape, tile_size)
+
+    def tile_components(rows, cols):
+        tile = mask[rows, cols]
+        return cv2.connectedComponentsWithStats(255 - tile if detect_black else tile, connectivity=8)
+
+    # 第一遍：各块标签编为全局编号（偏移 + 局部标签 - 1），记录面积和块边界上的标签
+    areas = []
+    edge_rows = {}
+    edge_cols = {}
+    next_id = 0
+    for rows, cols in tiles:
+        count, labels, stats, _ = tile_components(rows, cols)
+        global_labels = lambda line: np.where(line > 0, line.astype(np.int64) + (next_id - 1), -1)
+        areas.append(stats[1:, cv2.CC_STAT_AREA])
+        if rows.start > 0:
+            edge_rows.setdefault(rows.start, np.full(width, -1, np.int64))[cols] = global_labels(labels[0])
+        if rows.stop < height:
+            edge_rows.setdefault(rows.stop - 1, np.full(width, -1, np.int64))[cols] = global_labels(labels[-1])
+        if cols.start > 0:
+            edge_cols.setdefault(cols.start, np.full(height, -1, np.int64))[rows] = global_labels(labels[:, 0])
+        if cols.stop < width:
+            edge_cols.setdefault(cols.stop - 1, np.full(height, -1, np.int64))[rows] = global_labels(labels[:, -1])
+        next_id += count - 1
+    if next_id == 0:
+        return mask
+
+    # 合并跨块相接的连通区域，按合并后的总面积判断
+    pairs = []
+    for edges in (edge_rows, edge_cols):
+        for line in range(tile_size, height if edges is edge_rows else width, tile_size):
+            pairs.extend(_adjacent_label_pairs(edges[line - 1], edges[line]))
+    sources = np.concatenate([a for a, _ in pairs]) if pairs else np.empty(0, np.int64)
+    targets = np.concatenate([b for _, b in pairs]) if pairs else np.empty(0, np.int64)
+    graph = coo_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(next_id, next_id))
+    _, components = connected_components(graph, directed=False)
+    component_areas = np.bincount(components, weights=np.concatenate(areas))
+    isolated = (component_areas <= area_threshold)[components]
+
+    # 第二遍：重新标记各块，按查找表修改
+    value = 255 if detect_black else 0
+    next_id = 0
+    for rows, cols in tiles:
+        count, labels, _, _ = tile_components(rows, cols)
+        lut = np.zeros(count, dtype=bool)
+        lut[1:] = isolated[next_id:next_id + count - 1]
+        mask[rows, cols][lut[labels]] = value
+        next_id += count - 1
+    return mask
+
+def process_image_tiled(image, white_area_threshold, black_area_threshold,
+                        window_size=MAJORITY_WINDOW_SIZE, tile_size=TILE_SIZE):
+    """分块处理单通道图像，结果与整图处理一致
+
+    先分块扫描求全局百分位数，再逐块二值化和多数滤波（块间重叠半个窗口），
+    最后跨块合并连通区域去除孤立点。输入图像和输出掩码为整幅大小，拉伸、二值化、滤波和连通区域标记的
+    中间数据只占单块大小的内存（整图处理时这些中间数据都为整幅大小）。
+    """
+    height, width = image.shape
+    with timed_stage('stretch'):
+        low, high = streaming_linear_bounds(image, 0.03)
+    mask = np.empty((height, width), dtype=np.uint8)
+    halo = window_size // 2
+    for rows, cols in _tile_slices(image.shape, tile_size):
+        top, left = max(rows.start - halo, 0), max(cols.start - halo, 0)
+        region = image[top:min(rows.stop + halo, height), left:min(cols.stop + halo, width)]
+        with timed_stage('stretch'):
+            binary = binarize_with_bounds(region, low, high, 33)
+        with timed_stage('majority_filter'):
+            smoothed = majority_filter(binary, window_size)
+        mask[rows, cols] = smoothed[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left]
+
+    with timed_stage('isolated_points'):
+        if white_area_threshold > 0:
+            remove_isolated_points_tiled(mask, white_area_threshold, False, tile_size)
+
+        if black_area_threshold > 0:
+            remove_isolated_points_tiled(mask, black_area_threshold, True, tile_size)
+
+    return mask
+
+def build_component_tables(smoothed):
+    """为多数滤波后的掩码建立连通区域表，之后可不经拉伸、滤波和连通域标记直接换阈值
+
+    返回合并标签图（1..白色区域数为白色区域，其后为黑色区域）、两类区域的面积，
+    以及8邻域相接的 (白色区域, 黑色区域) 标签对。
+    """
+    white_count, white_labels, white_stats, _ = cv2.connectedComponentsWithStats(smoothed, connectivity=8)
+    black_count, black_labels, black_stats, _ = cv2.connectedComponentsWithStats(255 - smoothed, connectivity=8)
+    white_total = white_count - 1
+
+    label_type = np.uint16 if white_total + black_count <= 0xFFFF else np.uint32
+    labels = np.where(smoothed > 0, white_labels, black_labels + white_total).astype(label_type)
+
+    # 白色区域被去除后会与相邻的黑色区域连成一片，记录相邻关系
+    height, width = smoothed.shape
+    pairs = []
+    for dy, dx in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        first = (slice(0, height - dy), slice(max(-dx, 0), width - max(dx, 0)))
+        second = (slice(dy, height), slice(max(dx, 0), width - max(-dx, 0)))
+        for white_at, black_at in ((first, second), (second, first)):
+            white = white_labels[white_at]
+            black = black_labels[black_at]
+            touching = (white > 0) & (black > 0)
+            pairs.append(white[touching].astype(np.int64) * black_count + black[touching])
+    pairs = np.unique(np.concatenate(pairs))
+
+    return {
+        'labels': labels,
+        'white_areas': white_stats[1:, cv2.CC_STAT_AREA].astype(np.int64),
+        'black_areas': black_stats[1:, cv2.CC_STAT_AREA].astype(np.int64),
+        'edge_white': pairs // black_count,
+        'edge_black': pairs % black_count,
+    }
+
+def apply_component_thresholds(tables, white_area_threshold, black_area_threshold, with_mask=True):
+    """按新阈值由连通区域表得到结果，与process_image逐像素一致
+
+    返回 (掩码, 统计)，with_mask为False时只统计不生成掩码。
+    """
+    white_areas = tables['white_areas']
+    black_areas = tables['black_areas']
+    white_total, black_total = len(white_areas), len(black_areas)
+
+    removed = (white_areas <= white_area_threshold) if white_area_threshold > 0 else np.zeros(white_total, bool)
+    refilled = np.zeros(white_total, bool)
+    filled = np.zeros(black_total, bool)
+    filled_components = 0
+    if black_area_threshold > 0:
+        # 节点：0..黑色区域数-1为黑色区域，其后为白色区域；被去除的白色区域与相邻黑色区域合并
+        merged = removed[tables['edge_white'] - 1]
+        graph = coo_matrix((np.ones(int(merged.sum()), dtype=np.int8),
+                            (tables['edge_black'][merged] - 1, black_total + tables['edge_white'][merged] - 1)),
+                           shape=(black_total + white_total, black_total + white_total))
+        _, components = connected_components(graph, directed=False)
+        areas = np.concatenate([black_areas, np.where(removed, white_areas, 0)])
+        isolated = np.bincount(components, weights=areas) <= black_area_threshold
+        filled = isolated[components[:black_total]]
+        refilled = removed & isolated[components[black_total:]]
+        filled_components = len(np.unique(np.concatenate([components[:black_total][filled],
+                                                          components[black_total:][refilled]])))
+
+    stats = {
+        'white_removed': int(removed.sum()),
+        'black_filled': filled_components,
+    }
+    if not with_mask:
+        return None, stats
+
+    lut = np.concatenate([[0], np.where(removed & ~refilled, 0, 255), np.where(filled, 255, 0)]).astype(np.uint8)
+    return lut[tables['labels']], stats
+
+def is_target_file(file_name):
+    """是否为需要处理的文件：f_*_p.tif / f_*_P.tif / o_*.tif"""
+    return ((file_name.startswith('f_') and file_name.endswith('_p.tif')) or
+            (file_name.startswith('f_') and file_name.endswith('_P.tif')) or
+            (file_name.startswith('o_') and file_name.endswith('.tif')))
+
+def encode_bilevel_tiff(mask):
+    """将0/255掩码编码为1位、Deflate压缩的单条带TIFF（BlackIsZero，255记为1）"""
+    height, width = mask.shape
+    data = zlib.compress(np.packbits(mask > 0, axis=1).tobytes())
+    data_offset = 8 + 2 + 12 * 9 + 4  # 文件头 + 含9个条目的IFD
+    entries = [
+        (256, 4, width),           # ImageWidth
+        (257, 4, height),          # ImageLength
+        (258, 3, 1),               # BitsPerSample
+        (259, 3, 8),               # Compression: Adobe Deflate
+        (262, 3, 1),               # PhotometricInterpretation: BlackIsZero
+        (273, 4, data_offset),     # StripOffsets
+        (277, 3, 1),               # SamplesPerPixel
+        (278, 4, height),          # RowsPerStrip
+        (279, 4, len(data)),       # StripByteCounts
+    ]
+    ifd = [struct.pack('<H', len(entries))]
+    for tag, field_type, value in entries:
+        if field_type == 3:
+            ifd.append(struct.pack('<HHIH2x', tag, field_type, 1, value))
+        else:
+            ifd.append(struct.pack('<HHII', tag, field_type, 1, value))
+    ifd.append(struct.pack('<I', 0))
+    return struct.pack('<2sHI', b'II', 42, 8) + b''.join(ifd) + data
+
+# 结果掩码输出格式：格式名 -> (文件后缀, cv2.imencode参数)，参数为None时使用1位TIFF编码
+OUTPUT_FORMATS = {
+    'tif': ('.tif', []),                                              # 8位TIFF，OpenCV默认LZW压缩
+    'tif_deflate': ('.tif', [cv2.IMWRITE_TIFF_COMPRESSION, 8]),       # 8位Deflate压缩TIFF
+    'tif_1bit': ('.tif', None),                                       # 1位Deflate压缩TIFF
+    'png': ('.png', []),
+}
+DEFAULT_OUTPUT_FORMAT = 'tif'
+
+def encode_mask(mask, output_format=DEFAULT_OUTPUT_FORMAT):
+    """在内存中按指定格式编码掩码，失败返回None"""
+    ext, params = OUTPUT_FORMATS[output_format]
+    if params is None:
+        return encode_bilevel_tiff(mask)
+    ok, buffer = cv2.imencode(ext, mask, params)
+    return buffer.tobytes() if ok else None
+
+def output_file_name_for(file_name, output_format=DEFAULT_OUTPUT_FORMAT):
+    """结果文件名：xxx.tif -> xxx_m.tif（或对应格式的后缀）"""
+    return file_name.replace(".tif", "_m" + OUTPUT_FORMATS[output_format][0])
@@ -0,0 +1,15 @@
+import pytest
+
+import app
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """临时目录和内存任务存储上的测试客户端：不启动处理线程，不连接数据库，不检查IP白名单"""
+    for name in ('BASE_UPLOAD_FOLDER', 'BASE_PROCESSED_FOLDER', 'RESULT_CACHE_FOLDER', 'COMPONENTS_FOLDER'):
+        folder = tmp_path / name.lower()
+        folder.mkdir()
+        monkeypatch.setattr(app, name, str(folder))
+    monkeypatch.setattr(app, 'task_registry', app.TaskRegistry(app.TASK_WORKERS))
+    monkeypatch.setattr(app, 'workers_started', True)
+    monkeypatch.setattr(app, 'is_ip_allowed', lambda ip: True)
+    return app.app.test_client()
@@ -0,0 +1,89 @@
+"""batch.py 的输出测试：结果与 process_image 一致，同名输入不互相覆盖，清单跳过未变化的文件"""
+import os
+import warnings
+import zipfile
+
+import cv2
+import numpy as np
+import pytest
+
+from batch import find_sources, run_batch
+from image_processing import encode_mask, process_image
+
+def make_tif(seed):
+    rng = np.random.default_rng(seed)
+    image = (cv2.blur(rng.random((40, 30)), (3, 3)) * 4000).astype(np.uint16)
+    ok, data = cv2.imencode('.tif', image)
+    assert ok
+    return data.tobytes()
+
+def expected_result(data):
+    return encode_mask(process_image(data, 3, 3), 'tif')
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def inputs(tmp_path):
+    """a/x 与 b/x 两个同名目录，以及 c/x.zip，其中的文件同名但内容不同"""
+    data = {}
+    for i, path in enumerate(['a/x/o_1.tif', 'b/x/o_1.tif', 'a/x/sub/f_2_p.tif']):
+        data[path] = make_tif(i)
+        write_file(str(tmp_path / path), data[path])
+    write_file(str(tmp_path / 'a/x/readme.txt'), b'ignored')
+    os.makedirs(tmp_path / 'c')
+    data['c/x.zip:o_1.tif'] = make_tif(10)
+    with zipfile.ZipFile(tmp_path / 'c/x.zip', 'w') as zip_ref:
+        zip_ref.writestr('o_1.tif', data['c/x.zip:o_1.tif'])
+    return tmp_path, data
+
+def test_same_named_inputs_get_unique_labels(inputs):
+    tmp_path, _ = inputs
+    sources = find_sources([str(tmp_path / 'a/x'), str(tmp_path / 'b/x'), str(tmp_path / 'c/x.zip'),
+                            str(tmp_path / 'a/x')])
+    assert [key for key, _, _ in sources] == ['x/o_1.tif', 'x/sub/f_2_p.tif', 'x_2/o_1.tif', 'x_3/o_1.tif']
+
+def test_directory_output(inputs):
+    tmp_path, data = inputs
+    output = str(tmp_path / 'out')
+    args = ([str(tmp_path / 'a/x'), str(tmp_path / 'b/x'), str(tmp_path / 'c/x.zip')], output, 3, 3)
+    stats = run_batch(*args, output_format='tif', workers=1)
+    assert (stats['total'], stats['processed'], stats['skipped'], stats['failed']) == (4, 4, 0, 0)
+    assert read_file(os.path.join(output, 'x/o_1_m.tif')) == expected_result(data['a/x/o_1.tif'])
+    assert read_file(os.path.join(output, 'x/sub/f_2_p_m.tif')) == expected_result(data['a/x/sub/f_2_p.tif'])
+    assert read_file(os.path.join(output, 'x_2/o_1_m.tif')) == expected_result(data['b/x/o_1.tif'])
+    assert read_file(os.path.join(output, 'x_3/o_1_m.tif')) == expected_result(data['c/x.zip:o_1.tif'])
+
+    stats = run_batch(*args, output_format='tif', workers=1)
+    assert (stats['processed'], stats['skipped']) == (0, 4)
+
+def test_zip_output_has_unique_entries(inputs):
+    tmp_path, data = inputs
+    output = str(tmp_path / 'out.zip')
+    args = ([str(tmp_path / 'a/x'), str(tmp_path / 'b/x'), str(tmp_path / 'c/x.zip')], output, 3, 3)
+    for _ in range(2):
+        run_batch(*args, output_format='tif', workers=2)
+        with zipfile.ZipFile(output) as zip_ref:
+            names = zip_ref.namelist()
+            assert sorted(names) == ['x/o_1_m.tif', 'x/sub/f_2_p_m.tif', 'x_2/o_1_m.tif', 'x_3/o_1_m.tif']
+            assert zip_ref.read('x_2/o_1_m.tif') == expected_result(data['b/x/o_1.tif'])
+
+def test_duplicate_zip_members_keep_last(tmp_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # zipfile对重复成员名给出警告
+        with zipfile.ZipFile(tmp_path / 'in.zip', 'w') as zip_ref:
+            zip_ref.writestr('o_1.tif', make_tif(0))
+            zip_ref.writestr('./o_1.tif', make_tif(1))
+            zip_ref.writestr('o_1.tif', make_tif(2))
+    output = str(tmp_path / 'out.zip')
+    stats = run_batch([str(tmp_path / 'in.zip')], output, 3, 3, output_format='tif', workers=1)
+    assert (stats['total'], stats['processed']) == (1, 1)
+    with zipfile.ZipFile(output) as zip_ref:
+        assert zip_ref.namelist() == ['in/o_1_m.tif']
+        assert zip_ref.read('in/o_1_m.tif') == expected_result(make_tif(2))
@@ -0,0 +1,24 @@
+"""定期清理测试：过期的重新设置阈值结果被删除，任务的结果ZIP和未过期的文件保留"""
+import os
+import time
+import uuid
+
+import app
+
+def test_expired_rethreshold_archives_are_removed(client):
+    task_id = str(uuid.uuid4())
+    names = {
+        'old': f'{task_id}_10_-3_{uuid.uuid4().hex[:12]}_processed.zip',
+        'old_part': f'{task_id}_1_2_{uuid.uuid4().hex[:12]}_processed.zip.part',
+        'recent': f'{task_id}_5_5_{uuid.uuid4().hex[:12]}_processed.zip',
+        'result': f'{uuid.uuid4()}_processed.zip',
+    }
+    expired = time.time() - app.RETHRESHOLD_ZIP_TTL - 60
+    for key, name in names.items():
+        path = os.path.join(app.BASE_PROCESSED_FOLDER, name)
+        open(path, 'wb').close()
+        if key != 'recent':
+            os.utime(path, (expired, expired))
+
+    app.cleanup_old_tasks()
+    assert sorted(os.listdir(app.BASE_PROCESSED_FOLDER)) == sorted([names['recent'], names['result']])
@@ -0,0 +1,133 @@
+"""数据库连接池测试：连接数上限、等待超时、失效连接的回收和替换，用假的 pymysql.connect，不连接数据库"""
+import threading
+import time
+
+import pymysql
+import pytest
+
+from app import ConnectionPool
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.rollbacks = 0
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            raise pymysql.err.OperationalError('gone away')
+
+    def rollback(self):
+        self.rollbacks += 1
+        if not self.alive:
+            raise pymysql.err.OperationalError('gone away')
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def connections(monkeypatch):
+    """按创建顺序记录假连接"""
+    created = []
+
+    def connect(**config):
+        created.append(FakeConnection())
+        return created[-1]
+
+    monkeypatch.setattr(pymysql, 'connect', connect)
+    return created
+
+def make_pool(max_size=2, timeout=0.1, recycle=3600, idle_timeout=600, ping_interval=30):
+    return ConnectionPool({}, max_size, timeout, recycle, idle_timeout, ping_interval)
+
+def test_connections_are_reused(connections):
+    pool = make_pool()
+    for _ in range(5):
+        with pool.connection() as conn:
+            assert conn is connections[0]
+    assert len(connections) == 1
+    assert connections[0].rollbacks == 5
+    status = pool.status()
+    assert (status['created'], status['reused'], status['in_use'], status['idle']) == (1, 4, 0, 1)
+
+def test_checkout_waits_at_max_size_then_times_out(connections):
+    pool = make_pool(max_size=2, timeout=0.1)
+    held = [pool.checkout(), pool.checkout()]
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        pool.checkout()
+    assert time.monotonic() - start >= 0.1
+    assert len(connections) == 2
+    assert pool.status()['timeouts'] == 1
+
+    # 归还后等待中的线程取得连接
+    pool.timeout = 5
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(pool.checkout()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.checkin(*held.pop())
+    waiter.join(5)
+    assert result[0][0] is connections[1]
+    assert pool.status()['in_use'] == 2
+    assert pool.status()['waits'] == 2
+
+def test_concurrent_use_never_exceeds_max_size(connections):
+    pool = make_pool(max_size=3, timeout=5)
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        for _ in range(20):
+            with pool.connection() as conn:
+                with lock:
+                    active.append(conn)
+                    peak.append(len(active))
+                time.sleep(0.001)
+                with lock:
+                    active.remove(conn)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 3
+    assert len(connections) <= 3
+    assert pool.status()['in_use'] == 0
+
+def test_broken_and_expired_connections_are_replaced(connections):
+    pool = make_pool(ping_interval=0)
+    with pool.connection():
+        pass
+    connections[0].alive = False
+    with pool.connection() as conn:
+        assert conn is connections[1]
+    assert connections[0].closed
+    assert pool.status()['broken'] == 1
+
+    pool.recycle = 0
+    with pool.connection() as conn:
+        assert conn is connections[2]
+    assert connections[1].closed
+    assert pool.status()['recycled'] == 1
+
+def test_failed_rollback_discards_connection(connections):
+    pool = make_pool()
+    with pool.connection() as conn:
+        conn.alive = False
+    status = pool.status()
+    assert (status['idle'], status['in_use'], status['broken']) == (0, 0, 1)
+    assert connections[0].closed
+
+def test_connect_error_releases_slot(monkeypatch):
+    def connect(**config):
+        raise pymysql.err.OperationalError('refused')
+
+    monkeypatch.setattr(pymysql, 'connect', connect)
+    pool = make_pool(max_size=1)
+    for _ in range(3):
+        with pytest.raises(pymysql.err.OperationalError):
+            pool.checkout()
+    assert pool.status()['in_use'] == 0
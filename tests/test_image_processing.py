@@ -0,0 +1,189 @@
+"""image_processing 与旧版实现的逐像素一致性测试
+
+只导入 image_processing，不启动 Web 服务。旧版实现按原始写法保留在本文件中作为参照。
+"""
+import cv2
+import numpy as np
+import pytest
+from scipy.signal import convolve2d
+
+import image_processing
+from image_processing import (apply_component_thresholds, binarize, build_component_tables, detect_isolated_points,
+                              encode_mask, linear_bounds, linear_show, majority_filter, process_image,
+                              streaming_linear_bounds)
+
+def detect_isolated_points_loop(image, area_threshold, detect_black=False):
+    """旧版逐标签循环实现"""
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(image, connectivity=8)
+    error_flag = 0
+    mask = np.zeros_like(image)
+    for i in range(1, num_labels):
+        if stats[i, -1] <= area_threshold:
+            error_flag = 1
+            mask[labels == i] = 255
+    return mask, error_flag
+
+def majority_filter_convolve(mask, window_size=5):
+    """旧版convolve2d实现"""
+    counts = convolve2d(mask > 0, np.ones((window_size, window_size), dtype=np.uint8), mode='same')
+    return ((counts > (window_size * window_size / 2)) * 255).astype(np.uint8)
+
+def binarize_linear_show(image, contrast_factor=0.03, level=33):
+    """旧版 linear_show + 阈值实现"""
+    mask = linear_show(image, contrast_factor).astype(np.uint8)
+    return (mask < level).astype(np.uint8) * 255
+
+def process_image_original(image, white_area_threshold, black_area_threshold, window_size=5):
+    """旧版整图处理流程：linear_show 拉伸、convolve2d 多数滤波、逐标签去除孤立点"""
+    mask_1 = binarize_linear_show(image, 0.03, 33)
+    mask_1 = majority_filter_convolve(mask_1, window_size)
+    if white_area_threshold > 0:
+        white_isolated_mask, _ = detect_isolated_points_loop(mask_1, white_area_threshold, False)
+        mask_1[white_isolated_mask == 255] = 0
+    if black_area_threshold > 0:
+        black_isolated_mask, _ = detect_isolated_points_loop(255 - mask_1, black_area_threshold, True)
+        mask_1[black_isolated_mask == 255] = 255
+    return mask_1
+
+def make_image(rng, shape, dtype):
+    """平滑过的随机噪声，拉伸二值化后得到大小不一的斑块"""
+    base = cv2.blur(rng.random(shape), (int(rng.integers(1, 6)),) * 2)
+    if np.issubdtype(dtype, np.integer):
+        return (base * min(np.iinfo(dtype).max, 4000)).astype(dtype)
+    return ((base - 0.5) * 10.0 ** int(rng.integers(-3, 4))).astype(dtype)
+
+def make_mask(rng, shape, density):
+    return ((rng.random(shape) < density) * 255).astype(np.uint8)
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('detect_black', [False, True])
+def test_detect_isolated_points_matches_loop(seed, detect_black):
+    rng = np.random.default_rng(seed)
+    mask = make_mask(rng, (int(rng.integers(1, 80)), int(rng.integers(1, 80))), rng.random())
+    image = 255 - mask if detect_black else mask
+    for threshold in (0, 1, 3, 10, 1000):
+        expected, expected_flag = detect_isolated_points_loop(image, threshold, detect_black)
+        actual, flag = detect_isolated_points(image, threshold, detect_black)
+        assert np.array_equal(actual, expected)
+        assert flag == expected_flag
+
+@pytest.mark.parametrize('window_size', [1, 2, 3, 5, 6, 9])
+@pytest.mark.parametrize('seed', range(10))
+def test_majority_filter_matches_convolve2d(window_size, seed):
+    rng = np.random.default_rng(seed)
+    mask = make_mask(rng, (int(rng.integers(1, 60)), int(rng.integers(1, 60))), rng.random())
+    assert np.array_equal(majority_filter(mask, window_size), majority_filter_convolve(mask, window_size))
+
+def test_majority_filter_rejects_empty_window():
+    with pytest.raises(ValueError):
+        majority_filter(np.zeros((3, 3), np.uint8), 0)
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16, np.float32, np.float64])
+@pytest.mark.parametrize('seed', range(10))
+def test_binarize_matches_linear_show(dtype, seed):
+    rng = np.random.default_rng(seed)
+    image = make_image(rng, (int(rng.integers(1, 70)), int(rng.integers(1, 70))), dtype)
+    for contrast_factor, level in ((0.03, 33), (0.0, 33), (0.5, 1), (0.03, 254.5), (0.03, 0), (0.03, 300)):
+        with np.errstate(all='ignore'):
+            expected = binarize_linear_show(image, contrast_factor, level)
+        assert np.array_equal(binarize(image, contrast_factor, level), expected)
+
+def test_binarize_constant_image():
+    image = np.full((8, 8), 1234, np.uint16)
+    with np.errstate(all='ignore'):
+        expected = binarize_linear_show(image)
+    assert np.array_equal(binarize(image, 0.03), expected)
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int32, np.float32])
+@pytest.mark.parametrize('seed', range(10))
+def test_linear_bounds_matches_np_percentile(dtype, seed):
+    rng = np.random.default_rng(seed)
+    image = make_image(rng, (int(rng.integers(1, 100)), int(rng.integers(1, 100))), dtype)
+    for contrast_factor in (0.0, 0.03, 0.5, 1.0, float(rng.random())):
+        expected = (np.percentile(image, contrast_factor * 100), np.percentile(image, 100 - contrast_factor * 100))
+        assert tuple(linear_bounds(image, contrast_factor)) == expected
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('dtype', [np.float16, np.float32, np.float64])
+@pytest.mark.parametrize('seed', range(30))
+def test_radix_percentiles_match_np_percentile(dtype, seed):
+    rng = np.random.default_rng(seed)
+    image = (rng.standard_normal((int(rng.integers(1, 200)), int(rng.integers(1, 6)))) *
+             10.0 ** int(rng.integers(-3, 4))).astype(dtype)
+    case = seed % 5
+    if case == 1:
+        image = np.round(image)
+    elif case == 2:
+        image[:] = image.flat[0]
+    elif case == 3:
+        image.flat[0], image.flat[-1] = np.inf, -np.inf
+    elif case == 4:
+        image[:] = 0
+        image.flat[::2] = -0.0
+    if seed % 3 == 0 and image.shape[1] > 1:
+        image = image[:, ::2]  # 非连续数组
+    for contrast_factor in (0.0, 0.03, 0.5, 1.0):
+        expected = linear_bounds(image, contrast_factor)
+        actual = streaming_linear_bounds(image, contrast_factor)
+        # 含 ±inf 时插值结果可能为 nan
+        np.testing.assert_array_equal(np.array(actual, np.float64), np.array(expected, np.float64))
+        assert [type(x) for x in actual] == [type(x) for x in expected]
+
+def test_radix_percentiles_nan():
+    image = np.arange(20, dtype=np.float32).reshape(4, 5)
+    image[2, 3] = np.nan
+    assert all(np.isnan(x) for x in streaming_linear_bounds(image, 0.03))
+
+def test_radix_percentiles_small_chunks(monkeypatch):
+    monkeypatch.setattr(image_processing, 'PERCENTILE_HISTOGRAM_CHUNK', 5)
+    image = np.random.default_rng(0).standard_normal((77, 13)).astype(np.float32)
+    assert streaming_linear_bounds(image, 0.03) == linear_bounds(image, 0.03)
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+@pytest.mark.parametrize('seed', range(8))
+def test_process_image_matches_original(dtype, seed):
+    rng = np.random.default_rng(seed)
+    image = make_image(rng, (int(rng.integers(1, 60)), int(rng.integers(1, 60))), dtype)
+    for white_area_threshold, black_area_threshold in ((0, 0), (3, 3), (20, 5), (1000, 1000)):
+        with np.errstate(all='ignore'):
+            expected = process_image_original(image, white_area_threshold, black_area_threshold)
+        actual = process_image(image, white_area_threshold, black_area_threshold, tile_size=None)
+        assert np.array_equal(actual, expected)
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+@pytest.mark.parametrize('seed', range(8))
+def test_tiled_matches_whole_image(dtype, seed):
+    rng = np.random.default_rng(seed)
+    image = make_image(rng, (int(rng.integers(1, 50)), int(rng.integers(1, 50))), dtype)
+    for window_size in (1, 3, 5, 6):
+        for white_area_threshold, black_area_threshold in ((0, 0), (3, 3), (20, 5), (1000, 1000)):
+            expected = process_image(image, white_area_threshold, black_area_threshold, window_size, None)
+            for tile_size in (2, 5, 16):
+                actual = process_image(image, white_area_threshold, black_area_threshold, window_size, tile_size)
+                assert np.array_equal(actual, expected), (window_size, tile_size)
+
+def test_tiled_single_pixel_tiles():
+    image = make_image(np.random.default_rng(0), (9, 11), np.uint16)
+    for white_area_threshold, black_area_threshold in ((3, 3), (20, 5)):
+        expected = process_image(image, white_area_threshold, black_area_threshold, tile_size=None)
+        assert np.array_equal(process_image(image, white_area_threshold, black_area_threshold, tile_size=1), expected)
+
+@pytest.mark.parametrize('seed', range(15))
+def test_component_thresholds_match_process_image(seed):
+    rng = np.random.default_rng(seed)
+    image = make_image(rng, (int(rng.integers(1, 60)), int(rng.integers(1, 60))), np.uint16)
+    tables = build_component_tables(image_processing.smooth_image(image))
+    for white_area_threshold in (0, 1, 3, 10, 50, 1000):
+        for black_area_threshold in (0, 1, 3, 10, 50, 1000):
+            expected = process_image(image, white_area_threshold, black_area_threshold, tile_size=None)
+            mask, stats = apply_component_thresholds(tables, white_area_threshold, black_area_threshold)
+            assert np.array_equal(mask, expected), (white_area_threshold, black_area_threshold)
+            _, counts_only = apply_component_thresholds(tables, white_area_threshold, black_area_threshold,
+                                                        with_mask=False)
+            assert counts_only == stats
+
+@pytest.mark.parametrize('output_format', sorted(image_processing.OUTPUT_FORMATS))
+def test_encode_mask_round_trip(output_format):
+    mask = make_mask(np.random.default_rng(0), (37, 53), 0.4)
+    data = encode_mask(mask, output_format)
+    assert np.array_equal(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED) > 0, mask > 0)
@@ -0,0 +1,46 @@
+"""结果缓存测试：写入时按最近使用时间淘汰，缓存总大小任何时候都不超过上限"""
+import os
+
+import pytest
+
+import app
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'RESULT_CACHE_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app, 'RESULT_CACHE_MAX_BYTES', 1000)
+    return tmp_path
+
+def cached_size(folder):
+    return sum(path.stat().st_size for path in folder.iterdir() if not path.name.startswith('.'))
+
+def test_put_evicts_least_recently_used(cache):
+    for i in range(3):
+        app.result_cache_put(f'key{i}', bytes(300))
+        os.utime(cache / f'key{i}', (i, i))
+    assert app.result_cache_get('key0') is not None
+    # key0 刚被读取，写入 key3 时淘汰最久未使用的 key1，写入后不超过上限的90%
+    app.result_cache_put('key3', bytes(300))
+    assert sorted(path.name for path in cache.iterdir() if not path.name.startswith('.')) == ['key0', 'key2', 'key3']
+    assert int((cache / '.size').read_text()) == cached_size(cache) == 900
+
+def test_total_size_never_exceeds_limit(cache):
+    for i in range(50):
+        app.result_cache_put(f'key{i}', bytes(37 * (i % 7 + 1)))
+        assert cached_size(cache) <= 1000
+        assert int((cache / '.size').read_text()) == cached_size(cache)
+
+def test_overwrite_and_lost_size_record(cache):
+    app.result_cache_put('key', bytes(400))
+    app.result_cache_put('key', bytes(400))
+    assert int((cache / '.size').read_text()) == 400
+    # 记录丢失时扫描目录重新统计，并删除写入中途退出留下的临时文件
+    (cache / '.size').unlink()
+    (cache / 'stale.123.tmp').write_bytes(bytes(500))
+    app.result_cache_put('other', bytes(400))
+    assert not (cache / 'stale.123.tmp').exists()
+    assert int((cache / '.size').read_text()) == cached_size(cache) == 800
+
+def test_oversized_result_is_not_cached(cache):
+    app.result_cache_put('key', bytes(1001))
+    assert app.result_cache_get('key') is None
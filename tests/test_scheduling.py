@@ -0,0 +1,152 @@
+"""任务调度测试：OrderIndex 与有序列表一致，内存和SQLite任务存储的调度顺序、排队位置一致
+
+只创建临时的任务存储，不启动处理线程和Web服务。
+"""
+import bisect
+import random
+import threading
+import time
+
+import pytest
+
+import app
+from app import OrderIndex, SqliteTaskStore, TaskRegistry, TaskStatus, task_state
+
+@pytest.mark.parametrize('seed', range(5))
+def test_order_index_matches_sorted_list(seed):
+    rng = random.Random(seed)
+    index = OrderIndex()
+    entries = []
+    for _ in range(2000):
+        if entries and rng.random() < 0.4:
+            key, value, cost = entries.pop(rng.randrange(len(entries)))
+            index.remove(key)
+        else:
+            key = (rng.randint(0, 50), rng.random())
+            entry = (key, f'v{key}', rng.randint(0, 100))
+            bisect.insort(entries, entry)
+            index.insert(*entry)
+        assert len(index) == len(entries)
+        probe = (rng.randint(0, 50), rng.random())
+        position = bisect.bisect_left(entries, (probe,))
+        assert index.rank(probe) == (position, sum(cost for _, _, cost in entries[:position]))
+    assert list(index) == [(key, value) for key, value, _ in entries]
+
+def make_task(client_ip, cost):
+    return {'data': {'cost': {'cost': cost}}, 'client_ip': client_ip, 'created_at': time.time()}
+
+def queued_order(store, task_ids):
+    """各排队任务的 (排队位置, 前面任务的成本之和)"""
+    if isinstance(store, TaskRegistry):
+        return {task_id: store.scheduler.position(task_id) for task_id in task_ids}
+    store.get(task_ids[0])  # 同步调度顺序副本
+    return {task_id: store.order.rank(store.order_keys[task_id]) for task_id in task_ids}
+
+@pytest.mark.parametrize('scheduling', ['fair', 'fifo'])
+@pytest.mark.parametrize('shortest_job_first', [False, True])
+@pytest.mark.parametrize('max_running', [0, 1])
+def test_memory_and_sqlite_schedule_match(tmp_path, monkeypatch, scheduling, shortest_job_first, max_running):
+    monkeypatch.setattr(app, 'TASK_SCHEDULING', scheduling)
+    monkeypatch.setattr(app, 'TASK_SHORTEST_JOB_FIRST', shortest_job_first)
+    monkeypatch.setattr(app, 'TASK_MAX_RUNNING_PER_IP', max_running)
+    memory = TaskRegistry(2)
+    sqlite = SqliteTaskStore(str(tmp_path / 'tasks.db'), 2, 0.05, 60)
+    rng = random.Random(f'{scheduling}{shortest_job_first}{max_running}')
+    queued, running = [], []
+    for step in range(300):
+        action = rng.random()
+        if action < 0.5:
+            task_id = f'task{step}'
+            client_ip, cost = f'10.0.0.{rng.randint(1, 4)}', rng.choice([1, 5, 20, 100])
+            memory.add(task_id, make_task(client_ip, cost))
+            sqlite.add(task_id, make_task(client_ip, cost))
+            queued.append(task_id)
+        elif action < 0.8:
+            claimed = sqlite.try_claim()
+            if claimed is None:
+                assert memory.scheduler.pop() is None
+                continue
+            assert memory.claim()[0] == claimed[0]
+            queued.remove(claimed[0])
+            running.append(claimed[0])
+        elif running:
+            task_id = running.pop(rng.randrange(len(running)))
+            memory.finish(task_id, TaskStatus.COMPLETED, result={})
+            sqlite.finish(task_id, TaskStatus.COMPLETED, result={})
+        if queued:
+            assert queued_order(memory, queued) == queued_order(sqlite, queued)
+            task_id = rng.choice(queued)
+            assert memory.get(task_id)[1] == sqlite.get(task_id)[1]
+
+def test_sqlite_order_follows_other_processes(tmp_path):
+    """其他进程（另一个存储实例）的变化按 queue_log 同步，日志被清理后从任务表重新加载"""
+    path = str(tmp_path / 'tasks.db')
+    reader = SqliteTaskStore(path, 2, 0.05, 60)
+    writer = SqliteTaskStore(path, 2, 0.05, 60)
+    writer.owner = 'other-host:1'
+    rng = random.Random(0)
+    for step in range(200):
+        if rng.random() < 0.6:
+            writer.add(f'task{step}', make_task(f'10.0.0.{rng.randint(1, 3)}', rng.randint(1, 50)))
+        else:
+            claimed = writer.try_claim()
+            if claimed is not None:
+                writer.finish(claimed[0], TaskStatus.COMPLETED, result={})
+        if step == 100:
+            writer.log_keep = 0
+            writer.expire(3600)
+        conn = reader.connect()
+        rows = conn.execute(f"""SELECT task_id, cost FROM tasks WHERE status = 'queued'
+                                ORDER BY {', '.join(reader.schedule_columns())}""").fetchall()
+        for position, row in enumerate(rows):
+            task, queue_position = reader.get(row['task_id'])
+            assert queue_position == position
+            assert reader.order.rank(reader.order_keys[row['task_id']]) == \
+                (position, sum(other['cost'] for other in rows[:position]))
+        assert len(reader.order) == len(rows)
+
+def test_sqlite_counts_workers_of_all_processes(tmp_path):
+    first = SqliteTaskStore(str(tmp_path / 'tasks.db'), 1, 0.05, 60)
+    second = SqliteTaskStore(str(tmp_path / 'tasks.db'), 2, 0.05, 60)
+    conn = first.connect()
+    conn.execute('DELETE FROM workers')
+    first.owner, second.owner = 'host-a:1', 'host-b:2'
+    first.register_workers(conn)
+    second.register_workers(second.connect())
+    assert first.total_workers(conn) == 3
+
+    first.add('running', make_task('10.0.0.1', 1))
+    first.add('queued', make_task('10.0.0.1', 1))
+    assert first.try_claim()[0] == 'running'
+    # 一个处理中的任务占用3个线程中的一个，排队任务可以立即开始
+    assert first.get('queued')[1] == 0
+    # 另一个进程的心跳超时后只计本进程的1个线程
+    conn.execute("UPDATE workers SET heartbeat_at = 0 WHERE owner = 'host-b:2'")
+    assert first.total_workers(conn) == 1
+    assert first.get('queued')[1] == 1
+
+def test_sqlite_progress_wakes_only_its_watchers(tmp_path):
+    # 轮询间隔很长，等待者只能由通知唤醒
+    store = SqliteTaskStore(str(tmp_path / 'tasks.db'), 2, 30, 60)
+    for task_id in ('a', 'b'):
+        store.add(task_id, make_task('10.0.0.1', 1))
+        assert store.try_claim()[0] == task_id
+    results = {}
+
+    def watch(task_id):
+        task, position = store.get(task_id)
+        results[task_id] = store.wait(task_id, task_state(task, position), 10)
+
+    threads = {task_id: threading.Thread(target=watch, args=(task_id,)) for task_id in ('a', 'b')}
+    for thread in threads.values():
+        thread.start()
+    while len(store.watchers) < 2:
+        time.sleep(0.01)
+    store.set_progress('a', 1, 2)
+    threads['a'].join(5)
+    assert results['a'][0]['progress'] == {'done': 1, 'total': 2}
+    assert store.watchers['b'][2] == 0
+    store.set_progress('b', 1, 3)
+    threads['b'].join(5)
+    assert results['b'][0]['progress'] == {'done': 1, 'total': 3}
+    assert not store.watchers
@@ -0,0 +1,78 @@
+"""token验证缓存测试：缓存命中不再解码，过期后重新验证并拒绝，缓存条数不超过 TOKEN_CACHE_SIZE"""
+import datetime
+import time
+
+import jwt
+import pytest
+
+import app
+
+def make_token(user='admin', expires_in=3600, secret=None):
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in)
+    claims = {'user': user, 'exp': expires}
+    return jwt.encode(claims, secret or app.app.config['SECRET_KEY'], algorithm='HS256')
+
+@pytest.fixture
+def decodes(monkeypatch):
+    """记录实际解码的token，并清空缓存"""
+    calls = []
+
+    def decode(token, *args, **kwargs):
+        calls.append(token)
+        return jwt.decode(token, *args, **kwargs)
+
+    monkeypatch.setattr(app, 'decode', decode)
+    monkeypatch.setattr(app, 'verified_tokens', type(app.verified_tokens)())
+    return calls
+
+def test_verified_token_is_cached(decodes):
+    token = make_token()
+    for _ in range(3):
+        assert app.verify_token(token)['user'] == 'admin'
+    assert decodes == [token]
+
+def test_expired_token_is_verified_again_and_rejected(decodes):
+    token = make_token(expires_in=1)
+    claims = app.verify_token(token)
+    while time.time() < claims['exp'] + 0.01:
+        time.sleep(0.05)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        app.verify_token(token)
+    assert decodes == [token, token]
+    assert token not in app.verified_tokens
+
+def test_invalid_token_is_not_cached(decodes):
+    token = make_token(secret='wrong-secret')
+    for _ in range(2):
+        with pytest.raises(jwt.InvalidSignatureError):
+            app.verify_token(token)
+    assert len(decodes) == 2
+    assert not app.verified_tokens
+
+def test_cache_keeps_most_recently_used(decodes, monkeypatch):
+    monkeypatch.setattr(app, 'TOKEN_CACHE_SIZE', 2)
+    tokens = [make_token(user=f'user{i}') for i in range(3)]
+    app.verify_token(tokens[0])
+    app.verify_token(tokens[1])
+    app.verify_token(tokens[0])
+    app.verify_token(tokens[2])
+    assert list(app.verified_tokens) == [tokens[0], tokens[2]]
+    app.verify_token(tokens[0])
+    app.verify_token(tokens[1])
+    assert decodes == [tokens[0], tokens[1], tokens[2], tokens[1]]
+
+def test_cache_disabled(decodes, monkeypatch):
+    monkeypatch.setattr(app, 'TOKEN_CACHE_SIZE', 0)
+    token = make_token()
+    app.verify_token(token)
+    app.verify_token(token)
+    assert decodes == [token, token]
+
+def test_token_required(client, decodes):
+    assert client.get('/api/db-pool/status').status_code == 401
+    headers = {'Authorization': f'Bearer {make_token(expires_in=-10)}'}
+    assert client.get('/api/db-pool/status', headers=headers).status_code == 401
+    headers = {'Authorization': f'Bearer {make_token()}'}
+    for _ in range(2):
+        assert client.get('/api/db-pool/status', headers=headers).get_json()['status'] == 'success'
+    assert len(decodes) == 2
@@ -0,0 +1,85 @@
+"""分块上传测试：按位置续传、CRC校验失败时丢弃分块、上传数和总大小的额度"""
+import hashlib
+import io
+import os
+import zipfile
+import zlib
+
+import app
+
+def make_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_ref:
+        zip_ref.writestr('readme.txt', os.urandom(3000))
+    return buffer.getvalue()
+
+def start_upload(client, data, **fields):
+    response = client.post('/api/uploads', json=dict(size=len(data), **fields))
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['upload_id']
+
+def put_chunk(client, upload_id, offset, chunk, crc=None):
+    headers = {} if crc is None else {'X-Chunk-CRC32': crc}
+    return client.put(f'/api/uploads/{upload_id}?offset={offset}', data=chunk, headers=headers)
+
+def test_chunks_append_at_the_received_offset(client):
+    data = make_zip()
+    upload_id = start_upload(client, data, sha256=hashlib.sha256(data).hexdigest())
+    response = put_chunk(client, upload_id, 0, data[:1000])
+    assert response.get_json() == {'offset': 1000, 'status': 'success'}
+
+    # 重发已接收的分块或跳过一段时返回服务器已接收的位置
+    for offset in (0, 1500):
+        response = put_chunk(client, upload_id, offset, data[offset:offset + 500])
+        assert response.status_code == 409
+        assert response.get_json()['offset'] == 1000
+    assert client.get(f'/api/uploads/{upload_id}').get_json()['offset'] == 1000
+
+    response = client.post(f'/api/uploads/{upload_id}/finalize', json={})
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 1000
+
+    response = put_chunk(client, upload_id, 1000, data[1000:], f'{zlib.crc32(data[1000:]):08x}')
+    assert response.get_json() == {'offset': len(data), 'status': 'success'}
+    response = client.post(f'/api/uploads/{upload_id}/finalize', json={})
+    assert response.get_json()['status'] == 'success'
+    assert client.get(f'/api/uploads/{upload_id}').status_code == 404
+    assert app.task_registry.get(response.get_json()['task_id'])[0] is not None
+
+def test_chunk_with_wrong_crc_is_discarded(client):
+    data = make_zip()
+    upload_id = start_upload(client, data)
+    response = put_chunk(client, upload_id, 0, data[:1000], f'{zlib.crc32(data[:1000]) ^ 1:x}')
+    assert response.status_code == 400
+    assert response.get_json()['offset'] == 0
+    assert client.get(f'/api/uploads/{upload_id}').get_json()['offset'] == 0
+
+    for crc in ('xyz', '123456789', '-1'):
+        assert put_chunk(client, upload_id, 0, data[:1000], crc).status_code == 400, crc
+    assert client.get(f'/api/uploads/{upload_id}').get_json()['offset'] == 0
+
+def test_chunk_past_declared_size_is_rejected(client):
+    data = make_zip()
+    upload_id = start_upload(client, data)
+    assert put_chunk(client, upload_id, 0, data + b'x').status_code == 413
+    assert client.post('/api/uploads', json={'size': app.MAX_UPLOAD_SIZE + 1}).status_code == 413
+
+def test_open_uploads_per_ip_are_limited(client, monkeypatch):
+    monkeypatch.setattr(app, 'UPLOAD_MAX_PER_IP', 2)
+    data = make_zip()
+    upload_ids = [start_upload(client, data) for _ in range(2)]
+    assert client.post('/api/uploads', json={'size': len(data)}).status_code == 429
+    # 其他IP不受影响
+    other = client.post('/api/uploads', json={'size': len(data)}, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert other.status_code == 200
+
+    # 完成一个上传后可以开始新的上传
+    assert put_chunk(client, upload_ids[0], 0, data).status_code == 200
+    assert client.post(f'/api/uploads/{upload_ids[0]}/finalize', json={}).status_code == 200
+    start_upload(client, data)
+
+def test_reserved_bytes_are_limited(client, monkeypatch):
+    monkeypatch.setattr(app, 'UPLOAD_MAX_RESERVED_BYTES', 10000)
+    assert client.post('/api/uploads', json={'size': 6000}).status_code == 200
+    assert client.post('/api/uploads', json={'size': 5000}).status_code == 413
+    assert client.post('/api/uploads', json={'size': 4000}).status_code == 200
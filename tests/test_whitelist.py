@@ -0,0 +1,131 @@
+"""IP白名单测试：CIDR 网段匹配，版本号变化时重新加载，数据库不可用时继续使用已加载的白名单"""
+import contextlib
+import threading
+import time
+
+import pytest
+
+import app
+from app import IpWhitelistIndex
+
+@pytest.mark.parametrize('ip, allowed', [
+    ('192.168.1.7', True),
+    ('192.168.255.255', True),
+    ('192.169.0.0', False),
+    ('10.0.0.5', True),
+    ('10.0.0.6', False),
+    ('172.16.0.0', True),
+    ('172.31.255.255', True),
+    ('172.32.0.0', False),
+    ('::ffff:10.0.0.5', True),
+    ('2001:db8::1', True),
+    ('2001:db9::1', False),
+    ('not-an-ip', False),
+    ('legacy-host', True),
+])
+def test_index_matches_networks(ip, allowed):
+    index = IpWhitelistIndex(True, ['192.168.0.0/16', '10.0.0.5', ' 172.16.0.0/13', '172.24.0.0/13',
+                                    '2001:db8::/32', 'legacy-host'])
+    assert index.contains(ip) == allowed
+
+def test_disabled_index_allows_everyone():
+    assert IpWhitelistIndex(False, []).contains('203.0.113.1')
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query):
+        self.result = [{'enabled': 1}] if 'whitelist_settings' in query else [{'ip': ip} for ip in self.rows]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+class FakePool:
+    """按 rows 返回白名单，rows 为异常时连接失败；gate 不为None时连接前等待"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.loads = 0
+        self.gate = None
+
+    @contextlib.contextmanager
+    def connection(self):
+        self.loads += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        if isinstance(self.rows, Exception):
+            raise self.rows
+        yield FakeConnection(self.rows)
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool(['10.0.0.0/8'])
+    monkeypatch.setattr(app, 'db_pool', pool)
+    monkeypatch.setattr(app, 'task_registry', app.TaskRegistry(1))
+    monkeypatch.setattr(app, 'ip_whitelist', None)
+    monkeypatch.setattr(app, 'ip_whitelist_failed_at', None)
+    return pool
+
+def test_reloads_when_version_changes(pool):
+    assert app.is_ip_allowed('10.1.2.3')
+    assert not app.is_ip_allowed('192.168.0.1')
+    pool.rows = ['192.168.0.0/16']
+    assert app.is_ip_allowed('10.1.2.3')
+    assert pool.loads == 1
+    app.invalidate_ip_whitelist()
+    assert app.is_ip_allowed('192.168.0.1')
+    assert not app.is_ip_allowed('10.1.2.3')
+    assert pool.loads == 2
+
+def test_failed_reload_keeps_previous_index(pool, monkeypatch):
+    assert app.is_ip_allowed('10.1.2.3')
+    pool.rows = RuntimeError('connect timeout')
+    app.invalidate_ip_whitelist()
+    assert app.is_ip_allowed('10.1.2.3')
+    assert not app.is_ip_allowed('192.168.0.1')
+    # 重试间隔内不再连接数据库
+    assert pool.loads == 2
+
+    monkeypatch.setattr(app, 'IP_WHITELIST_RETRY', 0)
+    pool.rows = ['192.168.0.0/16']
+    assert app.is_ip_allowed('192.168.0.1')
+    assert app.ip_whitelist_failed_at is None
+
+def test_first_load_failure_denies_and_backs_off(pool):
+    pool.rows = RuntimeError('connect timeout')
+    assert not app.is_ip_allowed('10.1.2.3')
+    assert not app.is_ip_allowed('10.1.2.3')
+    assert pool.loads == 1
+
+def test_reload_does_not_block_other_requests(pool, monkeypatch):
+    assert app.is_ip_allowed('10.1.2.3')
+    monkeypatch.setattr(app, 'IP_WHITELIST_TTL', 0)
+    pool.gate = threading.Event()
+    reloading = threading.Thread(target=app.is_ip_allowed, args=('10.1.2.3',))
+    reloading.start()
+    while pool.loads < 2:
+        time.sleep(0.01)
+    # 重新加载的线程等待数据库期间，其他请求使用旧白名单立即返回
+    assert app.is_ip_allowed('10.1.2.3')
+    assert pool.loads == 2
+    pool.gate.set()
+    reloading.join(5)
+    assert not reloading.is_alive()
@@ -7,6 +7,7 @@ export const API_PATHS = {
     WHITELIST_STATUS: '/api/whitelist/status',
     SETTINGS_THRESHOLD: '/api/settings/threshold',
     CHANGE_PASSWORD: '/api/change-password',
+    UPLOADS: '/api/uploads',
     DOWNLOAD: (filename) => `/api/download/${filename}`,
     TASK_STATUS: '/api/task-status'
 };